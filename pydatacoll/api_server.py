@@ -15,7 +15,7 @@
 # under the License.
 
 import argparse
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
 import importlib
 from multiprocessing import Process
 try:
@@ -23,19 +23,30 @@ try:
 except ImportError:
     import json
 import asyncio
-import aioredis
-from aiohttp import web
-import redis
+from aiohttp import web, MsgType
 import pydatacoll.utils.logger as my_logger
-from pydatacoll.utils.json_response import JSON
+from pydatacoll.utils.json_response import JSON, JSONStream
 from pydatacoll.resources.protocol import *
 from pydatacoll.resources.redis_key import *
 from pydatacoll.utils.func_container import ParamFunctionContainer, param_function
-from pydatacoll import plugins
+from pydatacoll import plugins, version
+from pydatacoll.utils.api_doc import index_text, make_etag, openapi_spec, route_list
 from pydatacoll.utils.read_config import *
+from pydatacoll.utils.redis_pool import get_redis_pool, get_broker, redis_stats, close_redis_pool
+from pydatacoll.utils.time_index import TimeIndex
+from pydatacoll.utils.key_index import KeyIndex
+from pydatacoll.utils.site_model import EXPORT_ORDER, ModelReader, ModelWriter, queue_record
+from pydatacoll.utils.aggregate import aggregate, AggregateCache
+from pydatacoll.utils.live_feed import LiveFeed
+from pydatacoll.utils.rpc import RPCClient
 
 logger = my_logger.get_logger('APIServer')
 HANDLER_TIME_OUT = config.getint('SERVER', 'web_timeout', fallback=10)
+CHUNK_SIZE = max(config.getint('SERVER', 'chunk_size', fallback=1000), 1)
+WRITE_BATCH = max(config.getint('SERVER', 'write_batch', fallback=1000), 1)
+LIVE_QUEUE_SIZE = config.getint('SERVER', 'live_queue_size', fallback=1000)
+LIVE_BUFFER_SIZE = config.getint('SERVER', 'live_buffer_size', fallback=65536)
+DOC_MAX_AGE = config.getint('SERVER', 'doc_max_age', fallback=300)
 
 
 class APIServer(ParamFunctionContainer):
@@ -46,9 +57,23 @@ class APIServer(ParamFunctionContainer):
         if self.io_loop is None:
             self.io_loop = asyncio.new_event_loop()
             asyncio.set_event_loop(self.io_loop)
-        self.redis_client = redis.StrictRedis(db=config.getint('REDIS', 'db', fallback=1), decode_responses=True)
+        self.redis_client = get_redis_pool(self.io_loop)
+        self.broker = get_broker(self.io_loop)
+        self.time_index = TimeIndex()
+        self.key_index = KeyIndex(self.time_index)
+        self.aggregate_cache = AggregateCache(config.getint('SERVER', 'aggregate_cache', fallback=256))
+        self.data_sub = self.io_loop.run_until_complete(
+                self.broker.subscribe('CHANNEL:DEVICE_DATA:*', pattern=True).open())
+        self.live_feeds = set()
+        self.io_loop.create_task(self._dispatch_data())
+        self.rpc = RPCClient(self.broker, self.redis_client, self.io_loop)
         self.web_app = web.Application()
         self._add_router()
+        # API documents never change after started, built once and served with ETag
+        self.routes = route_list(self.module_arg_dict)
+        self.index_cache = dict()  # scheme://host -> (body, etag) of get_index
+        openapi = json.dumps(openapi_spec(self, version=version)).encode('utf-8')
+        self.openapi = (openapi, make_etag(openapi))
         self.web_handler = self.web_app.make_handler()
         self.web_server = self.io_loop.run_until_complete(
                 self.io_loop.create_server(self.web_handler, '127.0.0.1', self.port))
@@ -91,16 +116,114 @@ class APIServer(ParamFunctionContainer):
 
     def stop_server(self):
         self._uninstall_plugins()
+        for feed in self.live_feeds:
+            feed.close()
+        self.io_loop.run_until_complete(self.data_sub.close())
+        self.io_loop.run_until_complete(self.rpc.close())
         self.web_server.close()
         self.io_loop.run_until_complete(self.web_server.wait_closed())
         self.io_loop.run_until_complete(self.web_handler.finish_connections(1.0))
         self.io_loop.run_until_complete(self.web_app.finish())
+        self.io_loop.run_until_complete(close_redis_pool(self.io_loop))
         logger.info('ApiServer stopped')
 
-    def found_and_delete(self, match: str):
-        keys = list(self.redis_client.scan_iter(match))
-        if keys:
-            self.redis_client.delete(*keys)
+    async def cascade_delete(self, kind: str, obj_id):
+        """
+        delete all mappings and data referencing a device/term/item, found by index sets instead of SCAN
+        :param kind: DEVICE, TERM or ITEM
+        """
+        pipe = self.redis_client.pipeline()
+        pipe.smembers('SET:{}_MAPPING:{}'.format(kind, obj_id))
+        pipe.smembers('SET:{}_DATA:{}'.format(kind, obj_id))
+        mapping_keys, data_keys = await pipe.execute()
+        await self.key_index.delete_mappings(self.redis_client, mapping_keys)
+        await self.key_index.delete_data(self.redis_client, data_keys)
+
+    async def delete_term_items(self, term_id=None, item_id=None):
+        """
+        delete HS:TERM_ITEM of a term(item_id=None) or an item(term_id=None)
+        :return: [{'device_id', 'term_id', 'item_id'}] of deleted term items, device_id is None if unknown
+        """
+        if item_id is None:
+            item_list = await self.redis_client.smembers('SET:TERM_ITEM:{}'.format(term_id))
+            term_items = [(term_id, item) for item in item_list]
+        else:
+            term_list = await self.redis_client.smembers('SET:ITEM_TERM:{}'.format(item_id))
+            term_items = [(term, item_id) for term in term_list]
+        pipe = self.redis_client.pipeline()
+        for term, item in term_items:
+            pipe.hget('HS:TERM_ITEM:{}:{}'.format(term, item), 'device_id')
+            pipe.hget('HS:TERM:{}'.format(term), 'device_id')
+        rst = await pipe.execute()
+        deleted = [{'device_id': rst[2 * idx] or rst[2 * idx + 1], 'term_id': term, 'item_id': item}
+                   for idx, (term, item) in enumerate(term_items)]
+        await self.key_index.delete_term_items(self.redis_client, term_items)
+        return deleted
+
+    async def publish_term_items_del(self, term_items):
+        """
+        publish CHANNEL:TERM_ITEM_DEL for term items returned by delete_term_items, so devices drop their mappings
+        """
+        pipe = self.redis_client.pipeline()
+        for term_item in term_items:
+            if term_item['device_id'] is not None:
+                pipe.publish('CHANNEL:TERM_ITEM_DEL', json.dumps(term_item))
+        await pipe.execute()
+
+    async def _dispatch_data(self):
+        """
+        the only reader of CHANNEL:DEVICE_DATA:* in api server: drop aggregate cache and fan out to live feeds
+        """
+        while True:
+            msg = await self.data_sub.get()
+            if msg is None:
+                break
+            real_channel, msg = msg
+            data_key = real_channel[20:]
+            self.aggregate_cache.invalidate(data_key)
+            for feed in self.live_feeds:
+                if feed.match(data_key):
+                    feed.put(data_key, msg)
+
+    async def _wait_writable(self, request):
+        """
+        wait until client consumed data buffered in transport, messages coalesce in LiveFeed meanwhile
+        """
+        transport = request.transport
+        while transport.get_write_buffer_size() > LIVE_BUFFER_SIZE:
+            if transport.is_closing():
+                raise ConnectionResetError('client disconnected')
+            await asyncio.sleep(0.1, loop=self.io_loop)
+
+    @staticmethod
+    def _check_batch(obj_list: list, fields: tuple):
+        """
+        validate the whole list before anything is written by v2 batch api
+        :param fields: required fields of every element
+        :return: error text of the first invalid element, None if all valid
+        """
+        for idx, obj_dict in enumerate(obj_list):
+            if not isinstance(obj_dict, dict):
+                return 'element {} is not an object!'.format(idx)
+            missing = [field for field in fields if obj_dict.get(field) in (None, '')]
+            if missing:
+                return 'element {} missing {}!'.format(idx, ', '.join(missing))
+        return None
+
+    async def _write_batch(self, obj_list: list, queue_writes, channel: str = None):
+        """
+        write WRITE_BATCH elements in one MULTI/EXEC, with one message to channel for the whole batch
+        :param queue_writes: queue_writes(pipe, obj_dict) queues commands of one element into pipe
+        :param channel: message is the list of elements in batch, None for no message
+        """
+        for idx in range(0, len(obj_list), WRITE_BATCH):
+            batch = obj_list[idx:idx + WRITE_BATCH]
+            pipe = self.redis_client.pipeline(transaction=True)
+            for obj_dict in batch:
+                queue_writes(pipe, obj_dict)
+            if channel is not None:
+                pipe.publish(channel, json.dumps(batch))
+            await pipe.execute()
 
     @staticmethod
     async def _read_data(request):
@@ -109,19 +232,34 @@ class APIServer(ParamFunctionContainer):
             data = data.decode('utf-8')
         return data
 
+    @staticmethod
+    def _cached_response(request, body: bytes, etag: str, content_type: str):
+        """
+        :return: 304 without body if client already has the version of etag
+        """
+        headers = {'ETag': etag, 'Cache-Control': 'public, max-age={}'.format(DOC_MAX_AGE)}
+        if etag in request.headers.get('If-None-Match', ''):
+            return web.Response(status=304, headers=headers)
+        return web.Response(body=body, headers=headers, content_type=content_type, charset='utf-8')
+
     @param_function(method='GET', url=r'/')
     async def get_index(self, request):
-        doc_list = ['PyDataColl is running, available API:\n']
-        method_dict = defaultdict(list)
-        for route in self.web_app.router.routes():
-            method_dict[route.method].append('method: {:<8} URL: {}://{}{}'.format(
-                    route.method, request.scheme, request.host, route._formatter if hasattr(route, '_formatter') else
-                    route._path))
-        doc_list.append('\n'.join(sorted(method_dict['GET'])))
-        doc_list.append('\n'.join(sorted(method_dict['POST'])))
-        doc_list.append('\n'.join(sorted(method_dict['PUT'])))
-        doc_list.append('\n'.join(sorted(method_dict['DELETE'])))
-        return web.Response(text='\n'.join(doc_list))
+        base_url = '{}://{}'.format(request.scheme, request.host)
+        if base_url not in self.index_cache:
+            if len(self.index_cache) >= 16:  # host header is set by client, don't keep too many
+                self.index_cache.clear()
+            body = index_text(self.routes, base_url).encode('utf-8')
+            self.index_cache[base_url] = (body, make_etag(body))
+        body, etag = self.index_cache[base_url]
+        return self._cached_response(request, body, etag, 'text/plain')
+
+    @param_function(method='GET', url=r'/api/v1/openapi.json')
+    async def get_openapi(self, request):
+        """
+        OpenAPI 3.0 document of all API, operationId is name of handler
+        """
+        body, etag = self.openapi
+        return self._cached_response(request, body, etag, 'application/json')
 
     @param_function(method='GET', url=r'/api/v1/redis_key')
     async def get_redis_key(self, _):
@@ -138,7 +276,7 @@ class APIServer(ParamFunctionContainer):
     @param_function(method='GET', url=r'/api/v1/formulas')
     async def get_formula_list(self, _):
         try:
-            formula_list = self.redis_client.smembers('SET:FORMULA')
+            formula_list = await self.redis_client.smembers('SET:FORMULA')
             return JSON(formula_list)
         except Exception as e:
             logger.error('get_formula_list failed: %s', repr(e), exc_info=True)
@@ -147,7 +285,7 @@ class APIServer(ParamFunctionContainer):
     @param_function(method='GET', url=r'/api/v1/formulas/{formula_id}')
     async def get_formula(self, request):
         try:
-            formula = self.redis_client.hgetall('HS:FORMULA:{}'.format(request.match_info['formula_id']))
+            formula = await self.redis_client.hgetall('HS:FORMULA:{}'.format(request.match_info['formula_id']))
             if not formula:
                 return web.Response(status=404, text='formula_id not found!')
             return JSON(formula)
@@ -158,7 +296,7 @@ class APIServer(ParamFunctionContainer):
     @param_function(method='GET', url=r'/api/v1/devices')
     async def get_device_list(self, _):
         try:
-            device_list = self.redis_client.smembers('SET:DEVICE')
+            device_list = await self.redis_client.smembers('SET:DEVICE')
             return JSON(device_list)
         except Exception as e:
             logger.error('get_device_list failed: %s', repr(e), exc_info=True)
@@ -167,7 +305,7 @@ class APIServer(ParamFunctionContainer):
     @param_function(method='GET', url=r'/api/v1/devices/{device_id}')
     async def get_device(self, request):
         try:
-            device = self.redis_client.hgetall('HS:DEVICE:{}'.format(request.match_info['device_id']))
+            device = await self.redis_client.hgetall('HS:DEVICE:{}'.format(request.match_info['device_id']))
             if not device:
                 return web.Response(status=404, text='device_id not found!')
             return JSON(device)
@@ -178,7 +316,7 @@ class APIServer(ParamFunctionContainer):
     @param_function(method='GET', url=r'/api/v1/terms')
     async def get_term_list(self, _):
         try:
-            term_list = self.redis_client.smembers('SET:TERM')
+            term_list = await self.redis_client.smembers('SET:TERM')
             return JSON(term_list)
         except Exception as e:
             logger.error('get_term_list failed: %s', repr(e), exc_info=True)
@@ -188,7 +326,7 @@ class APIServer(ParamFunctionContainer):
     async def get_term(self, request):
         try:
             term_id = request.match_info['term_id']
-            term = self.redis_client.hgetall('HS:TERM:{}'.format(term_id))
+            term = await self.redis_client.hgetall('HS:TERM:{}'.format(term_id))
             if not term:
                 return web.Response(status=404, text='term_id not found!')
             return JSON(term)
@@ -199,7 +337,7 @@ class APIServer(ParamFunctionContainer):
     @param_function(method='GET', url=r'/api/v1/items')
     async def get_item_list(self, _):
         try:
-            item_list = self.redis_client.smembers('SET:ITEM')
+            item_list = await self.redis_client.smembers('SET:ITEM')
             return JSON(item_list)
         except Exception as e:
             logger.error('get_item_list failed: %s', repr(e), exc_info=True)
@@ -209,7 +347,7 @@ class APIServer(ParamFunctionContainer):
     async def get_item(self, request):
         try:
             item_id = request.match_info['item_id']
-            item = self.redis_client.hgetall('HS:ITEM:{}'.format(item_id))
+            item = await self.redis_client.hgetall('HS:ITEM:{}'.format(item_id))
             if not item:
                 return web.Response(status=404, text='item_id not found!')
             return JSON(item)
@@ -221,10 +359,10 @@ class APIServer(ParamFunctionContainer):
     async def get_device_term_list(self, request):
         try:
             device_id = request.match_info['device_id']
-            found = self.redis_client.exists('SET:DEVICE_TERM:{}'.format(device_id))
+            found = await self.redis_client.exists('SET:DEVICE_TERM:{}'.format(device_id))
             if not found:
                 return web.Response(status=404, text='device_id not found!')
-            term_list = self.redis_client.smembers('SET:DEVICE_TERM:{}'.format(device_id))
+            term_list = await self.redis_client.smembers('SET:DEVICE_TERM:{}'.format(device_id))
             return JSON(term_list)
         except Exception as e:
             logger.error('get_device_term_list failed: %s', repr(e), exc_info=True)
@@ -234,10 +372,10 @@ class APIServer(ParamFunctionContainer):
     async def get_term_item_list(self, request):
         try:
             term_id = request.match_info['term_id']
-            found = self.redis_client.exists('SET:TERM_ITEM:{}'.format(term_id))
+            found = await self.redis_client.exists('SET:TERM_ITEM:{}'.format(term_id))
             if not found:
                 return web.Response(status=404, text='term_id not found!')
-            item_list = self.redis_client.smembers('SET:TERM_ITEM:{}'.format(term_id))
+            item_list = await self.redis_client.smembers('SET:TERM_ITEM:{}'.format(term_id))
             return JSON(item_list)
         except Exception as e:
             logger.error('get_term_item_list failed: %s', repr(e), exc_info=True)
@@ -248,13 +386,13 @@ class APIServer(ParamFunctionContainer):
         try:
             term_id = request.match_info['term_id']
             item_id = request.match_info['item_id']
-            found = self.redis_client.exists('HS:TERM:{}'.format(term_id))
+            found = await self.redis_client.exists('HS:TERM:{}'.format(term_id))
             if not found:
                 return web.Response(status=404, text='term_id not found!')
-            found = self.redis_client.exists('HS:ITEM:{}'.format(item_id))
+            found = await self.redis_client.exists('HS:ITEM:{}'.format(item_id))
             if not found:
                 return web.Response(status=404, text='item_id not found!')
-            term_item = self.redis_client.hgetall('HS:TERM_ITEM:{}:{}'.format(term_id, item_id))
+            term_item = await self.redis_client.hgetall('HS:TERM_ITEM:{}:{}'.format(term_id, item_id))
             if not term_item:
                 return web.Response(status=404, text='term_item not found!')
             return JSON(term_item)
@@ -264,45 +402,173 @@ class APIServer(ParamFunctionContainer):
 
     @param_function(method='GET', url=r'/api/v1/devices/{device_id}/terms/{term_id}/items/{item_id}/datas')
     async def get_data_list(self, request):
+        """
+        query string(all optional):
+            start, end: datetime.isoformat(), only datas in [start, end] returned, ordered by time
+            limit: max datas returned, header X-Next-Cursor is set if more datas left
+            cursor: X-Next-Cursor of last response to get next page
+        datas are paged by time index, whole HS:DATA is scanned by HSCAN without any parameter,
+        response is streamed in chunks of [SERVER] chunk_size datas.
+        paging with start or end needs [REDIS] time_index = zset, list index is in arrival order and every page of
+        a time range loads and sorts the whole list
+        """
         try:
-            device_id = request.match_info['device_id']
-            term_id = request.match_info['term_id']
-            item_id = request.match_info['item_id']
-            data_list = self.redis_client.hgetall('HS:DATA:{}:{}:{}'.format(device_id, term_id, item_id))
-            return JSON(data_list)
+            data_key = '{}:{}:{}'.format(
+                    request.match_info['device_id'], request.match_info['term_id'], request.match_info['item_id'])
+            start = request.GET.get('start') or None
+            end = request.GET.get('end') or None
+            limit = int(request.GET['limit']) if request.GET.get('limit') else None
+            cursor = int(request.GET.get('cursor') or 0)
+            if (limit is not None and limit <= 0) or cursor < 0:
+                raise ValueError('limit must be positive and cursor must not be negative')
+            if start or end or limit is not None or cursor:
+                return await self._stream_data_range(request, data_key, start, end, limit, cursor)
+            return await self._stream_data_scan(request, data_key)
         except Exception as e:
             logger.error('get_data_list failed: %s', repr(e), exc_info=True)
             return web.Response(status=400, text=repr(e))
 
-    @param_function(method='GET', url=r'/api/v1/devices/{device_id}/terms/{term_id}/items/{item_id}/datas/{index}')
+    async def _stream_data_range(self, request, data_key: str, start: str, end: str, limit: int, cursor: int):
+        """
+        page by time index, cursor is offset of times in [start, end], O(log N + limit) with zset time index
+        """
+        time_list = await self.time_index.between(
+                self.redis_client, data_key, start, end, offset=cursor, count=None if limit is None else limit + 1)
+        headers = None
+        if limit is not None and len(time_list) > limit:
+            time_list = time_list[:limit]
+            headers = {'X-Next-Cursor': str(cursor + limit)}
+        resp = JSONStream(headers=headers)
+        await resp.begin(request)
+        for idx in range(0, len(time_list), CHUNK_SIZE):
+            chunk = time_list[idx:idx + CHUNK_SIZE]
+            value_list = await self.redis_client.hmget('HS:DATA:{}'.format(data_key), *chunk)
+            await resp.write_items((time_str, value) for time_str, value in zip(chunk, value_list) if value is not None)
+        await resp.end()
+        return resp
+
+    async def _stream_data_scan(self, request, data_key: str):
+        """
+        send whole HS:DATA(unordered), every chunk is sent once scanned by HSCAN
+        """
+        resp = JSONStream()
+        await resp.begin(request)
+        cursor = 0
+        while True:
+            cursor, items = await self.redis_client.hscan('HS:DATA:{}'.format(data_key), cursor, count=CHUNK_SIZE)
+            await resp.write_items(zip(items[::2], items[1::2]))
+            if not cursor:
+                break
+        await resp.end()
+        return resp
+
+    @param_function(method='GET', url=r'/api/v1/devices/{device_id}/terms/{term_id}/items/{item_id}/datas/aggregate')
+    async def get_data_aggregate(self, request):
+        """
+        query string:
+            interval: bucket size, number + unit[s, m(min), h(hour), d(day), w(week)], eg: 15min, 1h
+            fn: aggregate functions separated by comma, value=[min, max, avg, sum, count], default: avg
+            start, end: datetime.isoformat(), optional
+        response: {'time': [start time of buckets], 'avg': [...], ...}, results are cached until new data arrive
+        """
+        try:
+            data_key = '{}:{}:{}'.format(
+                    request.match_info['device_id'], request.match_info['term_id'], request.match_info['item_id'])
+            interval = request.GET['interval']
+            fn_list = [fn.strip() for fn in request.GET.get('fn', 'avg').split(',') if fn.strip()]
+            start = request.GET.get('start') or None
+            end = request.GET.get('end') or None
+            cache_key = (data_key, interval, start, end, tuple(fn_list))
+            rst = self.aggregate_cache.get(cache_key)
+            if rst is None:
+                version = self.aggregate_cache.version(data_key)
+                if start or end:
+                    time_list = await self.time_index.between(self.redis_client, data_key, start, end)
+                    value_list = await self.redis_client.hmget('HS:DATA:{}'.format(data_key), *time_list) \
+                        if time_list else list()
+                    data_dict = {time_str: value for time_str, value in zip(time_list, value_list) if value is not None}
+                else:
+                    data_dict = await self.redis_client.hgetall('HS:DATA:{}'.format(data_key))
+                rst = aggregate(data_dict, interval, fn_list)
+                self.aggregate_cache.put(cache_key, rst, version)
+            return JSON(rst)
+        except Exception as e:
+            logger.error('get_data_aggregate failed: %s', repr(e), exc_info=True)
+            return web.Response(status=400, text=repr(e))
+
+    @param_function(method='GET',
+                    url=r'/api/v1/devices/{device_id}/terms/{term_id}/items/{item_id}/datas/{index:-?\d+}')
     async def get_data(self, request):
         try:
             device_id = request.match_info['device_id']
             term_id = request.match_info['term_id']
             item_id = request.match_info['item_id']
             index = int(request.match_info['index'])
-            idx_key = self.redis_client.lindex('LST:DATA_TIME:{}:{}:{}'.format(device_id, term_id, item_id), index)
-            data_val = self.redis_client.hget('HS:DATA:{}:{}:{}'.format(device_id, term_id, item_id), idx_key)
+            time_list = await self.time_index.range(
+                    self.redis_client, '{}:{}:{}'.format(device_id, term_id, item_id), index, index)
+            idx_key = time_list[0] if time_list else None
+            data_val = await self.redis_client.hget('HS:DATA:{}:{}:{}'.format(device_id, term_id, item_id), idx_key)
             return JSON({idx_key: data_val})
         except Exception as e:
             logger.error('get_data failed: %s', repr(e), exc_info=True)
             return web.Response(status=400, text=repr(e))
 
+    @param_function(method='POST', url=r'/api/v2/datas/query')
+    async def query_data_batch(self, request):
+        """
+        request: {'keys': ['1:10:20', {'device_id': 1, 'term_id': 10, 'item_id': 30}, ...],
+                  'start': datetime.isoformat()(optional), 'end': datetime.isoformat()(optional),
+                  'latest': latest N datas of each key(optional, default 1 without start and end)}
+        response: {'1:10:20': {'time': [...], 'value': [...]}, ...}, times ordered by time
+        all keys are resolved in two round trips: one for times, one for values
+        """
+        try:
+            query_data = await self._read_data(request)
+            query_dict = json.loads(query_data)
+            data_keys = list()
+            for key in query_dict['keys']:
+                if isinstance(key, dict):
+                    key = '{}:{}:{}'.format(key['device_id'], key['term_id'], key['item_id'])
+                data_keys.append(str(key))
+            start = query_dict.get('start') or None
+            end = query_dict.get('end') or None
+            latest = query_dict.get('latest')
+            if latest is None and start is None and end is None:
+                latest = 1
+            if latest is not None and int(latest) <= 0:
+                raise ValueError('latest must be positive')
+            time_lists = await self.time_index.query(
+                    self.redis_client, data_keys, start, end, None if latest is None else int(latest))
+            pipe = self.redis_client.pipeline()
+            for data_key, time_list in zip(data_keys, time_lists):
+                if time_list:
+                    pipe.hmget('HS:DATA:{}'.format(data_key), *time_list)
+            value_lists = iter(await pipe.execute())
+            rst = dict()
+            for data_key, time_list in zip(data_keys, time_lists):
+                value_list = next(value_lists) if time_list else list()
+                pairs = [(time_str, value) for time_str, value in zip(time_list, value_list) if value is not None]
+                rst[data_key] = {'time': [time_str for time_str, _ in pairs], 'value': [value for _, value in pairs]}
+            return JSON(rst)
+        except Exception as e:
+            logger.error('query_data_batch failed: %s', repr(e), exc_info=True)
+            return web.Response(status=400, text=repr(e))
+
     @param_function(method='POST', url=r'/api/v1/formulas')
     async def create_formula(self, request):
         try:
             formula_data = await self._read_data(request)
             formula_dict = json.loads(formula_data)
             logger.debug('new formula arg=%s', formula_dict)
-            found = self.redis_client.exists('HS:FORMULA:{}'.format(formula_dict['id']))
+            found = await self.redis_client.exists('HS:FORMULA:{}'.format(formula_dict['id']))
             if found:
                 return web.Response(status=409, text='formula already exists!')
-            self.redis_client.hmset('HS:FORMULA:{}'.format(formula_dict['id']), formula_dict)
-            self.redis_client.sadd('SET:FORMULA', formula_dict['id'])
+            await self.redis_client.hmset_dict('HS:FORMULA:{}'.format(formula_dict['id']), formula_dict)
+            await self.redis_client.sadd('SET:FORMULA', formula_dict['id'])
             for param, param_value in formula_dict.items():
                 if param.startswith('p'):
-                    self.redis_client.sadd('SET:FORMULA_PARAM:{}'.format(param_value), formula_dict['id'])
-            self.redis_client.publish('CHANNEL:FORMULA_ADD', json.dumps(formula_dict))
+                    await self.redis_client.sadd('SET:FORMULA_PARAM:{}'.format(param_value), formula_dict['id'])
+            await self.redis_client.publish('CHANNEL:FORMULA_ADD', json.dumps(formula_dict))
             return web.Response()
         except Exception as e:
             logger.error('create_formula failed: %s', repr(e), exc_info=True)
@@ -317,12 +583,12 @@ class APIServer(ParamFunctionContainer):
                 formula_list = [formula_list]
             for formula_dict in formula_list:
                 logger.debug('new formula arg=%s', formula_dict)
-                self.redis_client.hmset('HS:FORMULA:{}'.format(formula_dict['id']), formula_dict)
-                self.redis_client.sadd('SET:FORMULA', formula_dict['id'])
+                await self.redis_client.hmset_dict('HS:FORMULA:{}'.format(formula_dict['id']), formula_dict)
+                await self.redis_client.sadd('SET:FORMULA', formula_dict['id'])
                 for param, param_value in formula_dict.items():
                     if param.startswith('p'):
-                        self.redis_client.sadd('SET:FORMULA_PARAM:{}'.format(param_value), formula_dict['id'])
-                self.redis_client.publish('CHANNEL:FORMULA_ADD', json.dumps(formula_dict))
+                        await self.redis_client.sadd('SET:FORMULA_PARAM:{}'.format(param_value), formula_dict['id'])
+                await self.redis_client.publish('CHANNEL:FORMULA_ADD', json.dumps(formula_dict))
             return web.Response()
         except Exception as e:
             logger.error('create_formula_batch failed: %s', repr(e), exc_info=True)
@@ -332,7 +598,7 @@ class APIServer(ParamFunctionContainer):
     async def update_formula(self, request):
         try:
             formula_id = request.match_info['formula_id']
-            old_formula = self.redis_client.hgetall('HS:FORMULA:{}'.format(formula_id))
+            old_formula = await self.redis_client.hgetall('HS:FORMULA:{}'.format(formula_id))
             if not old_formula:
                 return web.Response(status=404, text='formula_id not found!')
             await self.del_formula(request)
@@ -346,15 +612,15 @@ class APIServer(ParamFunctionContainer):
     async def del_formula(self, request):
         try:
             formula_id = request.match_info['formula_id']
-            formula_dict = self.redis_client.hgetall('HS:FORMULA:{}'.format(formula_id))
+            formula_dict = await self.redis_client.hgetall('HS:FORMULA:{}'.format(formula_id))
             if not formula_dict:
                 return web.Response(status=404, text='formula_id not found!')
-            self.redis_client.publish('CHANNEL:FORMULA_DEL', json.dumps(formula_id))
+            await self.redis_client.publish('CHANNEL:FORMULA_DEL', json.dumps(formula_id))
             for param, param_value in formula_dict.items():
                 if param.startswith('p'):
-                    self.redis_client.srem('SET:FORMULA_PARAM:{}'.format(param_value), formula_id)
-            self.redis_client.delete('HS:FORMULA:{}'.format(formula_id))
-            self.redis_client.srem('SET:FORMULA', formula_id)
+                    await self.redis_client.srem('SET:FORMULA_PARAM:{}'.format(param_value), formula_id)
+            await self.redis_client.delete('HS:FORMULA:{}'.format(formula_id))
+            await self.redis_client.srem('SET:FORMULA', formula_id)
             return web.Response()
         except Exception as e:
             logger.error('del_formula failed: %s', repr(e), exc_info=True)
@@ -368,15 +634,15 @@ class APIServer(ParamFunctionContainer):
             if type(formula_list) != list:
                 formula_list = [formula_list]
             for formula_id in formula_list:
-                formula_dict = self.redis_client.hgetall('HS:FORMULA:{}'.format(formula_id))
+                formula_dict = await self.redis_client.hgetall('HS:FORMULA:{}'.format(formula_id))
                 if not formula_dict:
                     return web.Response(status=404, text='formula_id not found!')
-                self.redis_client.publish('CHANNEL:FORMULA_DEL', json.dumps(formula_id))
+                await self.redis_client.publish('CHANNEL:FORMULA_DEL', json.dumps(formula_id))
                 for param, param_value in formula_dict.items():
                     if param.startswith('p'):
-                        self.redis_client.srem('SET:FORMULA_PARAM:{}'.format(param_value), formula_id)
-                self.redis_client.delete('HS:FORMULA:{}'.format(formula_id))
-                self.redis_client.srem('SET:FORMULA', formula_id)
+                        await self.redis_client.srem('SET:FORMULA_PARAM:{}'.format(param_value), formula_id)
+                await self.redis_client.delete('HS:FORMULA:{}'.format(formula_id))
+                await self.redis_client.srem('SET:FORMULA', formula_id)
             return web.Response()
         except Exception as e:
             logger.error('del_formula_batch failed: %s', repr(e), exc_info=True)
@@ -388,12 +654,12 @@ class APIServer(ParamFunctionContainer):
             device_data = await self._read_data(request)
             device_dict = json.loads(device_data)
             logger.debug('new device arg=%s', device_dict)
-            found = self.redis_client.exists('HS:DEVICE:{}'.format(device_dict['id']))
+            found = await self.redis_client.exists('HS:DEVICE:{}'.format(device_dict['id']))
             if found:
                 return web.Response(status=409, text='device already exists!')
-            self.redis_client.hmset('HS:DEVICE:{}'.format(device_dict['id']), device_dict)
-            self.redis_client.sadd('SET:DEVICE', device_dict['id'])
-            self.redis_client.publish('CHANNEL:DEVICE_ADD', json.dumps(device_dict))
+            await self.redis_client.hmset_dict('HS:DEVICE:{}'.format(device_dict['id']), device_dict)
+            await self.redis_client.sadd('SET:DEVICE', device_dict['id'])
+            await self.redis_client.publish('CHANNEL:DEVICE_ADD', json.dumps(device_dict))
             return web.Response()
         except Exception as e:
             logger.error('create_device failed: %s', repr(e), exc_info=True)
@@ -406,11 +672,14 @@ class APIServer(ParamFunctionContainer):
             device_list = json.loads(device_data)
             if type(device_list) != list:
                 device_list = [device_list]
-            for device_dict in device_list:
-                logger.debug('new device arg=%s', device_dict)
-                self.redis_client.hmset('HS:DEVICE:{}'.format(device_dict['id']), device_dict)
-                self.redis_client.sadd('SET:DEVICE', device_dict['id'])
-                self.redis_client.publish('CHANNEL:DEVICE_ADD', json.dumps(device_dict))
+            error = self._check_batch(device_list, ('id', 'protocol'))
+            if error is not None:
+                return web.Response(status=400, text=error)
+
+            def queue_writes(pipe, device_dict):
+                pipe.hmset_dict('HS:DEVICE:{}'.format(device_dict['id']), device_dict)
+                pipe.sadd('SET:DEVICE', device_dict['id'])
+            await self._write_batch(device_list, queue_writes, 'CHANNEL:DEVICE_ADD_BATCH')
             return web.Response()
         except Exception as e:
             logger.error('create_device failed: %s', repr(e), exc_info=True)
@@ -420,7 +689,7 @@ class APIServer(ParamFunctionContainer):
     async def update_device(self, request):
         try:
             device_id = request.match_info['device_id']
-            old_device = self.redis_client.hgetall('HS:DEVICE:{}'.format(device_id))
+            old_device = await self.redis_client.hgetall('HS:DEVICE:{}'.format(device_id))
             if not old_device:
                 return web.Response(status=404, text='device_id not found!')
             device_data = await self._read_data(request)
@@ -429,8 +698,8 @@ class APIServer(ParamFunctionContainer):
                 await self.del_device(request)
                 await self.create_device(request)
             else:
-                self.redis_client.hmset('HS:DEVICE:{}'.format(device_id), device_dict)
-                self.redis_client.publish('CHANNEL:DEVICE_FRESH', device_data)
+                await self.redis_client.hmset_dict('HS:DEVICE:{}'.format(device_id), device_dict)
+                await self.redis_client.publish('CHANNEL:DEVICE_FRESH', device_data)
             return web.Response()
         except Exception as e:
             logger.error('update_device failed: %s', repr(e), exc_info=True)
@@ -440,26 +709,22 @@ class APIServer(ParamFunctionContainer):
     async def del_device(self, request):
         try:
             device_id = request.match_info['device_id']
-            device_dict = self.redis_client.hgetall('HS:DEVICE:{}'.format(device_id))
+            device_dict = await self.redis_client.hgetall('HS:DEVICE:{}'.format(device_id))
             if not device_dict:
                 return web.Response(status=404, text='device_id not found!')
-            self.redis_client.publish('CHANNEL:DEVICE_DEL', json.dumps(device_id))
-            self.redis_client.delete('HS:DEVICE:{}'.format(device_id))
-            self.redis_client.srem('SET:DEVICE', device_id)
+            await self.redis_client.publish('CHANNEL:DEVICE_DEL', json.dumps(device_id))
+            await self.redis_client.delete('HS:DEVICE:{}'.format(device_id))
+            await self.redis_client.srem('SET:DEVICE', device_id)
             # delete all terms connected to that device
-            term_list = self.redis_client.smembers('SET:DEVICE_TERM:{}'.format(device_id))
+            term_list = await self.redis_client.smembers('SET:DEVICE_TERM:{}'.format(device_id))
             for term_id in term_list:
-                self.redis_client.delete('HS:TERM:{}'.format(term_id))
-                self.redis_client.srem('SET:TERM', term_id)
-                self.found_and_delete('HS:TERM_ITEM:{}:*'.format(term_id))
-                self.redis_client.delete('SET:TERM_ITEM:{}'.format(term_id))
-            self.redis_client.delete('SET:DEVICE_TERM:{}'.format(device_id))
-            self.redis_client.delete('LST:FRAME:{}'.format(device_id))
-            # delete values
-            self.found_and_delete('LST:DATA_TIME:{}:*'.format(device_id))
-            self.found_and_delete('HS:DATA:{}:*'.format(device_id))
-            # delete mapping
-            self.found_and_delete('HS:MAPPING:*:{}:*'.format(device_id))
+                await self.redis_client.delete('HS:TERM:{}'.format(term_id))
+                await self.redis_client.srem('SET:TERM', term_id)
+                await self.delete_term_items(term_id=term_id)
+            await self.redis_client.delete('SET:DEVICE_TERM:{}'.format(device_id))
+            await self.redis_client.delete('LST:FRAME:{}'.format(device_id))
+            # delete values and mapping
+            await self.cascade_delete('DEVICE', device_id)
             return web.Response()
         except Exception as e:
             logger.error('del_device failed: %s', repr(e), exc_info=True)
@@ -473,26 +738,22 @@ class APIServer(ParamFunctionContainer):
             if type(device_list) != list:
                 device_list = [device_list]
             for device_id in device_list:
-                device_dict = self.redis_client.hgetall('HS:DEVICE:{}'.format(device_id))
+                device_dict = await self.redis_client.hgetall('HS:DEVICE:{}'.format(device_id))
                 if not device_dict:
                     return web.Response(status=404, text='device_id not found!')
-                self.redis_client.publish('CHANNEL:DEVICE_DEL', json.dumps(device_id))
-                self.redis_client.delete('HS:DEVICE:{}'.format(device_id))
-                self.redis_client.srem('SET:DEVICE', device_id)
+                await self.redis_client.publish('CHANNEL:DEVICE_DEL', json.dumps(device_id))
+                await self.redis_client.delete('HS:DEVICE:{}'.format(device_id))
+                await self.redis_client.srem('SET:DEVICE', device_id)
                 # delete all terms connected to that device
-                term_list = self.redis_client.smembers('SET:DEVICE_TERM:{}'.format(device_id))
+                term_list = await self.redis_client.smembers('SET:DEVICE_TERM:{}'.format(device_id))
                 for term_id in term_list:
-                    self.redis_client.delete('HS:TERM:{}'.format(term_id))
-                    self.redis_client.srem('SET:TERM', term_id)
-                    self.found_and_delete('HS:TERM_ITEM:{}:*'.format(term_id))
-                    self.redis_client.delete('SET:TERM_ITEM:{}'.format(term_id))
-                self.redis_client.delete('SET:DEVICE_TERM:{}'.format(device_id))
-                self.redis_client.delete('LST:FRAME:{}'.format(device_id))
-                # delete values
-                self.found_and_delete('LST:DATA_TIME:{}:*'.format(device_id))
-                self.found_and_delete('HS:DATA:{}:*'.format(device_id))
-                # delete mapping
-                self.found_and_delete('HS:MAPPING:*:{}:*'.format(device_id))
+                    await self.redis_client.delete('HS:TERM:{}'.format(term_id))
+                    await self.redis_client.srem('SET:TERM', term_id)
+                    await self.delete_term_items(term_id=term_id)
+                await self.redis_client.delete('SET:DEVICE_TERM:{}'.format(device_id))
+                await self.redis_client.delete('LST:FRAME:{}'.format(device_id))
+                # delete values and mapping
+                await self.cascade_delete('DEVICE', device_id)
             return web.Response()
         except Exception as e:
             logger.error('del_device_batch failed: %s', repr(e), exc_info=True)
@@ -504,13 +765,13 @@ class APIServer(ParamFunctionContainer):
             term_data = await self._read_data(request)
             term_dict = json.loads(term_data)
             logger.debug('new term arg=%s', term_dict)
-            found = self.redis_client.exists('HS:TERM:{}'.format(term_dict['id']))
+            found = await self.redis_client.exists('HS:TERM:{}'.format(term_dict['id']))
             if found:
                 return web.Response(status=409, text='term already exists!')
-            self.redis_client.hmset('HS:TERM:{}'.format(term_dict['id']), term_dict)
-            self.redis_client.sadd('SET:TERM', term_dict['id'])
-            self.redis_client.sadd('SET:DEVICE_TERM:{}'.format(term_dict['device_id']), term_dict['id'])
-            self.redis_client.publish('CHANNEL:TERM_ADD"', json.dumps(term_dict))
+            await self.redis_client.hmset_dict('HS:TERM:{}'.format(term_dict['id']), term_dict)
+            await self.redis_client.sadd('SET:TERM', term_dict['id'])
+            await self.redis_client.sadd('SET:DEVICE_TERM:{}'.format(term_dict['device_id']), term_dict['id'])
+            await self.redis_client.publish('CHANNEL:TERM_ADD"', json.dumps(term_dict))
             return web.Response()
         except Exception as e:
             logger.error('create_term failed: %s', repr(e), exc_info=True)
@@ -523,12 +784,15 @@ class APIServer(ParamFunctionContainer):
             term_list = json.loads(term_data)
             if type(term_list) != list:
                 term_list = [term_list]
-            for term_dict in term_list:
-                logger.debug('new term arg=%s', term_dict)
-                self.redis_client.hmset('HS:TERM:{}'.format(term_dict['id']), term_dict)
-                self.redis_client.sadd('SET:TERM', term_dict['id'])
-                self.redis_client.sadd('SET:DEVICE_TERM:{}'.format(term_dict['device_id']), term_dict['id'])
-                self.redis_client.publish('CHANNEL:TERM_ADD"', json.dumps(term_dict))
+            error = self._check_batch(term_list, ('id', 'device_id'))
+            if error is not None:
+                return web.Response(status=400, text=error)
+
+            def queue_writes(pipe, term_dict):
+                pipe.hmset_dict('HS:TERM:{}'.format(term_dict['id']), term_dict)
+                pipe.sadd('SET:TERM', term_dict['id'])
+                pipe.sadd('SET:DEVICE_TERM:{}'.format(term_dict['device_id']), term_dict['id'])
+            await self._write_batch(term_list, queue_writes, 'CHANNEL:TERM_ADD_BATCH')
             return web.Response()
         except Exception as e:
             logger.error('create_term_batch failed: %s', repr(e), exc_info=True)
@@ -538,7 +802,7 @@ class APIServer(ParamFunctionContainer):
     async def update_term(self, request):
         try:
             term_id = request.match_info['term_id']
-            old_term = self.redis_client.hgetall('HS:TERM:{}'.format(term_id))
+            old_term = await self.redis_client.hgetall('HS:TERM:{}'.format(term_id))
             if not old_term:
                 return web.Response(status=404, text='term_id not found!')
             term_data = await self._read_data(request)
@@ -547,12 +811,12 @@ class APIServer(ParamFunctionContainer):
                 await self.del_term(request)
                 await self.create_term(request)
             else:
-                self.redis_client.hmset('HS:TERM:{}'.format(term_id), term_dict)
+                await self.redis_client.hmset_dict('HS:TERM:{}'.format(term_id), term_dict)
                 if term_dict['device_id'] != old_term['device_id']:
-                    self.redis_client.publish('CHANNEL:TERM_DEL', json.dumps(old_term))
-                    self.redis_client.publish('CHANNEL:TERM_ADD', term_data)
+                    await self.redis_client.publish('CHANNEL:TERM_DEL', json.dumps(old_term))
+                    await self.redis_client.publish('CHANNEL:TERM_ADD', term_data)
                 else:
-                    self.redis_client.publish('CHANNEL:TERM_FRESH', term_data)
+                    await self.redis_client.publish('CHANNEL:TERM_FRESH', term_data)
             return web.Response()
         except Exception as e:
             logger.error('update_term failed: %s', repr(e), exc_info=True)
@@ -562,27 +826,18 @@ class APIServer(ParamFunctionContainer):
     async def del_term(self, request):
         try:
             term_id = request.match_info['term_id']
-            term_info = self.redis_client.hgetall('HS:TERM:{}'.format(term_id))
+            term_info = await self.redis_client.hgetall('HS:TERM:{}'.format(term_id))
             if not term_info:
                 return web.Response(status=404, text='term_id not found!')
             device_id = term_info['device_id']
-            self.redis_client.publish('CHANNEL:TERM_DEL', json.dumps({'device_id': device_id, 'term_id': term_id}))
-            self.redis_client.delete('HS:TERM:{}'.format(term_id))
-            self.redis_client.srem('SET:TERM', term_id)
-            self.redis_client.srem('SET:DEVICE_TERM:{}'.format(term_info['device_id']), term_id)
-            self.redis_client.delete('SET:TERM_ITEM:{}'.format(term_id))
-            # delete all values
-            self.found_and_delete('LST:DATA_TIME:*:{}:*'.format(term_id))
-            self.found_and_delete('HS:DATA:*:{}:*'.format(term_id))
-            # delete from protocols mapping
-            all_keys = set()
-            keys = self.redis_client.scan_iter('HS:MAPPING:*')
-            for key in keys:
-                map_key = self.redis_client.hgetall(key)
-                if str(map_key['term_id']) == term_id:
-                    all_keys.add(key)
-            if all_keys:
-                self.redis_client.delete(*all_keys)
+            await self.redis_client.publish('CHANNEL:TERM_DEL', json.dumps(
+                    {'device_id': device_id, 'term_id': term_id}))
+            await self.redis_client.delete('HS:TERM:{}'.format(term_id))
+            await self.redis_client.srem('SET:TERM', term_id)
+            await self.redis_client.srem('SET:DEVICE_TERM:{}'.format(term_info['device_id']), term_id)
+            await self.delete_term_items(term_id=term_id)
+            # delete all values and protocols mapping
+            await self.cascade_delete('TERM', term_id)
             return web.Response()
         except Exception as e:
             logger.error('del_term failed: %s', repr(e), exc_info=True)
@@ -596,27 +851,18 @@ class APIServer(ParamFunctionContainer):
             if type(term_list) != list:
                 term_list = [term_list]
             for term_id in term_list:
-                term_info = self.redis_client.hgetall('HS:TERM:{}'.format(term_id))
+                term_info = await self.redis_client.hgetall('HS:TERM:{}'.format(term_id))
                 if not term_info:
                     return web.Response(status=404, text='term_id not found!')
                 device_id = term_info['device_id']
-                self.redis_client.publish('CHANNEL:TERM_DEL', json.dumps({'device_id': device_id, 'term_id': term_id}))
-                self.redis_client.delete('HS:TERM:{}'.format(term_id))
-                self.redis_client.srem('SET:TERM', term_id)
-                self.redis_client.srem('SET:DEVICE_TERM:{}'.format(term_info['device_id']), term_id)
-                self.redis_client.delete('SET:TERM_ITEM:{}'.format(term_id))
-                # delete all values
-                self.found_and_delete('LST:DATA_TIME:*:{}:*'.format(term_id))
-                self.found_and_delete('HS:DATA:*:{}:*'.format(term_id))
-                # delete from protocols mapping
-                all_keys = set()
-                keys = self.redis_client.scan_iter('HS:MAPPING:*')
-                for key in keys:
-                    map_key = self.redis_client.hgetall(key)
-                    if str(map_key['term_id']) == term_id:
-                        all_keys.add(key)
-                if all_keys:
-                    self.redis_client.delete(*all_keys)
+                await self.redis_client.publish('CHANNEL:TERM_DEL', json.dumps(
+                        {'device_id': device_id, 'term_id': term_id}))
+                await self.redis_client.delete('HS:TERM:{}'.format(term_id))
+                await self.redis_client.srem('SET:TERM', term_id)
+                await self.redis_client.srem('SET:DEVICE_TERM:{}'.format(term_info['device_id']), term_id)
+                await self.delete_term_items(term_id=term_id)
+                # delete all values and protocols mapping
+                await self.cascade_delete('TERM', term_id)
             return web.Response()
         except Exception as e:
             logger.error('del_term_batch failed: %s', repr(e), exc_info=True)
@@ -628,11 +874,11 @@ class APIServer(ParamFunctionContainer):
             item_data = await self._read_data(request)
             item_dict = json.loads(item_data)
             logger.debug('new item arg=%s', item_dict)
-            found = self.redis_client.exists('HS:ITEM:{}'.format(item_dict['id']))
+            found = await self.redis_client.exists('HS:ITEM:{}'.format(item_dict['id']))
             if found:
                 return web.Response(status=409, text='item already exists!')
-            self.redis_client.hmset('HS:ITEM:{}'.format(item_dict['id']), item_dict)
-            self.redis_client.sadd('SET:ITEM', item_dict['id'])
+            await self.redis_client.hmset_dict('HS:ITEM:{}'.format(item_dict['id']), item_dict)
+            await self.redis_client.sadd('SET:ITEM', item_dict['id'])
             return web.Response()
         except Exception as e:
             logger.error('create_item failed: %s', repr(e), exc_info=True)
@@ -645,10 +891,14 @@ class APIServer(ParamFunctionContainer):
             item_list = json.loads(item_data)
             if type(item_list) != list:
                 item_list = [item_list]
-            for item_dict in item_list:
-                logger.debug('new item arg=%s', item_dict)
-                self.redis_client.hmset('HS:ITEM:{}'.format(item_dict['id']), item_dict)
-                self.redis_client.sadd('SET:ITEM', item_dict['id'])
+            error = self._check_batch(item_list, ('id',))
+            if error is not None:
+                return web.Response(status=400, text=error)
+
+            def queue_writes(pipe, item_dict):
+                pipe.hmset_dict('HS:ITEM:{}'.format(item_dict['id']), item_dict)
+                pipe.sadd('SET:ITEM', item_dict['id'])
+            await self._write_batch(item_list, queue_writes)
             return web.Response()
         except Exception as e:
             logger.error('create_item_batch failed: %s', repr(e), exc_info=True)
@@ -658,7 +908,7 @@ class APIServer(ParamFunctionContainer):
     async def update_item(self, request):
         try:
             item_id = request.match_info['item_id']
-            old_item = self.redis_client.hgetall('HS:ITEM:{}'.format(item_id))
+            old_item = await self.redis_client.hgetall('HS:ITEM:{}'.format(item_id))
             if not old_item:
                 return web.Response(status=404, text='item_id not found!')
             item_data = await self._read_data(request)
@@ -667,7 +917,7 @@ class APIServer(ParamFunctionContainer):
                 await self.del_item(request)
                 await self.create_item(request)
             else:
-                self.redis_client.hmset('HS:ITEM:{}'.format(item_id), item_dict)
+                await self.redis_client.hmset_dict('HS:ITEM:{}'.format(item_id), item_dict)
             return web.Response()
         except Exception as e:
             logger.error('update_item failed: %s', repr(e), exc_info=True)
@@ -677,27 +927,16 @@ class APIServer(ParamFunctionContainer):
     async def del_item(self, request):
         try:
             item_id = request.match_info['item_id']
-            found = self.redis_client.exists('HS:ITEM:{}'.format(item_id))
+            found = await self.redis_client.exists('HS:ITEM:{}'.format(item_id))
             if not found:
                 return web.Response(status=404, text='item_id not found!')
-            self.redis_client.delete('HS:ITEM:{}'.format(item_id))
-            self.redis_client.srem('SET:ITEM', item_id)
-            # delete from term->item set
-            self.found_and_delete('SET:TERM_ITEM:*')
-            # delete from term->item hash, TODO: publish msg to CHANNEL:TERM_ITEM_DEL
-            self.found_and_delete('HS:TERM_ITEM:*:{}'.format(item_id))
-            # delete from protocols mapping
-            all_keys = set()
-            keys = self.redis_client.scan_iter('HS:MAPPING:*')
-            for key in keys:
-                map_key = self.redis_client.hgetall(key)
-                if map_key and str(map_key['item_id']) == item_id:
-                    all_keys.add(key)
-            if all_keys:
-                self.redis_client.delete(*all_keys)
-            # delete all values
-            self.found_and_delete('LST:DATA_TIME:*:*:{}'.format(item_id))
-            self.found_and_delete('HS:DATA:*:*:{}'.format(item_id))
+            await self.redis_client.delete('HS:ITEM:{}'.format(item_id))
+            await self.redis_client.srem('SET:ITEM', item_id)
+            # delete from term->item hash and set
+            term_items = await self.delete_term_items(item_id=item_id)
+            # delete from protocols mapping and all values, then devices drop cached mappings
+            await self.cascade_delete('ITEM', item_id)
+            await self.publish_term_items_del(term_items)
             return web.Response()
         except Exception as e:
             logger.error('del_item failed: %s', repr(e), exc_info=True)
@@ -711,27 +950,16 @@ class APIServer(ParamFunctionContainer):
             if type(item_list) != list:
                 item_list = [item_list]
             for item_id in item_list:
-                found = self.redis_client.exists('HS:ITEM:{}'.format(item_id))
+                found = await self.redis_client.exists('HS:ITEM:{}'.format(item_id))
                 if not found:
                     return web.Response(status=404, text='item_id not found!')
-                self.redis_client.delete('HS:ITEM:{}'.format(item_id))
-                self.redis_client.srem('SET:ITEM', item_id)
-                # delete from term->item set
-                self.found_and_delete('SET:TERM_ITEM:*')
-                # delete from term->item hash, TODO: publish msg to CHANNEL:TERM_ITEM_DEL
-                self.found_and_delete('HS:TERM_ITEM:*:{}'.format(item_id))
-                # delete from protocols mapping
-                all_keys = set()
-                keys = self.redis_client.scan_iter('HS:MAPPING:*')
-                for key in keys:
-                    map_key = self.redis_client.hgetall(key)
-                    if map_key and str(map_key['item_id']) == item_id:
-                        all_keys.add(key)
-                if all_keys:
-                    self.redis_client.delete(*all_keys)
-                # delete all values
-                self.found_and_delete('LST:DATA_TIME:*:*:{}'.format(item_id))
-                self.found_and_delete('HS:DATA:*:*:{}'.format(item_id))
+                await self.redis_client.delete('HS:ITEM:{}'.format(item_id))
+                await self.redis_client.srem('SET:ITEM', item_id)
+                # delete from term->item hash and set
+                term_items = await self.delete_term_items(item_id=item_id)
+                # delete from protocols mapping and all values, then devices drop cached mappings
+                await self.cascade_delete('ITEM', item_id)
+                await self.publish_term_items_del(term_items)
             return web.Response()
         except Exception as e:
             logger.error('del_item_batch failed: %s', repr(e), exc_info=True)
@@ -747,34 +975,34 @@ class APIServer(ParamFunctionContainer):
             if term_id != str(term_item_dict['term_id']):
                 return web.Response(status=400, text='term_id mismatch in url and body!')
             item_id = term_item_dict['item_id']
-            found = self.redis_client.exists('HS:TERM:{}'.format(term_id))
+            found = await self.redis_client.exists('HS:TERM:{}'.format(term_id))
             if not found:
                 return web.Response(status=404, text='term_id not found!')
-            found = self.redis_client.exists('HS:ITEM:{}'.format(item_id))
+            found = await self.redis_client.exists('HS:ITEM:{}'.format(item_id))
             if not found:
                 return web.Response(status=404, text='item_id not found!')
-            found = self.redis_client.exists('HS:TERM_ITEM:{}:{}'.format(term_id, item_id))
+            found = await self.redis_client.exists('HS:TERM_ITEM:{}:{}'.format(term_id, item_id))
             if found:
                 return web.Response(status=409, text='term_item already exists!')
-            term_info = self.redis_client.hgetall('HS:TERM:{}'.format(term_id))
+            term_info = await self.redis_client.hgetall('HS:TERM:{}'.format(term_id))
             device_id = term_info['device_id']
             term_item_dict.update({'device_id': device_id})
-            device_info = self.redis_client.hgetall('HS:DEVICE:{}'.format(device_id))
-            self.redis_client.hmset('HS:TERM_ITEM:{}:{}'.format(term_id, item_id), term_item_dict)
-            self.redis_client.sadd('SET:TERM_ITEM:{}'.format(term_id), item_id)
+            device_info = await self.redis_client.hgetall('HS:DEVICE:{}'.format(device_id))
             if 'protocol_code' in term_item_dict:
                 # delete old mapping
-                all_keys = set()
-                keys = self.redis_client.scan_iter('HS:MAPPING:{}:*:*'.format(device_info['protocol'].upper()))
-                for key in keys:
-                    map_key = self.redis_client.hgetall(key)
-                    if str(map_key['term_id']) == term_id and str(map_key['item_id']) == item_id:
-                        all_keys.add(key)
-                if all_keys:
-                    self.redis_client.delete(*all_keys)
-                self.redis_client.hmset('HS:MAPPING:{}:{}:{}'.format(device_info['protocol'].upper(), device_id,
-                                                                     term_item_dict['protocol_code']), term_item_dict)
-            self.redis_client.publish('CHANNEL:TERM_ITEM_ADD', json.dumps(term_item_dict))
+                old_keys = await self.redis_client.sinter(
+                        'SET:TERM_MAPPING:{}'.format(term_id), 'SET:ITEM_MAPPING:{}'.format(item_id))
+                await self.key_index.delete_mappings(self.redis_client, old_keys)
+            pipe = self.redis_client.pipeline()
+            pipe.hmset_dict('HS:TERM_ITEM:{}:{}'.format(term_id, item_id), term_item_dict)
+            self.key_index.add_term_item(pipe, term_id, item_id)
+            if 'protocol_code' in term_item_dict:
+                mapping_key = 'HS:MAPPING:{}:{}:{}'.format(
+                        device_info['protocol'].upper(), device_id, term_item_dict['protocol_code'])
+                pipe.hmset_dict(mapping_key, term_item_dict)
+                self.key_index.add_mapping(pipe, mapping_key, term_item_dict)
+            await pipe.execute()
+            await self.redis_client.publish('CHANNEL:TERM_ITEM_ADD', json.dumps(term_item_dict))
             return web.Response()
         except Exception as e:
             logger.error('create_term_item failed: %s', repr(e), exc_info=True)
@@ -787,18 +1015,54 @@ class APIServer(ParamFunctionContainer):
             term_item_list = json.loads(term_item_data)
             if type(term_item_list) != list:
                 term_item_list = [term_item_list]
+            error = self._check_batch(term_item_list, ('term_id', 'item_id'))
+            if error is not None:
+                return web.Response(status=400, text=error)
+            # look up terms, items and old mappings of the whole list before anything is written
+            pipe = self.redis_client.pipeline()
             for term_item_dict in term_item_list:
-                logger.debug('new term_item arg=%s', term_item_dict)
-                device_id = term_item_dict['device_id']
                 term_id = term_item_dict['term_id']
                 item_id = term_item_dict['item_id']
-                self.redis_client.hmset('HS:TERM_ITEM:{}:{}'.format(term_id, item_id), term_item_dict)
-                self.redis_client.sadd('SET:TERM_ITEM:{}'.format(term_id), item_id)
-                if 'protocol' in term_item_dict and 'protocol_code' in term_item_dict:
-                    self.redis_client.hmset('HS:MAPPING:{}:{}:{}'.format(
-                            term_item_dict['protocol'].upper(), device_id, term_item_dict['protocol_code']),
-                            term_item_dict)
-                self.redis_client.publish('CHANNEL:TERM_ITEM_ADD', json.dumps(term_item_dict))
+                pipe.hget('HS:TERM:{}'.format(term_id), 'device_id')
+                pipe.exists('HS:ITEM:{}'.format(item_id))
+                pipe.sinter('SET:TERM_MAPPING:{}'.format(term_id), 'SET:ITEM_MAPPING:{}'.format(item_id))
+            rst = await pipe.execute()
+            old_mappings = dict()  # (term_id, item_id) -> keys of HS:MAPPING replaced by new protocol_code
+            for idx, term_item_dict in enumerate(term_item_list):
+                device_id, item_found, old_keys = rst[idx * 3:idx * 3 + 3]
+                if device_id is None:
+                    return web.Response(status=404, text='element {} term_id not found!'.format(idx))
+                if not item_found:
+                    return web.Response(status=404, text='element {} item_id not found!'.format(idx))
+                term_item_dict['device_id'] = device_id  # device of term, not the one in body
+                if 'protocol_code' in term_item_dict:
+                    old_mappings[(str(term_item_dict['term_id']), str(term_item_dict['item_id']))] = old_keys
+            device_ids = list({term_item_dict['device_id'] for term_item_dict in term_item_list})
+            pipe = self.redis_client.pipeline()
+            for device_id in device_ids:
+                pipe.hget('HS:DEVICE:{}'.format(device_id), 'protocol')
+            protocol_dict = dict(zip(device_ids, await pipe.execute()))
+            for idx, term_item_dict in enumerate(term_item_list):
+                if protocol_dict[term_item_dict['device_id']] is None:
+                    return web.Response(status=404, text='element {} device_id not found!'.format(idx))
+
+            def queue_writes(pipe, term_item_dict):
+                term_id = term_item_dict['term_id']
+                item_id = term_item_dict['item_id']
+                old_keys = old_mappings.get((str(term_id), str(item_id)))
+                if old_keys:
+                    for old_key in old_keys:
+                        self.key_index.remove_mapping(pipe, old_key, term_item_dict)
+                    pipe.delete(*old_keys)
+                pipe.hmset_dict('HS:TERM_ITEM:{}:{}'.format(term_id, item_id), term_item_dict)
+                self.key_index.add_term_item(pipe, term_id, item_id)
+                if 'protocol_code' in term_item_dict:
+                    mapping_key = 'HS:MAPPING:{}:{}:{}'.format(protocol_dict[term_item_dict['device_id']].upper(),
+                                                               term_item_dict['device_id'],
+                                                               term_item_dict['protocol_code'])
+                    pipe.hmset_dict(mapping_key, term_item_dict)
+                    self.key_index.add_mapping(pipe, mapping_key, term_item_dict)
+            await self._write_batch(term_item_list, queue_writes, 'CHANNEL:TERM_ITEM_ADD_BATCH')
             return web.Response()
         except Exception as e:
             logger.error('create_term_item_batch failed: %s', repr(e), exc_info=True)
@@ -811,7 +1075,7 @@ class APIServer(ParamFunctionContainer):
             term_item_dict = json.loads(term_item_data)
             term_id = request.match_info['term_id']
             item_id = request.match_info['item_id']
-            old_term_item = self.redis_client.hgetall('HS:TERM_ITEM:{}:{}'.format(term_id, item_id))
+            old_term_item = await self.redis_client.hgetall('HS:TERM_ITEM:{}:{}'.format(term_id, item_id))
             if not old_term_item:
                 return web.Response(status=404, text='term_item not found!')
             if str(term_item_dict['term_id']) == term_id and str(term_item_dict['item_id']) == item_id:
@@ -827,22 +1091,22 @@ class APIServer(ParamFunctionContainer):
         try:
             term_id = request.match_info['term_id']
             item_id = request.match_info['item_id']
-            term_item_dict = self.redis_client.hgetall('HS:TERM_ITEM:{}:{}'.format(term_id, item_id))
+            term_item_dict = await self.redis_client.hgetall('HS:TERM_ITEM:{}:{}'.format(term_id, item_id))
             if not term_item_dict:
                 return web.Response(status=404, text='term_item not found!')
-            term_info = self.redis_client.hgetall('HS:TERM:{}'.format(term_id))
+            term_info = await self.redis_client.hgetall('HS:TERM:{}'.format(term_id))
             device_id = term_info['device_id']
-            device_info = self.redis_client.hgetall('HS:DEVICE:{}'.format(device_id))
-            self.redis_client.publish('CHANNEL:TERM_ITEM_DEL',
+            device_info = await self.redis_client.hgetall('HS:DEVICE:{}'.format(device_id))
+            await self.redis_client.publish('CHANNEL:TERM_ITEM_DEL',
                                       json.dumps({'device_id': device_id, 'term_id': term_id, 'item_id': item_id}))
-            self.redis_client.delete('HS:TERM_ITEM:{}:{}'.format(term_id, item_id))
-            self.redis_client.srem('SET:TERM_ITEM:{}'.format(term_id), item_id)
+            await self.key_index.delete_term_items(self.redis_client, [(term_id, item_id)])
             if 'protocol_code' in term_item_dict:
-                self.redis_client.delete('HS:MAPPING:{}:{}:{}'.format(
-                        device_info['protocol'].upper(), device_id, term_item_dict['protocol_code']))
+                await self.key_index.delete_mappings(self.redis_client, ['HS:MAPPING:{}:{}:{}'.format(
+                        device_info['protocol'].upper(), device_id, term_item_dict['protocol_code'])])
             # delete all values
-            self.found_and_delete('LST:DATA_TIME:*:{}:{}'.format(term_id, item_id))
-            self.found_and_delete('HS:DATA:*:{}:{}'.format(term_id, item_id))
+            data_keys = await self.redis_client.sinter(
+                    'SET:TERM_DATA:{}'.format(term_id), 'SET:ITEM_DATA:{}'.format(item_id))
+            await self.key_index.delete_data(self.redis_client, data_keys)
             return web.Response()
         except Exception as e:
             logger.error('del_term_item failed: %s', repr(e), exc_info=True)
@@ -859,198 +1123,371 @@ class APIServer(ParamFunctionContainer):
                 device_id = term_item_dict['device_id']
                 term_id = term_item_dict['term_id']
                 item_id = term_item_dict['item_id']
-                term_item_dict = self.redis_client.hgetall('HS:TERM_ITEM:{}:{}'.format(term_id, item_id))
+                term_item_dict = await self.redis_client.hgetall('HS:TERM_ITEM:{}:{}'.format(term_id, item_id))
                 if not term_item_dict:
                     return web.Response(status=404, text='term_item not found!')
-                self.redis_client.publish('CHANNEL:TERM_ITEM_DEL',
+                await self.redis_client.publish('CHANNEL:TERM_ITEM_DEL',
                                           json.dumps({'device_id': device_id, 'term_id': term_id, 'item_id': item_id}))
-                self.redis_client.delete('HS:TERM_ITEM:{}:{}'.format(term_id, item_id))
-                self.redis_client.srem('SET:TERM_ITEM:{}'.format(term_id), item_id)
+                await self.key_index.delete_term_items(self.redis_client, [(term_id, item_id)])
                 if 'protocol_code' in term_item_dict:
-                    self.redis_client.delete('HS:MAPPING:{}:{}:{}'.format(
-                            term_item_dict['protocol'].upper(), device_id, term_item_dict['protocol_code']))
+                    await self.key_index.delete_mappings(self.redis_client, ['HS:MAPPING:{}:{}:{}'.format(
+                            term_item_dict['protocol'].upper(), device_id, term_item_dict['protocol_code'])])
                 # delete all values
-                self.found_and_delete('LST:DATA_TIME:*:{}:{}'.format(term_id, item_id))
-                self.found_and_delete('HS:DATA:*:{}:{}'.format(term_id, item_id))
+                data_keys = await self.redis_client.sinter(
+                        'SET:TERM_DATA:{}'.format(term_id), 'SET:ITEM_DATA:{}'.format(item_id))
+                await self.key_index.delete_data(self.redis_client, data_keys)
             return web.Response()
         except Exception as e:
             logger.error('del_term_item_batch failed: %s', repr(e), exc_info=True)
             return web.Response(status=400, text=repr(e))
 
+    @param_function(method='GET', url=r'/api/v2/export')
+    async def export_model(self, request):
+        """
+        stream the whole configuration(device, term, item, term_item, mapping, formula) as JSON Lines,
+        see ModelWriter for format, gzip compressed unless query string gzip=0
+        """
+        try:
+            compress = request.GET.get('gzip', '1') != '0'
+            file_name = 'pydatacoll.jsonl.gz' if compress else 'pydatacoll.jsonl'
+            resp = web.StreamResponse(headers={'Content-Disposition': 'attachment; filename="{}"'.format(file_name)})
+            resp.content_type = 'application/gzip' if compress else 'application/x-ndjson'
+            resp.enable_chunked_encoding()
+            await resp.prepare(request)
+            writer = ModelWriter(compress)
+            for record_type in EXPORT_ORDER:
+                if record_type == 'mapping':
+                    cursor = 0
+                    while True:
+                        cursor, keys = await self.redis_client.scan(cursor, match='HS:MAPPING:*', count=CHUNK_SIZE)
+                        await self._export_hashes(resp, writer, record_type, keys)
+                        if not cursor:
+                            break
+                    continue
+                if record_type == 'term_item':
+                    term_list = list(await self.redis_client.smembers('SET:TERM'))
+                    pipe = self.redis_client.pipeline()
+                    for term_id in term_list:
+                        pipe.smembers('SET:TERM_ITEM:{}'.format(term_id))
+                    keys = ['HS:TERM_ITEM:{}:{}'.format(term_id, item_id)
+                            for term_id, item_list in zip(term_list, await pipe.execute()) for item_id in item_list]
+                else:
+                    keys = ['HS:{}:{}'.format(record_type.upper(), obj_id)
+                            for obj_id in await self.redis_client.smembers('SET:{}'.format(record_type.upper()))]
+                for idx in range(0, len(keys), CHUNK_SIZE):
+                    await self._export_hashes(resp, writer, record_type, keys[idx:idx + CHUNK_SIZE])
+            resp.write(writer.flush())
+            await resp.write_eof()
+            return resp
+        except Exception as e:
+            logger.error('export_model failed: %s', repr(e), exc_info=True)
+            return web.Response(status=400, text=repr(e))
+
+    async def _export_hashes(self, resp, writer: ModelWriter, record_type: str, keys: list):
+        pipe = self.redis_client.pipeline()
+        for key in keys:
+            pipe.hgetall(key)
+        records = [{'type': record_type, 'key': key, 'data': data} if record_type == 'mapping' else
+                   {'type': record_type, 'data': data} for key, data in zip(keys, await pipe.execute()) if data]
+        if records:
+            resp.write(writer.encode(records))
+            await resp.drain()
+
+    @param_function(method='POST', url=r'/api/v2/import')
+    async def import_model(self, request):
+        """
+        body is output of export_model(gzip compressed or not), parsed while receiving and written in MULTI/EXEC of
+        [SERVER] write_batch records, stop at the first invalid record with the records before it imported
+        :return: {'imported': number of records}
+        """
+        imported = 0
+        try:
+            reader = ModelReader(await self.redis_client.smembers('SET:DEVICE'))
+            record_list = list()
+            while True:
+                data = await request.content.readany()
+                record_list.extend(reader.feed(data) if data else reader.close())
+                while len(record_list) >= WRITE_BATCH or (record_list and not data):
+                    batch, record_list = record_list[:WRITE_BATCH], record_list[WRITE_BATCH:]
+                    await self._import_batch(batch)
+                    imported += len(batch)
+                if not data:
+                    break
+            logger.info('import_model: %s records imported', imported)
+            return JSON({'imported': imported})
+        except ValueError as e:
+            return web.Response(status=400, text='{}, {} records imported'.format(e, imported))
+        except Exception as e:
+            logger.error('import_model failed: %s', repr(e), exc_info=True)
+            return web.Response(status=400, text=repr(e))
+
+    async def _import_batch(self, record_list: list):
+        """
+        one MULTI/EXEC for records and messages of a batch, same messages as v2 batch api
+        """
+        pipe = self.redis_client.pipeline(transaction=True)
+        added = defaultdict(list)
+        for record in record_list:
+            queue_record(pipe, record)
+            added[record['type']].append(record['data'])
+        for record_type, channel in (('device', 'CHANNEL:DEVICE_ADD_BATCH'), ('term', 'CHANNEL:TERM_ADD_BATCH'),
+                                     ('term_item', 'CHANNEL:TERM_ITEM_ADD_BATCH')):
+            if added[record_type]:
+                pipe.publish(channel, json.dumps(added[record_type]))
+        for formula_dict in added['formula']:
+            pipe.publish('CHANNEL:FORMULA_ADD', json.dumps(formula_dict))
+        await pipe.execute()
+
+    async def _check_term_item(self, data_dict: dict):
+        """
+        :param data_dict: dict contains device_id, term_id and item_id
+        :return: error text if any of them not found, otherwise None
+        """
+        pipe = self.redis_client.pipeline()
+        pipe.exists('HS:DEVICE:{}'.format(data_dict['device_id']))
+        pipe.exists('HS:TERM:{}'.format(data_dict['term_id']))
+        pipe.exists('HS:ITEM:{}'.format(data_dict['item_id']))
+        pipe.exists('HS:TERM_ITEM:{}:{}'.format(data_dict['term_id'], data_dict['item_id']))
+        found_list = await pipe.execute()
+        for found, name in zip(found_list, ('device_id', 'term_id', 'item_id', 'term_item')):
+            if not found:
+                return '{} not found!'.format(name)
+
     @param_function(method='POST', url=r'/api/v1/device_call')
     async def device_call(self, request):
-        sub_client = None
-        channel_name = None
         try:
-            sub_client = await aioredis.create_redis((config.get('REDIS', 'host', fallback='localhost'),
-                                                      config.getint('REDIS', 'port', fallback=6379)),
-                                                     db=config.getint('REDIS', 'db', fallback=1))
             call_data = await self._read_data(request)
             call_data_dict = json.loads(call_data)
             logger.debug('new call_data arg=%s', call_data_dict)
-            found = await sub_client.exists('HS:DEVICE:{}'.format(call_data_dict['device_id']))
-            if not found:
-                return web.Response(status=404, text='device_id not found!')
-            found = await sub_client.exists('HS:TERM:{}'.format(call_data_dict['term_id']))
-            if not found:
-                return web.Response(status=404, text='term_id not found!')
-            found = await sub_client.exists('HS:ITEM:{}'.format(call_data_dict['item_id']))
-            if not found:
-                return web.Response(status=404, text='item_id not found!')
-            found = await sub_client.exists('HS:TERM_ITEM:{}:{}'.format(
-                    call_data_dict['term_id'], call_data_dict['item_id']))
-            if not found:
-                return web.Response(status=404, text='term_item not found!')
+            not_found = await self._check_term_item(call_data_dict)
+            if not_found:
+                return web.Response(status=404, text=not_found)
             channel_name = 'CHANNEL:DEVICE_CALL:{}:{}:{}'.format(
                     call_data_dict['device_id'], call_data_dict['term_id'], call_data_dict['item_id'])
-            res = await sub_client.subscribe(channel_name)
-            cb = asyncio.futures.Future(loop=self.io_loop)
-
-            async def reader(ch):
-                while await ch.wait_message():
-                    msg = await ch.get_json()
-                    logger.debug('device_call got msg: %s', msg)
-                    if not cb.done():
-                        cb.set_result(msg)
-
-            tsk = asyncio.ensure_future(reader(res[0]), loop=self.io_loop)
-            self.redis_client.publish('CHANNEL:DEVICE_CALL', call_data)
-            rst = await asyncio.wait_for(cb, HANDLER_TIME_OUT, loop=self.io_loop)
-            await sub_client.unsubscribe(channel_name)
-            sub_client.close()
-            await tsk
+            rst = json.loads(await self.rpc.call_channel(
+                    'CHANNEL:DEVICE_CALL', call_data, channel_name, 'CHANNEL:DEVICE_CALL:*', HANDLER_TIME_OUT))
+            logger.debug('device_call got msg: %s', rst)
             return JSON(rst)
         except Exception as e:
-            logger.exception(e)
             logger.error('device_call failed: %s', repr(e), exc_info=True)
-            if sub_client and sub_client.in_pubsub and channel_name:
-                await sub_client.unsubscribe(channel_name)
-                sub_client.close()
             return web.Response(status=400, text=repr(e))
 
+    @param_function(method='POST', url=r'/api/v2/device_call')
+    async def device_call_batch(self, request):
+        """
+        call many points in one request, body is a list of {'device_id': x, 'term_id': x, 'item_id': x},
+        points are grouped by device and all devices are called at once by CHANNEL:DEVICE_CALL_BATCH,
+        one JSON line is streamed for every distinct point as soon as its result arrives:
+            {"device_id": "1", "term_id": "10", "item_id": "1000", "status": "ok", "time": "...", "value": 102.0}
+        status is 'ok', 'not_found', 'timeout' for points not answered in [SERVER] web_timeout seconds, or 'error'
+        for a malformed reply, a failure after streaming began ends the stream with {"status": "error", "error": ...}
+        """
+        resp = None
+        try:
+            call_list = json.loads(await self._read_data(request))
+            if type(call_list) != list:
+                call_list = [call_list]
+            error = self._check_batch(call_list, ('device_id', 'term_id', 'item_id'))
+            if error is not None:
+                return web.Response(status=400, text=error)
+            point_dict = OrderedDict()  # reply channel -> (device_id, term_id, item_id)
+            for call_dict in call_list:
+                point = tuple(str(call_dict[field]) for field in ('device_id', 'term_id', 'item_id'))
+                point_dict.setdefault('CHANNEL:DEVICE_CALL:{}:{}:{}'.format(*point), point)
+            pipe = self.redis_client.pipeline()
+            for _, term_id, item_id in point_dict.values():
+                pipe.hgetall('HS:TERM_ITEM:{}:{}'.format(term_id, item_id))
+            device_dict = defaultdict(list)  # device_id -> [HS:TERM_ITEM]
+            not_found = list()
+            for (channel, point), term_item in zip(point_dict.items(), await pipe.execute()):
+                if term_item and str(term_item.get('device_id')) == point[0] and 'protocol_code' in term_item:
+                    device_dict[point[0]].append(term_item)
+                else:
+                    not_found.append(point_dict.pop(channel))
+            logger.debug('device_call_batch: %s points of %s devices, %s not found',
+                         len(point_dict), len(device_dict), len(not_found))
+            resp = web.StreamResponse()
+            resp.content_type = 'application/x-ndjson'
+            resp.enable_chunked_encoding()
+            await resp.prepare(request)
+            if not_found:
+                resp.write(''.join(self._call_line(point, 'not_found') for point in not_found).encode('utf-8'))
+            if point_dict:
+                await self._stream_call_results(resp, point_dict, [
+                    json.dumps({'device_id': device_id, 'term_items': term_items})
+                    for device_id, term_items in device_dict.items()])
+            await resp.write_eof()
+            return resp
+        except Exception as e:
+            logger.error('device_call_batch failed: %s', repr(e), exc_info=True)
+            if resp is None or not resp.prepared:
+                return web.Response(status=400, text=repr(e))
+            try:
+                resp.write('{}\n'.format(json.dumps({'status': 'error', 'error': repr(e)})).encode('utf-8'))
+                await resp.write_eof()
+            except Exception as ee:
+                logger.error('device_call_batch end stream failed: %s', repr(ee))
+            return resp
+
+    async def _stream_call_results(self, resp, point_dict: dict, msg_list: list):
+        """
+        :param point_dict: reply channel -> (device_id, term_id, item_id)
+        :param msg_list: messages of CHANNEL:DEVICE_CALL_BATCH, one for each device
+        """
+        future_dict = await self.rpc.call_channels(
+                'CHANNEL:DEVICE_CALL_BATCH', msg_list, point_dict, 'CHANNEL:DEVICE_CALL:*')
+        try:
+            channel_dict = {future: channel for channel, future in future_dict.items()}
+            pending = set(channel_dict)
+            deadline = self.io_loop.time() + HANDLER_TIME_OUT
+            while pending and self.io_loop.time() < deadline:
+                done, pending = await asyncio.wait(pending, timeout=deadline - self.io_loop.time(),
+                                                   return_when=asyncio.FIRST_COMPLETED, loop=self.io_loop)
+                line_list = list()
+                for future in done:
+                    point = point_dict[channel_dict[future]]
+                    try:
+                        rst = json.loads(future.result())
+                        line_list.append(self._call_line(point, 'ok', time=rst.get('time'), value=rst.get('value')))
+                    except Exception as e:
+                        logger.warning('device_call_batch: bad reply of %s: %s', point, repr(e))
+                        line_list.append(self._call_line(point, 'error', error=repr(e)))
+                if line_list:  # an empty chunk ends chunked body
+                    resp.write(''.join(line_list).encode('utf-8'))
+                    await resp.drain()
+            if pending:
+                resp.write(''.join(self._call_line(point_dict[channel_dict[future]], 'timeout')
+                                   for future in pending).encode('utf-8'))
+        finally:
+            self.rpc.release(future_dict)
+
+    @staticmethod
+    def _call_line(point: tuple, status: str, **kwargs):
+        kwargs.update(zip(('device_id', 'term_id', 'item_id'), point), status=status)
+        return '{}\n'.format(json.dumps(kwargs))
+
     @param_function(method='POST', url=r'/api/v1/device_ctrl')
     async def device_ctrl(self, request):
-        sub_client = None
-        channel_name = None
         try:
-            sub_client = await aioredis.create_redis((config.get('REDIS', 'host', fallback='localhost'),
-                                                      config.getint('REDIS', 'port', fallback=6379)),
-                                                     db=config.getint('REDIS', 'db', fallback=1))
             ctrl_data = await self._read_data(request)
             ctrl_data_dict = json.loads(ctrl_data)
             logger.debug('new ctrl_data arg=%s', ctrl_data_dict)
-            found = await sub_client.exists('HS:DEVICE:{}'.format(ctrl_data_dict['device_id']))
-            if not found:
-                return web.Response(status=404, text='device_id not found!')
-            found = await sub_client.exists('HS:TERM:{}'.format(ctrl_data_dict['term_id']))
-            if not found:
-                return web.Response(status=404, text='term_id not found!')
-            found = await sub_client.exists('HS:ITEM:{}'.format(ctrl_data_dict['item_id']))
-            if not found:
-                return web.Response(status=404, text='item_id not found!')
-            found = await sub_client.exists(
-                    'HS:TERM_ITEM:{}:{}'.format(ctrl_data_dict['term_id'], ctrl_data_dict['item_id']))
-            if not found:
-                return web.Response(status=404, text='term_item not found!')
+            not_found = await self._check_term_item(ctrl_data_dict)
+            if not_found:
+                return web.Response(status=404, text=not_found)
             channel_name = 'CHANNEL:DEVICE_CTRL:{}:{}:{}'.format(
                     ctrl_data_dict['device_id'], ctrl_data_dict['term_id'], ctrl_data_dict['item_id'])
-            res = await sub_client.subscribe(channel_name)
-            cb = asyncio.futures.Future(loop=self.io_loop)
-
-            async def reader(ch):
-                while await ch.wait_message():
-                    msg = await ch.get_json()
-                    logger.debug('device_ctrl got msg: %s', msg)
-                    if not cb.done():
-                        cb.set_result(msg)
-
-            tsk = asyncio.ensure_future(reader(res[0]), loop=self.io_loop)
-            self.redis_client.publish('CHANNEL:DEVICE_CTRL', ctrl_data)
-            rst = await asyncio.wait_for(cb, HANDLER_TIME_OUT, loop=self.io_loop)
-            await sub_client.unsubscribe(channel_name)
-            sub_client.close()
-            await tsk
+            rst = json.loads(await self.rpc.call_channel(
+                    'CHANNEL:DEVICE_CTRL', ctrl_data, channel_name, 'CHANNEL:DEVICE_CTRL:*', HANDLER_TIME_OUT))
+            logger.debug('device_ctrl got msg: %s', rst)
             return JSON(rst)
         except Exception as e:
-            logger.exception(e)
             logger.error('device_ctrl failed: %s', repr(e), exc_info=True)
-            if sub_client and sub_client.in_pubsub and channel_name:
-                await sub_client.unsubscribe(channel_name)
-                sub_client.close()
             return web.Response(status=400, text=repr(e))
 
     @param_function(method='POST', url=r'/api/v1/formula_check')
     async def formula_check(self, request):
-        sub_client = None
-        channel_name = None
         try:
-            sub_client = await aioredis.create_redis((config.get('REDIS', 'host', fallback='localhost'),
-                                                      config.getint('REDIS', 'port', fallback=6379)),
-                                                     db=config.getint('REDIS', 'db', fallback=1))
             formula_data = await self._read_data(request)
             formula_dict = json.loads(formula_data)
             logger.debug('formula_check arg=%s', formula_dict)
-            channel_name = 'CHANNEL:FORMULA_CHECK_RESULT:{}'.format(len(repr(formula_dict)))
-            res = await sub_client.subscribe(channel_name)
-            cb = asyncio.futures.Future(loop=self.io_loop)
-
-            async def reader(ch):
-                while await ch.wait_message():
-                    msg = await ch.get(encoding='utf-8')
-                    if not cb.done():
-                        cb.set_result(msg)
-
-            tsk = asyncio.ensure_future(reader(res[0]), loop=self.io_loop)
-            self.redis_client.publish('CHANNEL:FORMULA_CHECK', formula_data)
-            rst = await asyncio.wait_for(cb, HANDLER_TIME_OUT, loop=self.io_loop)
-            await sub_client.unsubscribe(channel_name)
-            sub_client.close()
-            await tsk
-            return web.Response(status=200, text=rst)
+            rst = await self.rpc.call('CHANNEL:FORMULA_CHECK', formula_dict, HANDLER_TIME_OUT)
+            return web.Response(status=200, text=str(rst))
         except Exception as e:
-            logger.exception(e)
             logger.error('formula_check failed: %s', repr(e), exc_info=True)
-            if sub_client and sub_client.in_pubsub and channel_name:
-                await sub_client.unsubscribe(channel_name)
-                sub_client.close()
             return web.Response(status=400, text=repr(e))
 
     @param_function(method='POST', url=r'/api/v1/sql_check')
     async def sql_check(self, request):
-        sub_client = None
-        channel_name = None
         try:
-            sub_client = await aioredis.create_redis((config.get('REDIS', 'host', fallback='localhost'),
-                                                      config.getint('REDIS', 'port', fallback=6379)),
-                                                     db=config.getint('REDIS', 'db', fallback=1))
             term_item_data = await self._read_data(request)
             term_item_dict = json.loads(term_item_data)
             logger.debug('sql_check arg=%s', term_item_dict)
-            channel_name = 'CHANNEL:SQL_CHECK_RESULT:{}'.format(len(repr(term_item_dict)))
-            res = await sub_client.subscribe(channel_name)
-            cb = asyncio.futures.Future(loop=self.io_loop)
-
-            async def reader(ch):
-                while await ch.wait_message():
-                    msg = await ch.get(encoding='utf-8')
-                    if not cb.done():
-                        cb.set_result(msg)
-
-            tsk = asyncio.ensure_future(reader(res[0]), loop=self.io_loop)
-            self.redis_client.publish('CHANNEL:SQL_CHECK', term_item_data)
-            rst = await asyncio.wait_for(cb, HANDLER_TIME_OUT, loop=self.io_loop)
-            await sub_client.unsubscribe(channel_name)
-            sub_client.close()
-            await tsk
-            return web.Response(status=200, text=rst)
+            rst = await self.rpc.call('CHANNEL:SQL_CHECK', term_item_dict, HANDLER_TIME_OUT)
+            return web.Response(status=200, text=str(rst))
         except Exception as e:
-            logger.exception(e)
             logger.error('sql_check failed: %s', repr(e), exc_info=True)
-            if sub_client and sub_client.in_pubsub and channel_name:
-                await sub_client.unsubscribe(channel_name)
-                sub_client.close()
             return web.Response(status=400, text=repr(e))
 
+    @param_function(method='GET', url=r'/api/v1/live/ws')
+    async def live_websocket(self, request):
+        """
+        live data over WebSocket, patterns can be given by query string: ?pattern=1:10:*&pattern=2:*
+        client sends {'subscribe': [glob patterns of {device_id}:{term_id}:{item_id}], 'unsubscribe': [...]},
+        server sends json list of CHANNEL:DEVICE_DATA messages
+        """
+        ws = web.WebSocketResponse()
+        await ws.prepare(request)
+        feed = LiveFeed(request.GET.getall('pattern', []), LIVE_QUEUE_SIZE, self.io_loop)
+        self.live_feeds.add(feed)
+        sender = self.io_loop.create_task(self._live_websocket_sender(request, ws, feed))
+        try:
+            while True:
+                msg = await ws.receive()
+                if msg.tp == MsgType.text:
+                    try:
+                        cmd_dict = json.loads(msg.data)
+                        feed.subscribe(cmd_dict.get('subscribe', []))
+                        feed.unsubscribe(cmd_dict.get('unsubscribe', []))
+                    except (ValueError, AttributeError) as e:
+                        logger.warning('live_websocket got invalid command %s: %s', msg.data, repr(e))
+                elif msg.tp in (MsgType.close, MsgType.closed, MsgType.error):
+                    break
+        finally:
+            feed.close()
+            self.live_feeds.discard(feed)
+            sender.cancel()
+            if not ws.closed:
+                await ws.close()
+        return ws
+
+    async def _live_websocket_sender(self, request, ws, feed: LiveFeed):
+        try:
+            while True:
+                msg_list = await feed.get()
+                if not msg_list or ws.closed:
+                    break
+                ws.send_str('[{}]'.format(','.join(msg_list)))
+                await self._wait_writable(request)
+        except (asyncio.CancelledError, ConnectionError):
+            pass
+        except Exception as e:
+            logger.error('live_websocket_sender failed: %s', repr(e), exc_info=True)
+
+    @param_function(method='GET', url=r'/api/v1/live/sse')
+    async def live_sse(self, request):
+        """
+        live data as Server-Sent Events, patterns are given by query string: ?pattern=1:10:*&pattern=2:*
+        every CHANNEL:DEVICE_DATA message is sent as data of one event
+        """
+        feed = LiveFeed(request.GET.getall('pattern', []), LIVE_QUEUE_SIZE, self.io_loop)
+        if not feed.patterns:
+            return web.Response(status=400, text='pattern is required')
+        resp = web.StreamResponse(headers={'Content-Type': 'text/event-stream', 'Cache-Control': 'no-cache'})
+        await resp.prepare(request)
+        self.live_feeds.add(feed)
+        try:
+            while True:
+                msg_list = await feed.get()
+                if not msg_list:
+                    break
+                resp.write(''.join('data: {}\n\n'.format(msg) for msg in msg_list).encode('utf-8'))
+                await self._wait_writable(request)
+        except ConnectionError:
+            pass
+        finally:
+            feed.close()
+            self.live_feeds.discard(feed)
+        return resp
+
+    @param_function(method='GET', url=r'/api/v1/redis_stats')
+    async def get_redis_stats(self, _):
+        stats = redis_stats(self.io_loop)
+        stats['aggregate_cache'] = self.aggregate_cache.stats
+        stats['live_feeds'] = [feed.stats for feed in self.live_feeds]
+        stats['rpc'] = self.rpc.stats
+        return JSON(stats)
+
 
 def main():
     api_server = None
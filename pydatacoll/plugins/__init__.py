@@ -16,12 +16,11 @@
 
 import asyncio
 from abc import abstractmethod, ABCMeta
-import aioredis
-import redis
 
 import pydatacoll.utils.logger as my_logger
 from pydatacoll.utils.func_container import ParamFunctionContainer
 from pydatacoll.utils.read_config import *
+from pydatacoll.utils.redis_pool import get_redis_pool, get_broker, close_redis_pool
 
 logger = my_logger.get_logger('BaseModule')
 
@@ -30,11 +29,8 @@ class BaseModule(ParamFunctionContainer, metaclass=ABCMeta):
     def __init__(self, io_loop: asyncio.AbstractEventLoop = None):
         super().__init__()
         self.io_loop = io_loop or asyncio.get_event_loop()
-        self.sub_client = self.io_loop.run_until_complete(
-                aioredis.create_redis((config.get('REDIS', 'host', fallback='localhost'),
-                                       config.getint('REDIS', 'port', fallback=6379)),
-                                      db=config.getint('REDIS', 'db', fallback=1)))
-        self.redis_client = redis.StrictRedis(db=config.getint('REDIS', 'db', fallback=1), decode_responses=True)
+        self.broker = get_broker(self.io_loop)
+        self.redis_client = get_redis_pool(self.io_loop)
         self.initialized = False
         self.sub_tasks = list()
         self.sub_channels = list()
@@ -50,9 +46,10 @@ class BaseModule(ParamFunctionContainer, metaclass=ABCMeta):
 
     async def install(self):
         try:
-            self.sub_channels = await self.sub_client.psubscribe(*[a['channel'] for a in self.module_arg_dict.values()])
-            for channel in self.sub_channels:
-                self.sub_tasks.append(asyncio.ensure_future(self._msg_reader(channel), loop=self.io_loop))
+            for args in self.module_arg_dict.values():
+                self.sub_channels.append(await self.broker.subscribe(args['channel'], pattern=True).open())
+            for sub in self.sub_channels:
+                self.sub_tasks.append(asyncio.ensure_future(self._msg_reader(sub), loop=self.io_loop))
             await self.start()
             self.initialized = True
             logger.info('%s plugin installed', type(self).__name__)
@@ -62,21 +59,24 @@ class BaseModule(ParamFunctionContainer, metaclass=ABCMeta):
     async def uninstall(self):
         try:
             await self.stop()
-            await self.sub_client.punsubscribe(*[a['channel'] for a in self.module_arg_dict.values()])
+            for sub in self.sub_channels:
+                await sub.close()
             # await asyncio.wait(self.sub_tasks, loop=self.io_loop)
+            self.sub_channels.clear()
             self.sub_tasks.clear()
-            self.sub_client.close()
             self.initialized = False
             logger.info('%s plugin uninstalled', type(self).__name__)
         except Exception as e:
             logger.error('%s plugin uninstall failed: %s', type(self).__name__, repr(e), exc_info=True)
 
-    async def _msg_reader(self, ch):
-        while await ch.wait_message():
-            real_channel, msg = await ch.get_json()
-            channel = ch.name.decode()
-            # logger.debug("%s channel[%s] Got Message:%s", type(self).__name__, channel, msg)
-            self.io_loop.create_task(self.channel_router[channel](real_channel, msg))
+    async def _msg_reader(self, sub):
+        while True:
+            msg = await sub.get_json()
+            if msg is None:
+                break
+            real_channel, msg = msg
+            # logger.debug("%s channel[%s] Got Message:%s", type(self).__name__, sub.channel, msg)
+            self.io_loop.create_task(self.channel_router[sub.channel](real_channel, msg))
         logger.debug('%s quit msg_reader!', type(self).__name__)
 
     @abstractmethod
@@ -101,10 +101,12 @@ class BaseModule(ParamFunctionContainer, metaclass=ABCMeta):
             logger.error('run failed: %s', repr(e), exc_info=True)
         finally:
             loop.run_until_complete(plugin.uninstall())
+            loop.run_until_complete(close_redis_pool(loop))
         loop.close()
 
 available_plugins = {
     'device_manage': 'DeviceManager',
     'db_save': 'DBSaver',
     'formula_calc': 'FormulaCalc',
+    'data_retention': 'DataRetention',
 }
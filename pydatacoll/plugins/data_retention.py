@@ -0,0 +1,199 @@
+#!/usr/bin/env python
+#
+# Copyright 2016 timercrack
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import asyncio
+import datetime
+import time
+
+from pydatacoll.plugins import BaseModule
+from pydatacoll.utils.func_container import param_function
+import pydatacoll.utils.logger as my_logger
+from pydatacoll.utils.read_config import *
+from pydatacoll.utils.time_index import TimeIndex, ROLLUP_PERIODS
+
+logger = my_logger.get_logger('DataRetention')
+
+
+class DataRetention(BaseModule):
+    keep_count = config.getint('DataRetention', 'keep_count', fallback=0)
+    keep_age = config.getint('DataRetention', 'keep_age', fallback=0)
+    rollup = config.get('DataRetention', 'rollup', fallback='')
+    interval = config.getfloat('DataRetention', 'interval', fallback=60)
+    batch_size = max(config.getint('DataRetention', 'batch_size', fallback=1000), 1)
+    key_batch = max(config.getint('DataRetention', 'key_batch', fallback=100), 1)
+    time_index = TimeIndex()
+    retain_lock = None
+    retain_task = None
+    retain_stats = None
+
+    async def start(self):
+        self.retain_lock = asyncio.Lock(loop=self.io_loop)
+        self.retain_stats = {'runs': 0, 'keys': 0, 'trimmed': 0, 'rollups': 0, 'memory_reclaimed': 0,
+                             'last_run': '', 'last_duration': 0.0}
+        if self.interval > 0:
+            self.retain_task = self.io_loop.create_task(self._retain_loop())
+
+    async def stop(self):
+        if self.retain_task:
+            self.retain_task.cancel()
+            self.retain_task = None
+
+    async def _retain_loop(self):
+        while True:
+            await asyncio.sleep(self.interval, loop=self.io_loop)
+            await self.retain()
+
+    @param_function(channel='CHANNEL:DATA_RETENTION')
+    async def retain_now(self, _, msg_dict: dict = None):
+        match = msg_dict.get('match') if isinstance(msg_dict, dict) else None
+        await self.retain(match)
+
+    def get_policy(self, term_item: list):
+        """
+        :param term_item: [keep_count, keep_age, rollup] of HS:TERM_ITEM:{term_id}:{item_id}, None if not set
+        :return: (keep_count, keep_age, rollup periods), 0 means unlimited, fallback to [DataRetention] if not set
+        """
+        keep_count, keep_age, rollup = term_item
+        try:
+            keep_count = self.keep_count if keep_count is None else int(keep_count)
+        except ValueError:
+            keep_count = self.keep_count
+        try:
+            keep_age = self.keep_age if keep_age is None else int(keep_age)
+        except ValueError:
+            keep_age = self.keep_age
+        rollup = self.rollup if rollup is None else rollup
+        periods = [period.strip() for period in rollup.split(',') if period.strip() in ROLLUP_PERIODS]
+        return keep_count, keep_age, periods
+
+    async def used_memory(self):
+        try:
+            info = await self.redis_client.info('memory')
+            return int(info['memory']['used_memory'])
+        except Exception as e:
+            logger.warning('used_memory failed: %s', repr(e))
+            return None
+
+    async def retain(self, match: str = None):
+        """
+        trim HS:DATA and time index(LST:DATA_TIME or ZS:DATA_TIME) of every data key found by match, oldest points
+        exceeding keep_count or older than keep_age are removed, at most batch_size points of each key in one run.
+        with list time index, points are trimmed in arrival order.
+        expired points are averaged into HS:ROLLUP:{period}:{device_id}:{term_id}:{item_id} before removed.
+        :param match: pattern of time index keys, default is all
+        :return: number of points trimmed
+        """
+        async with self.retain_lock:
+            start_time = time.time()
+            trimmed = rollups = 0
+            try:
+                memory_before = await self.used_memory()
+                keys = await self.redis_client.scan_keys(match or self.time_index.prefix + '*')
+                for idx in range(0, len(keys), self.key_batch):
+                    rst = await self.retain_keys(keys[idx:idx + self.key_batch])
+                    trimmed += rst[0]
+                    rollups += rst[1]
+                memory_after = await self.used_memory()
+                memory_reclaimed = memory_before - memory_after \
+                    if memory_before is not None and memory_after is not None else 0
+                self.retain_stats['runs'] += 1
+                self.retain_stats['keys'] = len(keys)
+                self.retain_stats['trimmed'] += trimmed
+                self.retain_stats['rollups'] += rollups
+                self.retain_stats['memory_reclaimed'] = memory_reclaimed
+                self.retain_stats['last_run'] = datetime.datetime.now().isoformat()
+                self.retain_stats['last_duration'] = round(time.time() - start_time, 6)
+                await self.redis_client.hmset_dict('HS:DATA_RETENTION', self.retain_stats)
+                if trimmed:
+                    logger.info('retain: %s keys checked, %s points trimmed, %s buckets rolled up, '
+                                '%s bytes reclaimed in %ss', len(keys), trimmed, rollups, memory_reclaimed,
+                                self.retain_stats['last_duration'])
+            except Exception as e:
+                logger.error('retain failed: %s', repr(e), exc_info=True)
+            return trimmed
+
+    async def retain_keys(self, keys: list):
+        """
+        three round trips for a batch of keys: read lengths, oldest times and policies; read values and rollups
+        of expired points; write rollups and trim in one MULTI/EXEC, so no point is removed before rolled up
+        :param keys: time index keys
+        :return: (points trimmed, rollup buckets written)
+        """
+        pipe = self.redis_client.pipeline()
+        for key in keys:
+            data_key = key[len(self.time_index.prefix):]
+            _, term_id, item_id = data_key.split(':')
+            self.time_index.count(pipe, data_key)
+            self.time_index.range(pipe, data_key, 0, self.batch_size - 1)
+            pipe.hmget('HS:TERM_ITEM:{}:{}'.format(term_id, item_id), 'keep_count', 'keep_age', 'rollup')
+        rst = await pipe.execute()
+        now = datetime.datetime.now()
+        expired_list = list()  # (data_key, count of expired points, expired times, rollup periods)
+        for idx, key in enumerate(keys):
+            length, time_list, term_item = rst[idx * 3:idx * 3 + 3]
+            keep_count, keep_age, periods = self.get_policy(term_item)
+            expired = max(length - keep_count, 0) if keep_count > 0 else 0
+            if keep_age > 0:
+                cutoff = (now - datetime.timedelta(seconds=keep_age)).isoformat()
+                expired = max(expired, next((pos for pos, time_str in enumerate(time_list) if time_str >= cutoff),
+                                            len(time_list)))
+            expired = min(expired, len(time_list))
+            if expired:
+                expired_list.append((key[len(self.time_index.prefix):], expired, time_list[:expired], periods))
+        if not expired_list:
+            return 0, 0
+        bucket_lists = list()  # rollup buckets of expired times, same order as queued into pipeline
+        pipe = self.redis_client.pipeline()
+        for data_key, _, time_list, periods in expired_list:
+            if periods:
+                pipe.hmget('HS:DATA:{}'.format(data_key), *time_list)
+            for period in periods:
+                buckets = sorted(set(time_str[:ROLLUP_PERIODS[period]] for time_str in time_list))
+                bucket_lists.append(buckets)
+                pipe.hmget('HS:ROLLUP:{}:{}'.format(period, data_key), *buckets)
+                pipe.hmget('HS:ROLLUP_COUNT:{}:{}'.format(period, data_key), *buckets)
+        rst = iter(await pipe.execute())
+        bucket_lists = iter(bucket_lists)
+        pipe = self.redis_client.pipeline(transaction=True)
+        trimmed = rollups = 0
+        for data_key, expired, time_list, periods in expired_list:
+            value_list = next(rst) if periods else list()
+            for period in periods:
+                bucket_dict = dict()  # bucket -> [sum, count], start with average already rolled up
+                for bucket, avg, count in zip(next(bucket_lists), next(rst), next(rst)):
+                    bucket_dict[bucket] = [float(avg) * int(count), int(count)] \
+                        if avg is not None and count is not None else [0.0, 0]
+                updated = set()
+                for time_str, value in zip(time_list, value_list):
+                    try:
+                        value = float(value)
+                    except (TypeError, ValueError):
+                        continue
+                    bucket = time_str[:ROLLUP_PERIODS[period]]
+                    bucket_dict[bucket][0] += value
+                    bucket_dict[bucket][1] += 1
+                    updated.add(bucket)
+                if updated:
+                    pipe.hmset_dict('HS:ROLLUP:{}:{}'.format(period, data_key), {
+                        bucket: bucket_dict[bucket][0] / bucket_dict[bucket][1] for bucket in updated})
+                    pipe.hmset_dict('HS:ROLLUP_COUNT:{}:{}'.format(period, data_key), {
+                        bucket: bucket_dict[bucket][1] for bucket in updated})
+                    rollups += len(updated)
+            self.time_index.trim(pipe, data_key, time_list)
+            pipe.hdel('HS:DATA:{}'.format(data_key), *time_list)
+            trimmed += expired
+        await pipe.execute()
+        return trimmed, rollups
@@ -14,22 +14,32 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 
-from collections import namedtuple
-import math
+import asyncio
+from collections import defaultdict
+import re
+import time
 
 try:
     import ujson as json
 except ImportError:
     import json
-import pymysql
+import aiomysql
 from pydatacoll.plugins import BaseModule
-from pydatacoll.utils.asteval import Interpreter
+from pydatacoll.utils import make_param
 from pydatacoll.utils.func_container import param_function
 import pydatacoll.utils.logger as my_logger
 from pydatacoll.utils.read_config import *
+from pydatacoll.utils.sql_template import SQLTemplate
+from pydatacoll.utils.expression import compile_expression
+from pydatacoll.utils.last_value import LastValueStore
+from pydatacoll.utils.rpc import reply, take_reply
 
 logger = my_logger.get_logger('DBSaver')
 
+# INSERT INTO table(columns) VALUES (values), rows of same head can be merged into one multi-row INSERT
+INSERT_SQL = re.compile(r'^\s*(insert\s+into\s+.+?\s+values)\s*(\((?!.*\bon\s+duplicate\b).*\))\s*;?\s*$',
+                        re.IGNORECASE | re.DOTALL)
+
 PLUGIN_PARAM = dict(
         host=config.get('MYSQL', 'host', fallback='127.0.0.1'),
         port=config.getint('MYSQL', 'port', fallback=3306),
@@ -37,73 +47,248 @@ PLUGIN_PARAM = dict(
         password=config.get('MYSQL', 'password', fallback='pydatacoll'),
         db=config.get('MYSQL', 'db', fallback='pydatacoll'),
 )
+POOL_MINSIZE = config.getint('MYSQL', 'pool_minsize', fallback=1)
+POOL_MAXSIZE = max(config.getint('MYSQL', 'pool_maxsize', fallback=10), POOL_MINSIZE)
+RETRY_COUNT = config.getint('MYSQL', 'retry_count', fallback=3)
+RETRY_INTERVAL = config.getfloat('MYSQL', 'retry_interval', fallback=1)
 
 
 class DBSaver(BaseModule):
     # not_implemented = True
-    interp = Interpreter(use_numpy=False)
-    conn = None
-    cursor = None
+    pool = None
+    pool_lock = None
     save_unchanged = config.getboolean('DBSaver', 'save_unchanged', fallback=False)
+    last_value = None  # LastValueStore
+    batch_size = max(config.getint('DBSaver', 'batch_size', fallback=1000), 1)
+    flush_interval = config.getfloat('DBSaver', 'flush_interval', fallback=0.5)
+    sql_buffer = None  # (statement, parameterized) -> list of arguments(or VALUES when not parameterized)
+    sql_cache = None  # (term_id, item_id, db_save_sql/db_warn_sql) -> SQLTemplate
+    verify_cache = None  # (term_id, item_id) -> (do_verify, compiled function)
+    queue_depth = 0  # rows waiting in sql_buffer
+    flush_count = 0
+    flush_latency = 0.0  # seconds used by last flush
+    flush_latency_max = 0.0
+    flush_task = None
 
     async def start(self):
-        self.conn = self.conn or pymysql.Connect(**PLUGIN_PARAM)
-        self.conn.autocommit(True)
-        self.cursor = self.conn.cursor()
+        self.pool_lock = asyncio.Lock(loop=self.io_loop)
+        self.sql_buffer = defaultdict(list)
+        self.sql_cache = dict()
+        self.verify_cache = dict()
+        self.last_value = LastValueStore(config.getfloat('DBSaver', 'deadband', fallback=1e-04))
+        self.flush_task = self.io_loop.create_task(self._flush_loop())
 
     async def stop(self):
-        self.conn and self.conn.close()
+        if self.flush_task:
+            self.flush_task.cancel()
+            self.flush_task = None
+        await self.flush()
+        if self.pool is not None:
+            self.pool.close()
+            await self.pool.wait_closed()
+            self.pool = None
+
+    @property
+    def stats(self):
+        return {'queue_depth': self.queue_depth, 'flush_count': self.flush_count,
+                'flush_latency': round(self.flush_latency, 6), 'flush_latency_max': round(self.flush_latency_max, 6),
+                'pool_size': self.pool.size if self.pool else 0, 'pool_free': self.pool.freesize if self.pool else 0}
+
+    async def get_pool(self):
+        if self.pool is None:
+            async with self.pool_lock:
+                if self.pool is None:
+                    self.pool = await aiomysql.create_pool(
+                            minsize=POOL_MINSIZE, maxsize=POOL_MAXSIZE, loop=self.io_loop, autocommit=True,
+                            **PLUGIN_PARAM)
+        return self.pool
+
+    async def execute(self, sql, args=None, many=False):
+        """
+        execute sql with a connection borrowed from pool, retry with a new connection if mysql gone away
+        :param sql: sql statement
+        :param args: parameters of sql
+        :param many: use executemany, args is a list of parameters
+        :return: None
+        """
+        retry = 0
+        while True:
+            try:
+                pool = await self.get_pool()
+                conn = await pool.acquire()
+                try:
+                    cursor = await conn.cursor()
+                    if many:
+                        await cursor.executemany(sql, args)
+                    else:
+                        await cursor.execute(sql, args)
+                    await cursor.close()
+                    return
+                finally:
+                    pool.release(conn)
+            except (aiomysql.OperationalError, aiomysql.InterfaceError, OSError) as ee:
+                if retry >= RETRY_COUNT:
+                    raise
+                retry += 1
+                logger.warning('execute failed: %s, reconnect and retry(%s)..', repr(ee), retry)
+                await asyncio.sleep(RETRY_INTERVAL, loop=self.io_loop)
+
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(self.flush_interval, loop=self.io_loop)
+            await self.flush()
+
+    def get_template(self, data_dict: dict, sql_field: str):
+        """
+        :param data_dict: data message updated by TERM_ITEM
+        :param sql_field: db_save_sql or db_warn_sql
+        :return: SQLTemplate compiled from TERM_ITEM, compiled again when the sql is changed
+        """
+        key = (str(data_dict['term_id']), str(data_dict['item_id']), sql_field)
+        template = self.sql_cache.get(key)
+        if template is None or template.template != data_dict[sql_field]:
+            template = self.sql_cache[key] = SQLTemplate(data_dict[sql_field])
+            logger.debug('get_template: compiled %s, statement=%s', key, template.statement)
+        return template
+
+    async def save_sql(self, template: SQLTemplate, data_dict: dict):
+        """
+        put a row into the write-behind buffer, non-INSERT statements are executed at once
+        :param template: compiled db_save_sql or db_warn_sql
+        :param data_dict: data message updated by TERM_ITEM
+        :return: None
+        """
+        if template.statement is None:
+            sql = template.render(data_dict)
+            logger.debug('save_sql: sql=%s', sql)
+            match = INSERT_SQL.match(sql)
+            if match is None:
+                await self.execute(sql)
+                return
+            self.sql_buffer[(match.group(1), False)].append(match.group(2))
+        elif INSERT_SQL.match(template.statement) is None:
+            await self.execute(template.statement, template.extract(data_dict))
+            return
+        else:
+            self.sql_buffer[(template.statement, True)].append(template.extract(data_dict))
+        self.queue_depth += 1
+        if self.queue_depth >= self.batch_size:
+            await self.flush()
+
+    async def flush(self):
+        """
+        send buffered rows to mysql, parameterized rows with executemany and
+        rendered rows with one multi-row INSERT per head, batch_size rows at most each time
+        """
+        if not self.queue_depth:
+            return
+        sql_buffer, self.sql_buffer = self.sql_buffer, defaultdict(list)
+        row_count, self.queue_depth = self.queue_depth, 0
+        start = time.monotonic()
+        for (statement, parameterized), row_list in sql_buffer.items():
+            for idx in range(0, len(row_list), self.batch_size):
+                chunk = row_list[idx:idx + self.batch_size]
+                try:
+                    if parameterized:
+                        await self.execute(statement, chunk, many=True)
+                    else:
+                        await self.execute('{} {}'.format(statement, ','.join(chunk)))
+                except Exception as ee:
+                    logger.error('flush failed: %s, retry row by row', repr(ee))
+                    for row in chunk:
+                        try:
+                            if parameterized:
+                                await self.execute(statement, row)
+                            else:
+                                await self.execute('{} {}'.format(statement, row))
+                        except Exception as ee:
+                            logger.error('flush drop row: %s %s, error: %s', statement, row, repr(ee))
+        self.flush_latency = time.monotonic() - start
+        self.flush_latency_max = max(self.flush_latency_max, self.flush_latency)
+        self.flush_count += 1
+        logger.debug('flush: %s rows saved in %.3fs', row_count, self.flush_latency)
+
+    def get_verify(self, data_dict: dict):
+        """
+        :param data_dict: data message updated by TERM_ITEM
+        :return: function compiled from do_verify of TERM_ITEM, compiled again when do_verify is changed
+        """
+        key = (str(data_dict['term_id']), str(data_dict['item_id']))
+        do_verify, verify = self.verify_cache.get(key, (None, None))
+        if verify is None or do_verify != data_dict['do_verify']:
+            verify = compile_expression(data_dict['do_verify'])
+            self.verify_cache[key] = (data_dict['do_verify'], verify)
+        return verify
+
+    @param_function(channel='CHANNEL:TERM_ITEM_ADD')
+    async def add_term_item(self, _, term_item_dict):
+        self.del_cache(term_item_dict)
+
+    @param_function(channel='CHANNEL:TERM_ITEM_ADD_BATCH')
+    async def add_term_item_batch(self, _, term_item_list):
+        for term_item_dict in term_item_list:
+            self.del_cache(term_item_dict)
+
+    @param_function(channel='CHANNEL:TERM_ITEM_DEL')
+    async def del_term_item(self, _, term_item_dict):
+        self.del_cache(term_item_dict)
+
+    def del_cache(self, term_item_dict):
+        term_id, item_id = str(term_item_dict['term_id']), str(term_item_dict['item_id'])
+        for sql_field in ('db_save_sql', 'db_warn_sql'):
+            self.sql_cache.pop((term_id, item_id, sql_field), None)
+        self.verify_cache.pop((term_id, item_id), None)
 
     @param_function(channel='CHANNEL:SQL_CHECK')
     async def check_sql(self, channel, data_dict):
         check_rst = 'OK'
+        reply_to, rpc_id = take_reply(data_dict)
         try:
             logger.debug('check_sql: got msg, channel=%s, dat_dict=%s', channel, data_dict)
-            term_item = self.redis_client.hgetall('HS:TERM_ITEM:{}:{}'.format(
+            term_item = await self.redis_client.hgetall('HS:TERM_ITEM:{}:{}'.format(
                     data_dict['term_id'], data_dict['item_id']))
             data_dict.update(term_item)
-            param = namedtuple('Param', data_dict.keys())(**data_dict)
             if 'db_save_sql' not in data_dict and 'db_warn_sql' not in data_dict:
                 check_rst = 'not found sql to check'
-            if 'db_save_sql' in data_dict:
-                self.cursor.execute(param.db_save_sql.format(PARAM=param))
-            if 'db_warn_sql' in data_dict:
-                self.cursor.execute(param.db_warn_sql.format(PARAM=param))
+            for sql_field in ('db_save_sql', 'db_warn_sql'):
+                if sql_field in data_dict:
+                    template = SQLTemplate(data_dict[sql_field])
+                    if template.statement is None:
+                        await self.execute(template.render(data_dict))
+                    else:
+                        await self.execute(template.statement, template.extract(data_dict))
         except Exception as ee:
-            check_rst = ee.args[0]
+            check_rst = str(ee)
         finally:
-            pub_ch = "CHANNEL:SQL_CHECK_RESULT:{}".format(len(repr(data_dict)))
-            logger.debug('check_sql: publish check result to %s', pub_ch)
-            self.redis_client.publish(pub_ch, check_rst)
+            if reply_to is not None:
+                await reply(self.redis_client, reply_to, rpc_id, check_rst)
+            else:
+                pub_ch = "CHANNEL:SQL_CHECK_RESULT:{}".format(len(repr(data_dict)))
+                logger.debug('check_sql: publish check result to %s', pub_ch)
+                await self.redis_client.publish(pub_ch, check_rst)
 
     @param_function(channel='CHANNEL:DEVICE_DATA:*')
     async def save_mysql(self, channel, data_dict):
         try:
             logger.debug('save_mysql: got msg, channel=%s, dat_dict=%s', channel, data_dict)
-            term_item = self.redis_client.hgetall('HS:TERM_ITEM:{}:{}'.format(
+            term_item = await self.redis_client.hgetall('HS:TERM_ITEM:{}:{}'.format(
                     data_dict['term_id'], data_dict['item_id']))
+            changed, _ = self.last_value.changed(data_dict, self.last_value.get_deadband(term_item))
             data_dict.update(term_item)
-            param = namedtuple('Param', data_dict.keys())(**data_dict)
             if term_item and 'db_save_sql' in term_item:
-                last_value = None
-                last_key = self.redis_client.lindex('LST:DATA_TIME:{}:{}:{}'.format(
-                        param.device_id, param.term_id, param.item_id), -2)
-                if last_key:
-                    last_value = self.redis_client.hget('HS:DATA:{}:{}:{}'.format(
-                            param.device_id, param.term_id, param.item_id), last_key)
-                if not last_value or self.save_unchanged or \
-                        not math.isclose(param.value, float(last_value), rel_tol=1e-04):
-                    sql = term_item['db_save_sql'].format(PARAM=param)
-                    logger.debug('save_mysql: save data, sql=%s', sql)
-                    self.cursor.execute(sql)
+                if changed or self.save_unchanged:
+                    logger.debug('save_mysql: save data, data_dict=%s', data_dict)
+                    await self.save_sql(self.get_template(data_dict, 'db_save_sql'), data_dict)
             if term_item and 'do_verify' in term_item and 'db_warn_sql' in term_item:
-                self.interp.symtable['param'] = param
-                self.interp.symtable['value'] = str(param.value)
-                check_rst = self.interp(param.do_verify)
+                param = make_param(data_dict)
+                try:
+                    check_rst = self.get_verify(data_dict)(param=param, value=str(param.value))
+                except Exception as ee:
+                    logger.info('save_mysql: do_verify=%s failed: %s', data_dict['do_verify'], repr(ee))
+                    check_rst = None
                 if not check_rst:
-                    sql = term_item['db_warn_sql'].format(PARAM=param)
-                    logger.debug('save_mysql: save alert, sql=%s', sql)
-                    self.cursor.execute(sql)
+                    logger.debug('save_mysql: save alert, data_dict=%s', data_dict)
+                    await self.save_sql(self.get_template(data_dict, 'db_warn_sql'), data_dict)
         except Exception as ee:
             logger.error('save_mysql failed: %s', repr(ee), exc_info=True)
 
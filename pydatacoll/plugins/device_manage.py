@@ -29,9 +29,11 @@ class DeviceManager(BaseModule):
 
     async def start(self):
         try:
-            device_dict = self.redis_client.smembers('SET:DEVICE')
-            for device_id in device_dict:
-                device_dict = self.redis_client.hgetall('HS:DEVICE:{}'.format(device_id))
+            device_list = await self.redis_client.smembers('SET:DEVICE')
+            pipe = self.redis_client.pipeline()
+            for device_id in device_list:
+                pipe.hgetall('HS:DEVICE:{}'.format(device_id))
+            for device_dict in await pipe.execute():
                 if device_dict:
                     await self.add_device(None, device_dict)
         except Exception as ee:
@@ -68,6 +70,11 @@ class DeviceManager(BaseModule):
     async def add_device(self, _, device_dict):
         await self.fresh_device(_, device_dict)
 
+    @param_function(channel='CHANNEL:DEVICE_ADD_BATCH')
+    async def add_device_batch(self, _, device_list):
+        for device_dict in device_list:
+            await self.fresh_device(_, device_dict)
+
     @param_function(channel='CHANNEL:DEVICE_DEL')
     async def del_device(self, _, device_id=None):
         try:
@@ -85,25 +92,35 @@ class DeviceManager(BaseModule):
 
     @param_function(channel='CHANNEL:TERM_ADD')
     async def add_term(self, _, term_dict):
-        device = self.device_dict.get(term_dict['device_id'])
+        device = self.device_dict.get(str(term_dict['device_id']))
         if device is not None:
             device.fresh_task(term_dict=term_dict, term_item_dict=None, delete=False)
 
+    @param_function(channel='CHANNEL:TERM_ADD_BATCH')
+    async def add_term_batch(self, _, term_list):
+        for term_dict in term_list:
+            await self.add_term(_, term_dict)
+
     @param_function(channel='CHANNEL:TERM_DEL')
     async def del_term(self, _, term_dict):
-        device = self.device_dict.get(term_dict['device_id'])
+        device = self.device_dict.get(str(term_dict['device_id']))
         if device is not None:
             device.fresh_task(term_dict=term_dict, term_item_dict=None, delete=True)
 
     @param_function(channel='CHANNEL:TERM_ITEM_ADD')
     async def add_term_item(self, _, term_item_dict):
-        device = self.device_dict.get(term_item_dict['device_id'])
+        device = self.device_dict.get(str(term_item_dict['device_id']))
         if device is not None:
             device.fresh_task(term_dict=None, term_item_dict=term_item_dict, delete=False)
 
+    @param_function(channel='CHANNEL:TERM_ITEM_ADD_BATCH')
+    async def add_term_item_batch(self, _, term_item_list):
+        for term_item_dict in term_item_list:
+            await self.add_term_item(_, term_item_dict)
+
     @param_function(channel='CHANNEL:TERM_ITEM_DEL')
     async def del_term_item(self, _, term_item_dict):
-        device = self.device_dict.get(term_item_dict['device_id'])
+        device = self.device_dict.get(str(term_item_dict['device_id']))
         if device is not None:
             device.fresh_task(term_dict=None, term_item_dict=term_item_dict, delete=True)
 
@@ -115,6 +132,15 @@ class DeviceManager(BaseModule):
         except Exception as ee:
             logger.error('device_call failed: %s', repr(ee), exc_info=True)
 
+    @param_function(channel='CHANNEL:DEVICE_CALL_BATCH')
+    async def device_call_batch(self, _, call_dict):
+        try:
+            device = self.device_dict.get(str(call_dict['device_id']))
+            if device is not None:
+                await device.call_batch(call_dict)
+        except Exception as ee:
+            logger.error('device_call_batch failed: %s', repr(ee), exc_info=True)
+
     @param_function(channel='CHANNEL:DEVICE_CTRL')
     async def device_ctrl(self, _, ctrl_dict):
         try:
@@ -17,7 +17,6 @@
 from io import StringIO
 from numbers import Number
 import functools
-from collections import namedtuple
 import math
 import datetime
 try:
@@ -28,9 +27,14 @@ from pydatacoll.utils.asteval import Interpreter
 import numpy as np
 import pandas as pd
 from pydatacoll.plugins import BaseModule
+from pydatacoll.utils import make_param
 from pydatacoll.utils.func_container import param_function
 import pydatacoll.utils.logger as my_logger
 from pydatacoll.utils.read_config import *
+from pydatacoll.utils.key_index import KeyIndex
+from pydatacoll.utils.last_value import LastValueStore
+from pydatacoll.utils.rpc import reply, take_reply
+from pydatacoll.utils.time_index import TimeIndex
 
 logger = my_logger.get_logger('FormulaCalc')
 
@@ -41,14 +45,19 @@ class FormulaCalc(BaseModule):
     pandas_dict = dict()  # HS:DATA:{formula_id}:{term_id}:{item_id} -> pandas.Series
     interp = Interpreter(use_numpy=False)
     calc_unchanged = config.getboolean('FormulaCalc', 'calc_unchanged', fallback=False)
+    time_index = TimeIndex()
+    last_value = LastValueStore(config.getfloat('FormulaCalc', 'deadband', fallback=1e-04))
+    indexed_set = set()  # {device_id}:{term_id}:{item_id} of formula results already in SET:*_DATA
 
     async def start(self):
         try:
             self.interp.symtable['np'] = np
             self.interp.symtable['pd'] = pd
-            formula_list = self.redis_client.smembers('SET:FORMULA')
+            formula_list = await self.redis_client.smembers('SET:FORMULA')
+            pipe = self.redis_client.pipeline()
             for formula_id in formula_list:
-                formula = self.redis_client.hgetall('HS:FORMULA:{}'.format(formula_id))
+                pipe.hgetall('HS:FORMULA:{}'.format(formula_id))
+            for formula in await pipe.execute():
                 if formula:
                     await self.add_formula(None, formula)
         except Exception as ee:
@@ -69,15 +78,14 @@ class FormulaCalc(BaseModule):
                 await self.del_formula(_, formula_id)
             for param, param_value in formula_dict.items():
                 if param.startswith('p') and param_value not in self.pandas_dict:
-                    data_dict = self.redis_client.hgetall('HS:DATA:{}'.format(param_value))
+                    data_dict = await self.redis_client.hgetall('HS:DATA:{}'.format(param_value))
                     self.pandas_dict[param_value] = pd.Series(data_dict, dtype=float)
                     self.pandas_dict[param_value].index = self.pandas_dict[param_value].index.to_datetime()
             formula_dict['result'] = "{}:{}:{}".format(
                     formula_dict['device_id'], formula_dict['term_id'], formula_dict['item_id'])
             self.formula_dict[formula_id] = formula_dict
             logger.debug("fresh_formula add new formula: %s", self.formula_dict)
-            data_key = self.redis_client.lindex("LST:DATA_TIME:{}".format(formula_dict['result']), -1)
-            if not data_key:
+            if not await self.time_index.count(self.redis_client, formula_dict['result']):
                 logger.debug('fresh_formula formula value not exist, calculate now')
                 await self.calculate(formula_id)
         except Exception as ee:
@@ -87,29 +95,28 @@ class FormulaCalc(BaseModule):
     async def del_formula(self, _, formula_id=None):
         if formula_id is None:
             self.formula_dict.clear()
+            self.indexed_set.clear()
         else:
-            self.formula_dict.pop(str(formula_id))
+            formula = self.formula_dict.pop(str(formula_id))
+            self.indexed_set.discard(formula['result'])
 
     @param_function(channel='CHANNEL:DEVICE_DATA:*')
-    async def param_update(self, channel: bytes, data_dict: dict):
+    async def param_update(self, channel: str, data_dict: dict):
         try:
             logger.debug('param_update: got msg, channel=%s, dat_dict=%s', channel, data_dict)
-            param = namedtuple('Param', data_dict.keys())(**data_dict)
-            partial_key = channel[20:].decode('utf8')
+            param = make_param(data_dict)
+            partial_key = channel[20:]
             data_dict_key = 'HS:DATA:{}'.format(partial_key)
             formula_param_key = 'SET:FORMULA_PARAM:{}'.format(partial_key)
-            formula_list = self.redis_client.smembers(formula_param_key)
+            pipe = self.redis_client.pipeline()
+            pipe.smembers(formula_param_key)
+            pipe.hget('HS:TERM_ITEM:{}:{}'.format(param.term_id, param.item_id), 'deadband')
+            formula_list, deadband = await pipe.execute()
+            changed, last_value = self.last_value.changed(data_dict, self.last_value.get_deadband(
+                    {'deadband': deadband}))
             if formula_list:
                 logger.debug("this arg has formula refer to, formula list=%s", formula_list)
-                last_value = None
-                data_time_key = 'LST:DATA_TIME:{}'.format(partial_key)
-                last_key = self.redis_client.lindex(data_time_key, -2)
-                if last_key:
-                    last_value = self.redis_client.hget(data_dict_key, last_key)
-                else:
-                    logger.debug("not found data in %s", data_time_key)
-                if not last_value or self.calc_unchanged or \
-                        not math.isclose(param.value, float(last_value), rel_tol=1e-04):
+                if changed or self.calc_unchanged:
                     self.pandas_dict[partial_key][pd.to_datetime(param.time)] = float(param.value)
                     logger.debug('%s value=%s,last_value=%s changed, calculate formula',
                                  data_dict_key, param.value, last_value)
@@ -148,27 +155,61 @@ class FormulaCalc(BaseModule):
             if math.isnan(value):
                 logger.debug('calculate formula=%s, value=NaN, ignored.', formula['formula'])
                 return
-            last_value = self.redis_client.hget('HS:DATA:{}'.format(formula['result']), time_str)
-            if last_value and math.isclose(value, float(last_value), rel_tol=1e-04):
+            last_value = await self.redis_client.hget('HS:DATA:{}'.format(formula['result']), time_str)
+            if last_value and math.isclose(value, float(last_value), rel_tol=self.last_value.deadband):
                 logger.debug("calculate value=%s,last_value=%s not change, ignored", value, last_value)
                 return
-            self.redis_client.hset("HS:DATA:{}".format(formula['result']), time_str, value)
-            self.redis_client.rpush("LST:DATA_TIME:{}".format(formula['result']), time_str)
-            self.redis_client.publish("CHANNEL:DEVICE_DATA:{}".format(formula['result']), json.dumps({
-                'device_id': formula['device_id'], 'term_id': formula['term_id'],
-                'item_id': formula['item_id'], 'time': time_str, 'value': value}))
+            data_dict = {'device_id': formula['device_id'], 'term_id': formula['term_id'],
+                         'item_id': formula['item_id'], 'time': time_str, 'value': value}
+            pipe = self.redis_client.pipeline(transaction=True)
+            if formula['result'] in self.last_value.value_dict:
+                data_dict['last_value'] = self.last_value.value_dict[formula['result']]
+            if formula['result'] not in self.indexed_set:  # the key index is written only once
+                KeyIndex.add_data(pipe, formula['result'])
+                self.indexed_set.add(formula['result'])
+            pipe.hset("HS:DATA:{}".format(formula['result']), time_str, value)
+            self.time_index.add(pipe, formula['result'], time_str)
+            pipe.hset('HS:LAST_VALUE', formula['result'], value)
+            pipe.publish("CHANNEL:DEVICE_DATA:{}".format(formula['result']), json.dumps(data_dict))
+            await pipe.execute()
         except Exception as ee:
             logger.error('calc failed: %s', repr(ee), exc_info=True)
 
     @param_function(channel='CHANNEL:FORMULA_CHECK')
     async def formula_check(self, _, check_dict: dict):
         try:
-            check_rst = self.do_check(**check_dict)
-            pub_ch = "CHANNEL:FORMULA_CHECK_RESULT:{}".format(len(repr(check_dict)))
-            self.redis_client.publish(pub_ch, check_rst)
+            reply_to, rpc_id = take_reply(check_dict)
+            check_rst = await self.check_param(check_dict)
+            if check_rst == 'OK':
+                check_rst = self.do_check(**check_dict)
+            if reply_to is not None:
+                await reply(self.redis_client, reply_to, rpc_id, check_rst)
+            else:
+                pub_ch = "CHANNEL:FORMULA_CHECK_RESULT:{}".format(len(repr(check_dict)))
+                await self.redis_client.publish(pub_ch, check_rst)
         except Exception as ee:
             logger.error('param_update failed: %s', repr(ee), exc_info=True)
 
+    async def check_param(self, check_dict: dict):
+        """
+        make sure every parameter of formula refers to an existing term_item of the device
+        :param check_dict: message of CHANNEL:FORMULA_CHECK
+        :return: 'OK' or error message
+        """
+        try:
+            param_list = [(param, param_value) for param, param_value in check_dict.items() if param.startswith('p')]
+            pipe = self.redis_client.pipeline()
+            for _, param_value in param_list:
+                _, term_id, item_id = param_value.split(':')
+                pipe.hget('HS:TERM_ITEM:{}:{}'.format(term_id, item_id), 'device_id')
+            for (param, param_value), test_id in zip(param_list, await pipe.execute()):
+                if not test_id or test_id != param_value.split(':')[0]:
+                    return 'parameter not found: %s=%s' % (param, param_value)
+            return 'OK'
+        except Exception as ee:
+            logger.info('check_param failed: %s', repr(ee), exc_info=True)
+            return str(ee)
+
     @functools.lru_cache(typed=True)
     def do_check(self, **check_dict):
         rst = 'OK'
@@ -180,11 +221,6 @@ class FormulaCalc(BaseModule):
             ts = pd.Series(np.random.randn(10), index=pd.date_range(start='1/1/2016', periods=10))
             for param, param_value in check_dict.items():
                 if param.startswith('p'):
-                    device_id, term_id, item_id = param_value.split(':')
-                    test_id = self.redis_client.hget('HS:TERM_ITEM:{}:{}'.format(
-                        term_id, item_id), 'device_id')
-                    if not test_id or test_id != device_id:
-                        raise Exception('parameter not found: %s=%s' % (param, param_value))
                     interp.symtable[param] = ts
             value = interp(check_dict['formula'])
             if len(interp.error) > 0:
@@ -193,7 +229,7 @@ class FormulaCalc(BaseModule):
                 rst = "result type must be Number or Series!"
         except Exception as ee:
             logger.info('do_check failed: %s', repr(ee), exc_info=True)
-            rst = ee.args[0]
+            rst = str(ee)
         finally:
             return rst
 
@@ -16,7 +16,6 @@
 
 import asyncio
 import datetime
-import redis
 
 try:
     import ujson as json
@@ -25,7 +24,10 @@ except ImportError:
 from abc import ABCMeta, abstractmethod
 
 from pydatacoll.utils import logger as my_logger
+from pydatacoll.utils.key_index import KeyIndex
 from pydatacoll.utils.read_config import *
+from pydatacoll.utils.redis_pool import get_redis_pool
+from pydatacoll.utils.time_index import TimeIndex
 
 logger = my_logger.get_logger('BaseDevice')
 
@@ -36,11 +38,18 @@ class BaseDevice(object, metaclass=ABCMeta):
         self.device_info = device_info
         self.device_id = self.device_info['id']
         self.io_loop = io_loop or asyncio.get_event_loop()
-        self.redis_client = redis.StrictRedis(db=config.getint('REDIS', 'db', fallback=1), decode_responses=True)
+        self.redis_client = get_redis_pool(self.io_loop)
+        # max data points sent to redis in one pipeline
+        self.batch_size = max(config.getint('REDIS', 'batch_size', fallback=500), 1)
+        self.mapping_dict = dict()  # protocol_code -> value of HS:MAPPING:{protocol}:{device_id}:{protocol_code}
+        self.mapping_hit = 0
+        self.mapping_miss = 0
+        self.time_index = TimeIndex()
+        self.last_value_dict = dict()  # {device_id}:{term_id}:{item_id} -> last value, same as HS:LAST_VALUE
 
     async def save_frame(self, frame, send=True, save_time=datetime.datetime.now()):
         try:
-            self.redis_client.rpush(
+            await self.redis_client.rpush(
                     "LST:FRAME:{}".format(self.device_id), '{time},{type},{frame}'.format(
                             time=save_time.isoformat(), type="send" if send is True else "recv", frame=frame.hex()))
         except Exception as e:
@@ -53,7 +62,7 @@ class BaseDevice(object, metaclass=ABCMeta):
                 raise Exception('device not connected!')
             term_id = call_dict['term_id']
             item_id = call_dict['item_id']
-            term_item = self.redis_client.hgetall('HS:TERM_ITEM:{term_id}:{item_id}'.format(
+            term_item = await self.redis_client.hgetall('HS:TERM_ITEM:{term_id}:{item_id}'.format(
                     term_id=term_id, item_id=item_id))
             logger.debug('device[%s] call_data, term_item=%s', self.device_id, term_item)
             if not term_item:
@@ -64,6 +73,33 @@ class BaseDevice(object, metaclass=ABCMeta):
         except Exception as e:
             logger.error('device[%s] call_data failed: %s', self.device_id, repr(e))
 
+    # 批量召测
+    async def call_batch(self, call_dict):
+        """
+        :param call_dict: message of CHANNEL:DEVICE_CALL_BATCH, {'device_id': x, 'term_items': [HS:TERM_ITEM]}
+        """
+        try:
+            if not self.connected:
+                raise Exception('device not connected!')
+            frame_list = self.prepare_call_frames(call_dict['term_items'])
+            logger.debug('device[%s] call_batch: %s points, %s frames', self.device_id,
+                         len(call_dict['term_items']), len(frame_list))
+            for frame in frame_list:
+                await self.send_frame(frame)
+        except Exception as e:
+            logger.error('device[%s] call_batch failed: %s', self.device_id, repr(e))
+
+    def prepare_call_frames(self, term_item_list):
+        """
+        override it if the protocol can call many points with fewer frames
+        :param term_item_list: redis data, values of HS:TERM_ITEM:{term_id}:{item_id}
+        :return: frames used in call self.send_frame, one call frame for each protocol_code by default
+        """
+        code_dict = dict()
+        for term_item in term_item_list:
+            code_dict.setdefault(str(term_item['protocol_code']), term_item)
+        return [self.prepare_call_frame(term_item) for term_item in code_dict.values()]
+
     # 控制
     async def ctrl_data(self, ctrl_dict):
         try:
@@ -72,7 +108,7 @@ class BaseDevice(object, metaclass=ABCMeta):
             term_id = ctrl_dict['term_id']
             item_id = ctrl_dict['item_id']
             value = ctrl_dict['value']
-            term_item = self.redis_client.hgetall('HS:TERM_ITEM:{term_id}:{item_id}'.format(
+            term_item = await self.redis_client.hgetall('HS:TERM_ITEM:{term_id}:{item_id}'.format(
                             term_id=term_id, item_id=item_id))
             logger.debug('device[%s] ctrl_data, term_item=%s, value=%s', self.device_id, term_item, value)
             if not term_item:
@@ -84,14 +120,77 @@ class BaseDevice(object, metaclass=ABCMeta):
             logger.error('device[%s] ctrl_data failed: %s', self.device_id, repr(e))
 
     # TODO: fixme
-    def change_device_status(self, on_line):
+    async def change_device_status(self, on_line):
         """
         :param on_line: boolean
         :return: None
         """
-        if self.redis_client.exists('HS:DEVICE:{}'.format(self.device_id)):
-            self.redis_client.hset('HS:DEVICE:{}'.format(self.device_id), 'status', 'on' if on_line else 'off')
         self.connected = on_line
+        try:
+            device_key = 'HS:DEVICE:{}'.format(self.device_id)
+            if await self.redis_client.exists(device_key):
+                await self.redis_client.hset(device_key, 'status', 'on' if on_line else 'off')
+        except Exception as e:
+            logger.error('device[%s] change_device_status failed: %s', self.device_id, repr(e))
+
+    @property
+    def mapping_stats(self):
+        return {'size': len(self.mapping_dict), 'hit': self.mapping_hit, 'miss': self.mapping_miss}
+
+    async def load_mapping(self):
+        try:
+            protocol = self.device_info['protocol'].upper()
+            keys = await self.redis_client.scan_keys('HS:MAPPING:{}:{}:*'.format(protocol, self.device_id))
+            pipe = self.redis_client.pipeline()
+            for key in keys:
+                pipe.hgetall(key)
+            term_item_list = await pipe.execute()
+            self.mapping_dict.clear()
+            for key, term_item in zip(keys, term_item_list):
+                if term_item:
+                    self.mapping_dict[key.rsplit(':', 1)[-1]] = term_item
+            fields = ['{}:{}:{}'.format(self.device_id, term_item['term_id'], term_item['item_id'])
+                      for term_item in self.mapping_dict.values()]
+            if fields:
+                for field, value in zip(fields, await self.redis_client.hmget('HS:LAST_VALUE', *fields)):
+                    if value is not None:
+                        self.last_value_dict[field] = float(value)
+            logger.debug('device[%s] load_mapping: %s mappings, %s last values loaded',
+                         self.device_id, len(self.mapping_dict), len(self.last_value_dict))
+        except Exception as e:
+            logger.error('device[%s] load_mapping failed: %s', self.device_id, repr(e))
+
+    def fresh_mapping(self, term_dict, term_item_dict, delete=False):
+        """
+        keep mapping_dict same as HS:MAPPING, called by fresh_task
+        :param term_dict: message of CHANNEL:TERM_ADD / CHANNEL:TERM_DEL
+        :param term_item_dict: message of CHANNEL:TERM_ITEM_ADD / CHANNEL:TERM_ITEM_DEL
+        :param delete: whether term(term_item) is deleted
+        :return: None
+        """
+        if term_dict is not None:
+            if delete:
+                term_id = str(term_dict.get('term_id', term_dict.get('id')))
+                for code in [code for code, term_item in self.mapping_dict.items()
+                             if str(term_item['term_id']) == term_id]:
+                    del self.mapping_dict[code]
+                prefix = '{}:{}:'.format(self.device_id, term_id)
+                for data_key in [data_key for data_key in self.last_value_dict if data_key.startswith(prefix)]:
+                    del self.last_value_dict[data_key]
+            return
+        if term_item_dict is None:
+            return
+        term_id = str(term_item_dict['term_id'])
+        item_id = str(term_item_dict['item_id'])
+        for code in [code for code, term_item in self.mapping_dict.items()
+                     if str(term_item['term_id']) == term_id and str(term_item['item_id']) == item_id]:
+            del self.mapping_dict[code]
+        if delete:
+            # data of the term_item is deleted too, index it again when it comes back
+            self.last_value_dict.pop('{}:{}:{}'.format(self.device_id, term_id, item_id), None)
+        elif 'protocol_code' in term_item_dict:
+            self.mapping_dict[str(term_item_dict['protocol_code'])] = {
+                key: str(value) for key, value in term_item_dict.items()}
 
     async def process_data(self, data_pairs, method='data'):
         """
@@ -102,32 +201,64 @@ class BaseDevice(object, metaclass=ABCMeta):
         if not data_pairs:
             return
         try:
-            for data_time, protocol_code, data_value in data_pairs:
-                map_key = 'HS:MAPPING:{}:{}:{}'.format(self.device_info['protocol'].upper(),
-                                                       self.device_id, protocol_code)
-                term_item = self.redis_client.hgetall(map_key)
-                if not term_item:
-                    logger.debug("DEVICE[%s] precess_data: can't found term_item, key=%s", self.device_id, map_key)
-                    continue
-                if 'coefficient' in term_item and 'base_val' in term_item:
-                    data_value = data_value * float(term_item['coefficient']) + float(term_item['base_val'])
-                json_data = json.dumps({
-                    'device_id': self.device_id, 'term_id': term_item['term_id'], 'item_id': term_item['item_id'],
-                    'time': data_time.isoformat(), 'value': data_value,
-                })
-                pub_channel = 'CHANNEL:DEVICE_{}:{}:{}:{}'.format(
-                        method.upper(), self.device_id, term_item['term_id'], term_item['item_id'])
-                if method == 'data':
-                    data_key = "{}:{}:{}".format(
-                            self.device_id, term_item['term_id'], term_item['item_id'])
-                    time_str = data_time.isoformat()
-                    self.redis_client.hset("HS:DATA:{}".format(data_key), time_str, data_value)
-                    self.redis_client.rpush("LST:DATA_TIME:{}".format(data_key), time_str)
-                rst = self.redis_client.publish(pub_channel, json_data)
-                logger.debug('pub to %s, val=%s, rst=%s', pub_channel, json_data, rst)
+            data_pairs = list(data_pairs)
+            for idx in range(0, len(data_pairs), self.batch_size):
+                await self.process_batch(data_pairs[idx:idx + self.batch_size], method)
         except Exception as e:
             logger.exception(e)
 
+    async def process_batch(self, data_pairs, method):
+        """
+        send a batch of data to redis in at most two round trips: one for mapping lookups not found in
+        mapping_dict, one MULTI/EXEC for writes and publishes, so HS:LAST_VALUE always matches the published data
+        :param data_pairs: data tuple->(time, protocol_code, value), no more than self.batch_size
+        :param method: same as process_data
+        :return: None
+        """
+        protocol = self.device_info['protocol'].upper()
+        pipe = self.redis_client.pipeline()
+        miss_codes = [str(protocol_code) for _, protocol_code, _ in data_pairs
+                      if str(protocol_code) not in self.mapping_dict]
+        self.mapping_miss += len(miss_codes)
+        self.mapping_hit += len(data_pairs) - len(miss_codes)
+        if miss_codes:
+            for protocol_code in miss_codes:
+                pipe.hgetall('HS:MAPPING:{}:{}:{}'.format(protocol, self.device_id, protocol_code))
+            for protocol_code, term_item in zip(miss_codes, await pipe.execute()):
+                if term_item:
+                    self.mapping_dict[protocol_code] = term_item
+        pipe = self.redis_client.pipeline(transaction=True)
+        term_item_list = [self.mapping_dict.get(str(protocol_code)) for _, protocol_code, _ in data_pairs]
+        for (data_time, protocol_code, data_value), term_item in zip(data_pairs, term_item_list):
+            if not term_item:
+                logger.debug("DEVICE[%s] precess_data: can't found term_item, key=HS:MAPPING:%s:%s:%s",
+                             self.device_id, protocol, self.device_id, protocol_code)
+                continue
+            if 'coefficient' in term_item and 'base_val' in term_item:
+                data_value = data_value * float(term_item['coefficient']) + float(term_item['base_val'])
+            time_str = data_time.isoformat()
+            data_dict = {
+                'device_id': self.device_id, 'term_id': term_item['term_id'], 'item_id': term_item['item_id'],
+                'time': time_str, 'value': data_value,
+            }
+            pub_channel = 'CHANNEL:DEVICE_{}:{}:{}:{}'.format(
+                    method.upper(), self.device_id, term_item['term_id'], term_item['item_id'])
+            if method == 'data':
+                data_key = "{}:{}:{}".format(self.device_id, term_item['term_id'], term_item['item_id'])
+                if data_key in self.last_value_dict:
+                    data_dict['last_value'] = self.last_value_dict[data_key]
+                else:  # first point of data_key, the key index is written only once
+                    KeyIndex.add_data(pipe, data_key)
+                self.last_value_dict[data_key] = data_value
+                pipe.hset("HS:DATA:{}".format(data_key), time_str, data_value)
+                self.time_index.add(pipe, data_key, time_str)
+                pipe.hset('HS:LAST_VALUE', data_key, data_value)
+            json_data = json.dumps(data_dict)
+            pipe.publish(pub_channel, json_data)
+            logger.debug('pub to %s, val=%s', pub_channel, json_data)
+        rst = await pipe.execute()
+        logger.debug('device[%s] process_batch: %s points, %s commands sent', self.device_id, len(data_pairs), len(rst))
+
     @abstractmethod
     async def send_frame(self, frame, check=True):
         """
@@ -0,0 +1,336 @@
+#!/usr/bin/env python
+#
+# Copyright 2016 timercrack
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""
+Table driven IEC 104 codec built on precompiled struct.Struct layouts, an alternative of iec_104 in frame.py for
+the hot path: no Container is built for information objects, each one is decoded into a compact tuple
+(address, value, quality, time):
+    address: information object address, StartAddress + index if the object has no address(sq=1)
+    value: value of the object with quality bits removed, None for C_RD_NA_1 and C_CS_NA_1
+    quality: byte of quality descriptor(SIQ, DIQ, QDS, BCR, SEP) or command qualifier(SCO, DCO, RCO, QOS) with
+             value bits removed, 0 if the type has none; QUALITY_IV is set when the value is invalid
+    time: datetime of cp56time2a/cp24time2a, None if the type has no time tag
+encode does the reverse for frames of iec_104.init_frame, byte-identical to iec_104.build_isu
+"""
+
+import datetime
+import struct
+from collections import namedtuple
+
+from .frame import TYP, Cause, UFrame
+
+Frame = namedtuple('Frame', 'APCI1 APCI2 ASDU')  # same meanings as fields of iec_104, ASDU is None for U and S
+ASDU = namedtuple('ASDU', 'TYP sq sq_count Cause GlobalAddress StartAddress data')  # data: [(address, value, ...)]
+
+QUALITY_IV = 0x80
+HEAD = struct.Struct('<BBHHBBHH')  # 0x68, length, APCI1, APCI2, TYP, VSQ, Cause, GlobalAddress
+APCI = struct.Struct('<BBHH')
+ADDRESS = struct.Struct('<HB')
+RSN = struct.Struct('<H')
+CP24 = 'HB'  # Millisecond, IV|Minute
+CP56 = 'HBBBBB'  # Millisecond, IV|Minute, SU|Hour, Week|Day, Month, Year
+
+# TYP -> (fields of information object after address, time tag, address omitted when sq=1, value mask,
+#         quality mask), value is the first field and quality is the last byte field:
+#   value mask: None if value is the whole field, otherwise value and quality share one byte
+#   quality mask: None if the type has no quality byte
+OBJECT_FORMATS = {
+    TYP.M_SP_NA_1: ('B', None, True, 0x01, 0xf0),
+    TYP.M_SP_TA_1: ('B', CP24, False, 0x01, 0xf0),
+    TYP.M_DP_NA_1: ('B', None, True, 0x03, 0xf0),
+    TYP.M_DP_TA_1: ('B', CP24, False, 0x03, 0xf0),
+    TYP.M_ST_NA_1: ('BB', None, True, 0x7f, 0xff),
+    TYP.M_ST_TA_1: ('BB', CP24, False, 0x7f, 0xff),
+    TYP.M_BO_NA_1: ('IB', None, True, None, 0xff),
+    TYP.M_BO_TA_1: ('IB', CP24, False, None, 0xff),
+    TYP.M_ME_NA_1: ('HB', None, True, None, 0xff),
+    TYP.M_ME_TA_1: ('HB', CP24, False, None, 0xff),
+    TYP.M_ME_NB_1: ('HB', None, True, None, 0xff),
+    TYP.M_ME_TB_1: ('HB', CP24, False, None, 0xff),
+    TYP.M_ME_NC_1: ('fB', None, True, None, 0xff),
+    TYP.M_ME_TC_1: ('fB', CP24, False, None, 0xff),
+    TYP.M_IT_NA_1: ('IB', None, True, None, 0xff),
+    TYP.M_IT_TA_1: ('IB', CP24, False, None, 0xff),
+    TYP.M_PS_NA_1: ('HHB', None, True, None, 0xff),
+    TYP.M_ME_ND_1: ('H', None, True, None, None),
+    TYP.M_SP_TB_1: ('B', CP56, False, 0x01, 0xf0),
+    TYP.M_DP_TB_1: ('B', CP56, False, 0x03, 0xf0),
+    TYP.M_ST_TB_1: ('BB', CP56, False, 0x7f, 0xff),
+    TYP.M_BO_TB_1: ('IB', CP56, False, None, 0xff),
+    TYP.M_ME_TD_1: ('HB', CP56, False, None, 0xff),
+    TYP.M_ME_TE_1: ('HB', CP56, False, None, 0xff),
+    TYP.M_ME_TF_1: ('fB', CP56, False, None, 0xff),
+    TYP.M_IT_TB_1: ('IB', CP56, False, None, 0xff),
+    TYP.M_EP_TD_1: ('BH', CP56, False, 0x03, 0xf8),
+    TYP.C_SC_NA_1: ('B', None, False, 0x01, 0xfc),
+    TYP.C_DC_NA_1: ('B', None, False, 0x03, 0xfc),
+    TYP.C_RC_NA_1: ('B', None, False, 0x03, 0xfc),
+    TYP.C_SE_NA_1: ('HB', None, False, None, 0xff),
+    TYP.C_SE_NB_1: ('HB', None, False, None, 0xff),
+    TYP.C_SE_NC_1: ('fB', None, False, None, 0xff),
+    TYP.C_BO_NA_1: ('I', None, False, None, None),
+    TYP.C_SC_TA_1: ('B', CP56, False, 0x01, 0xfc),
+    TYP.C_DC_TA_1: ('B', CP56, False, 0x03, 0xfc),
+    TYP.C_RC_TA_1: ('B', CP56, False, 0x03, 0xfc),
+    TYP.C_SE_TA_1: ('HB', CP56, False, None, 0xff),
+    TYP.C_SE_TB_1: ('HB', CP56, False, None, 0xff),
+    TYP.C_SE_TC_1: ('fB', CP56, False, None, 0xff),
+    TYP.C_BO_TA_1: ('I', CP56, False, None, None),
+    TYP.C_IC_NA_1: ('B', None, False, None, None),  # QOI
+    TYP.C_CI_NA_1: ('B', None, False, None, None),  # QCC
+    TYP.C_RD_NA_1: ('', None, False, None, None),
+    TYP.C_CS_NA_1: ('', CP56, False, None, None),  # 3 bytes padding are decoded as address
+}
+
+
+def _compile(fields: str, time_tag: str, optional_address: bool, value_mask, quality_mask):
+    """
+    :return: (Struct with address, Struct without address or None, value index, value mask,
+              quality index or None, quality mask, time index or None, time tag)
+    """
+    body = fields + (time_tag or '')
+    with_address = struct.Struct('<HB' + body)
+    without_address = struct.Struct('<' + body) if optional_address else None
+    quality_index = fields.rindex('B') if quality_mask is not None else None
+    time_index = len(fields) if time_tag else None
+    return (with_address, without_address, 0 if fields else None, value_mask,
+            quality_index, quality_mask, time_index, time_tag)
+
+
+LAYOUTS = {typ: _compile(*object_format) for typ, object_format in OBJECT_FORMATS.items()}
+
+
+def decode_cp56time2a(millisecond, minute, hour, day, month, year):
+    return datetime.datetime((year & 0x7f) + 2000, month & 0x0f, day & 0x1f, hour & 0x1f, minute & 0x3f,
+                             millisecond // 1000, millisecond % 1000 * 1000)
+
+
+def decode_cp24time2a(millisecond, minute):
+    now = datetime.datetime.now()
+    return datetime.datetime(now.year, now.month, now.day, now.hour, minute & 0x3f,
+                             millisecond // 1000, millisecond % 1000 * 1000)
+
+
+def decode_objects(typ: TYP, view, sq: int, count: int, start_address: int):
+    """
+    :param view: memoryview of information objects
+    :return: [(address, value, quality, time)]
+    """
+    with_address, without_address, value_index, value_mask, quality_index, quality_mask, time_index, time_tag = \
+        LAYOUTS[typ]
+    layout = without_address if sq and without_address is not None else with_address
+    if len(view) != layout.size * count:
+        raise ValueError('{}: {} bytes for {} objects of {} bytes'.format(typ.name, len(view), count, layout.size))
+    offset = 0 if layout is without_address else 2
+    objects = list()
+    for idx, fields in enumerate(layout.iter_unpack(view)):
+        address = start_address + idx if offset == 0 else fields[0] | fields[1] << 16
+        value = fields[offset + value_index] if value_index is not None else None
+        if value_mask is not None:
+            value &= value_mask
+        quality = fields[offset + quality_index] & quality_mask if quality_index is not None else 0
+        if time_tag is None:
+            data_time = None
+        elif time_tag == CP56:
+            data_time = decode_cp56time2a(*fields[offset + time_index:])
+        else:
+            data_time = decode_cp24time2a(*fields[offset + time_index:])
+        objects.append((address, value, quality, data_time))
+    return objects
+
+
+def decode(data) -> Frame:
+    """
+    decode one APDU(starts with 0x68), same frames and TYP set as iec_104.parse
+    :param data: bytes, bytearray or memoryview
+    :return: Frame, ValueError is raised for invalid frame
+    """
+    view = memoryview(data)
+    if len(view) < APCI.size or view[0] != 0x68 or view[1] != len(view) - 2:
+        raise ValueError('invalid APDU head: {}'.format(bytes(view[:2]).hex()))
+    _, _, apci1, apci2 = APCI.unpack_from(view)
+    if apci1 & 1 == 0:
+        apci1 >>= 1
+    elif apci1 & 3 == 1:
+        return Frame('S', apci2 >> 1, None)
+    else:
+        return Frame(UFrame(apci1), apci2 >> 1, None)
+    if len(view) < HEAD.size:
+        raise ValueError('I frame too short: {} bytes'.format(len(view)))
+    _, _, _, _, typ, vsq, cause, global_address = HEAD.unpack_from(view)
+    typ = TYP(typ)
+    sq, count = vsq >> 7, vsq & 0x7f
+    offset = HEAD.size
+    start_address = 0
+    if sq:
+        low, high = ADDRESS.unpack_from(view, offset)
+        start_address = low | high << 16
+        offset += ADDRESS.size
+    return Frame(apci1, apci2 >> 1, ASDU(typ, sq, count, Cause(cause), global_address, start_address,
+                                         decode_objects(typ, view[offset:], sq, count, start_address)))
+
+
+# bits of one byte field: (name, shift, mask) for Bits, (name, shift, {True: truth, False: falsehood}, default)
+# for Flag, values out of mask are truncated like construct does
+_QUALITY_BITS = (('IV', 7, 1), ('NT', 6, 1), ('SB', 5, 1), ('BL', 4, 1))
+SIQ_BITS = _QUALITY_BITS + (('value', 0, 0x01),)
+DIQ_BITS = _QUALITY_BITS + (('value', 0, 0x03),)
+QDS_BITS = _QUALITY_BITS + (('OV', 0, {True: 0, False: 1}, True),)
+VTI_BITS = (('VT', 7, {True: 1, False: 0}, False), ('value', 0, 0x7f))
+BCR_BITS = (('IV', 7, 1), ('CA', 6, 1), ('CY', 5, 1), ('sq', 0, 0x1f))
+SEP_BITS = _QUALITY_BITS + (('EI', 3, 1), ('value', 0, 0x03))
+SCO_BITS = (('se', 7, 1), ('QU', 2, 0x1f), ('value', 0, 0x01))
+DCO_BITS = (('se', 7, 1), ('QU', 2, 0x1f), ('value', 0, 0x03))  # RCO too
+QOS_BITS = (('se', 7, 1), ('QL', 0, 0x7f))
+
+# TYP -> source of each field in OBJECT_FORMATS: name of the field in Container, bits of a byte field or a
+#        constant(Magic)
+OBJECT_SOURCES = {
+    TYP.M_SP_NA_1: (SIQ_BITS,),
+    TYP.M_SP_TA_1: (SIQ_BITS,),
+    TYP.M_DP_NA_1: (DIQ_BITS,),
+    TYP.M_DP_TA_1: (DIQ_BITS,),
+    TYP.M_ST_NA_1: (VTI_BITS, QDS_BITS),
+    TYP.M_ST_TA_1: (VTI_BITS, QDS_BITS),
+    TYP.M_BO_NA_1: ('value', QDS_BITS),
+    TYP.M_BO_TA_1: ('value', QDS_BITS),
+    TYP.M_ME_NA_1: ('value', QDS_BITS),
+    TYP.M_ME_TA_1: ('value', QDS_BITS),
+    TYP.M_ME_NB_1: ('value', QDS_BITS),
+    TYP.M_ME_TB_1: ('value', QDS_BITS),
+    TYP.M_ME_NC_1: ('value', QDS_BITS),
+    TYP.M_ME_TC_1: ('value', QDS_BITS),
+    TYP.M_IT_NA_1: ('value', BCR_BITS),
+    TYP.M_IT_TA_1: ('value', BCR_BITS),
+    TYP.M_PS_NA_1: ('value', 'CD', QDS_BITS),
+    TYP.M_ME_ND_1: ('value',),
+    TYP.M_SP_TB_1: (SIQ_BITS,),
+    TYP.M_DP_TB_1: (DIQ_BITS,),
+    TYP.M_ST_TB_1: (VTI_BITS, QDS_BITS),
+    TYP.M_BO_TB_1: ('value', QDS_BITS),
+    TYP.M_ME_TD_1: ('value', QDS_BITS),
+    TYP.M_ME_TE_1: ('value', QDS_BITS),
+    TYP.M_ME_TF_1: ('value', QDS_BITS),
+    TYP.M_IT_TB_1: ('value', BCR_BITS),
+    TYP.M_EP_TD_1: (SEP_BITS, 'CP16Time2a'),
+    TYP.C_SC_NA_1: (SCO_BITS,),
+    TYP.C_DC_NA_1: (DCO_BITS,),
+    TYP.C_RC_NA_1: (DCO_BITS,),
+    TYP.C_SE_NA_1: ('value', QOS_BITS),
+    TYP.C_SE_NB_1: ('value', QOS_BITS),
+    TYP.C_SE_NC_1: ('value', QOS_BITS),
+    TYP.C_BO_NA_1: ('value',),
+    TYP.C_SC_TA_1: (SCO_BITS,),
+    TYP.C_DC_TA_1: (DCO_BITS,),
+    TYP.C_RC_TA_1: (DCO_BITS,),
+    TYP.C_SE_TA_1: ('value', QOS_BITS),
+    TYP.C_SE_TB_1: ('value', QOS_BITS),
+    TYP.C_SE_TC_1: ('value', QOS_BITS),
+    TYP.C_BO_TA_1: ('value',),
+    TYP.C_IC_NA_1: (0x14,),
+    TYP.C_CI_NA_1: (0x05,),
+    TYP.C_RD_NA_1: (),
+    TYP.C_CS_NA_1: (),
+}
+
+# U frames never change, APCI2 is always 0
+U_FRAMES = {u_frame: APCI.pack(0x68, 4, u_frame, 0) for u_frame in UFrame}
+S_FRAME = APCI.pack(0x68, 4, 1, 0)
+
+
+def encode_bits(obj, bits):
+    byte = 0
+    for spec in bits:
+        if len(spec) == 3:
+            byte |= (obj[spec[0]] & spec[2]) << spec[1]
+        else:
+            byte |= (spec[2].get(obj[spec[0]], spec[3]) & 1) << spec[1]
+    return byte
+
+
+def encode_cp56time2a(time: datetime.datetime):
+    return (time.second * 1000 + time.microsecond // 1000, time.minute, time.hour,
+            time.isoweekday() << 5 | time.day, time.month, time.year % 2000 & 0x7f)
+
+
+def encode_cp24time2a(time: datetime.datetime):
+    return time.second * 1000 + time.microsecond // 1000, time.minute
+
+
+def _compile_sources(typ: TYP):
+    """
+    :return: [function(obj) -> field value] for fields of OBJECT_FORMATS[typ] before time tag
+    """
+    getters = list()
+    for source in OBJECT_SOURCES[typ]:
+        if isinstance(source, int):
+            getters.append(lambda obj, const=source: const)
+        elif isinstance(source, str):
+            getters.append(lambda obj, name=source: obj[name])
+        else:
+            getters.append(lambda obj, bits=source: encode_bits(obj, bits))
+    return getters
+
+
+SOURCES = {typ: _compile_sources(typ) for typ in OBJECT_SOURCES}
+
+
+def encode_s(rsn: int) -> bytes:
+    frame = bytearray(S_FRAME)
+    RSN.pack_into(frame, 4, rsn << 1)
+    return bytes(frame)
+
+
+def encode(frame) -> bytes:
+    """
+    encode a frame of iec_104.init_frame or iec_104.parse
+    :return: APDU, same bytes as iec_104.build_isu, ValueError is raised if ASDU is too long
+    """
+    apci1, apci2 = frame.APCI1, frame.APCI2 or 0
+    if isinstance(apci1, UFrame):
+        return U_FRAMES[apci1] if apci2 == 0 else APCI.pack(0x68, 4, apci1, apci2 << 1)
+    if apci1 == 'S':
+        return encode_s(apci2)
+    asdu = frame.ASDU
+    typ = asdu.TYP
+    with_address, without_address = LAYOUTS[typ][:2]
+    layout = without_address if asdu.sq and without_address is not None else with_address
+    time_tag = OBJECT_FORMATS[typ][1]
+    time_name, encode_time = ('cp56time2a', encode_cp56time2a) if time_tag == CP56 else \
+        ('cp24time2a', encode_cp24time2a) if time_tag else (None, None)
+    getters = SOURCES[typ]
+    if len(asdu.data) != asdu.sq_count:
+        raise ValueError('{}: {} objects, sq_count={}'.format(typ.name, len(asdu.data), asdu.sq_count))
+    offset = HEAD.size + (ADDRESS.size if asdu.sq else 0)
+    size = offset + layout.size * len(asdu.data)
+    if size > 257:
+        raise ValueError('{}: APDU of {} bytes is too long'.format(typ.name, size))
+    buffer = bytearray(size)
+    HEAD.pack_into(buffer, 0, 0x68, size - 2, apci1 << 1, apci2 << 1, typ, (asdu.sq & 1) << 7 | asdu.sq_count & 0x7f,
+                   asdu.Cause, asdu.GlobalAddress)
+    if asdu.sq:
+        ADDRESS.pack_into(buffer, HEAD.size, asdu.StartAddress & 0xffff, asdu.StartAddress >> 16 & 0xff)
+    for obj in asdu.data:
+        fields = [getter(obj) for getter in getters]
+        if encode_time is not None:
+            fields.extend(encode_time(obj[time_name]))
+        if layout is with_address:
+            address = obj.get('address') or 0
+            layout.pack_into(buffer, offset, address & 0xffff, address >> 16 & 0xff, *fields)
+        else:
+            layout.pack_into(buffer, offset, *fields)
+        offset += layout.size
+    return bytes(buffer)
@@ -15,14 +15,32 @@
 # under the License.
 
 import asyncio
-from collections import deque
 
 from pydatacoll.protocols import BaseDevice
 import pydatacoll.utils.logger as my_logger
+from pydatacoll.utils.send_queue import SendQueue, PRIORITY_CTRL, PRIORITY_CALL, PRIORITY_TASK
 from .frame import *
+from .codec import encode
 
 logger = my_logger.get_logger('IEC104Device')
 
+# max information objects in one ASDU, sq_count has 7 bits
+MAX_SQ_COUNT = 127
+
+
+def code_runs(codes):
+    """
+    :param codes: protocol codes(int)
+    :return: [(start, count)] of contiguous codes in ascending order, count is no more than MAX_SQ_COUNT
+    """
+    runs = list()
+    for code in sorted(set(codes)):
+        if runs and runs[-1][0] + runs[-1][1] == code and runs[-1][1] < MAX_SQ_COUNT:
+            runs[-1] = (runs[-1][0], runs[-1][1] + 1)
+        else:
+            runs.append((code, 1))
+    return runs
+
 
 class IEC104Device(BaseDevice):
     def __init__(self, device_info: dict, io_loop: asyncio.AbstractEventLoop):
@@ -33,7 +51,12 @@ class IEC104Device(BaseDevice):
         self.rsn = 0
         self.k = 0
         self.w = 0
-        self.send_list = deque()
+        self.send_queue = SendQueue(config.getint('IEC104', 'send_queue_size', fallback=1000),
+                                    config.getint('IEC104', 'fair_share', fallback=8), self.io_loop.time)
+        self.send_timeout = config.getfloat('IEC104', 'send_timeout', fallback=30)
+        # station interrogation sent and not terminated yet, and the one waiting for it, see join_interrogation
+        self.interrogation = None
+        self.next_interrogation = None
         self.last_call_all_time_begin = datetime.datetime.now()
         self.last_call_all_time_end = None
         self.connect_retry_count = 0
@@ -64,7 +87,8 @@ class IEC104Device(BaseDevice):
                     timeout=IECParam.T0))
             self.reader, self.writer = await self.connect_handler
             self.connect_handler = None
-            self.change_device_status(on_line=True)
+            await self.change_device_status(on_line=True)
+            await self.load_mapping()
             self.receive_handler = self.io_loop.create_task(self.receive())
             await self.send_frame(iec_104.init_frame(UFrame.STARTDT_ACT))
         except asyncio.TimeoutError:
@@ -92,12 +116,15 @@ class IEC104Device(BaseDevice):
         self.writer and self.writer.close()
         self.receive_handler and self.receive_handler.cancel()
         if self.connected:
-            self.change_device_status(on_line=False)
+            self.connected = False
+            self.io_loop.create_task(self.change_device_status(on_line=False))
         self.ssn = 0
         self.rsn = 0
         self.k = 0
         self.w = 0
-        self.send_list.clear()
+        self.send_queue.clear()
+        self.interrogation = None
+        self.next_interrogation = None
         self.start_act_handler = None
         self.test_act_handler = None
         if self.data_link_established.done():
@@ -129,9 +156,9 @@ class IEC104Device(BaseDevice):
     #         self.reconnect_handler = self.io_loop.call_soon(lambda: self.io_loop.create_task(self.reconnect()))
 
     def on_timer1(self):
-        logger.error('device[%s] T1 timeout, send_list=%s', self.device_id,
-                     [frm.APCI1 if frm.APCI1 == 'S' or isinstance(frm.APCI1, UFrame) else
-                      frm.ASDU.TYP for frm in self.send_list])
+        frm = self.send_queue.inflight
+        logger.error('device[%s] T1 timeout, inflight=%s, send_queue=%s', self.device_id,
+                     frm and (frm.APCI1 if isinstance(frm.APCI1, UFrame) else frm.ASDU.TYP), self.send_queue.stats)
         if self.reconnect_handler is None:
             # self.reconnect_handler = self.io_loop.call_soon(lambda: self.io_loop.create_task(self.reconnect()))
             logger.debug('device[%s] reconnect after 3 seconds', self.device_id)
@@ -215,9 +242,9 @@ class IEC104Device(BaseDevice):
             logger.debug("device[%s] got U_FRAME: %s", self.device_id, frame.APCI1.name)
             if frame.APCI1 == UFrame.STARTDT_ACT:
                 # 对方也发送了STARTDT, 删除之前自己发送的STARTDT
-                if self.send_list and self.send_list[0].APCI1 == UFrame.STARTDT_ACT:
+                if self.send_queue.busy and self.send_queue.inflight.APCI1 == UFrame.STARTDT_ACT:
                     logger.info('device[%s] remote side send STARTDT_ACT too, ignored mine', self.device_id)
-                    self.send_list.popleft()
+                    self.send_queue.discard()
                     self.stop_timer(IECParam.T1)
                 elif self.start_act_handler:
                     self.stop_timer(IECParam.T1)
@@ -241,9 +268,9 @@ class IEC104Device(BaseDevice):
                     self.data_link_established.set_result(None)
             elif frame.APCI1 == UFrame.TESTFR_ACT:
                 # 对方也发送了TESTFR_ACT, 删除之前自己发送的TESTFR_ACT
-                if self.send_list and self.send_list[0].APCI1 == UFrame.TESTFR_ACT:
+                if self.send_queue.busy and self.send_queue.inflight.APCI1 == UFrame.TESTFR_ACT:
                     logger.debug('device[%s] remote side send TESTFR_ACT too, ignored mine', self.device_id)
-                    self.send_list.popleft()
+                    self.send_queue.discard()
                     self.stop_timer(IECParam.T1)
                 elif self.test_act_handler:
                     self.stop_timer(IECParam.T1)
@@ -295,6 +322,10 @@ class IEC104Device(BaseDevice):
                 logger.debug('device[%s] method=%s, data_pairs=%s', self.device_id, method, [
                     "{time} {data[1]} {data[2]}".format(time=data[0].isoformat(),data=data) for data in data_pairs])
                 await self.process_data(data_pairs, method)
+                if frame.ASDU.Cause == Cause.introgen and self.interrogation and self.interrogation['codes']:
+                    call_pairs = set(pair for pair in data_pairs if pair[1] in self.interrogation['codes'])
+                    self.interrogation['codes'].difference_update(pair[1] for pair in call_pairs)
+                    await self.process_data(call_pairs, 'call')
             elif frame.ASDU.Cause == Cause.actcon:
                 if TYP.C_SC_NA_1 <= frame.ASDU.TYP <= TYP.C_SE_TC_1 and frame.ASDU.data[0].se == 1:
                     send_data = frame
@@ -304,10 +335,17 @@ class IEC104Device(BaseDevice):
                 elif frame.ASDU.TYP == TYP.C_CS_NA_1:
                     if not self.time_synced.done():
                         self.time_synced.set_result(None)
+                elif frame.ASDU.TYP == TYP.C_IC_NA_1 and self.interrogation:
+                    self.interrogation['confirmed'] = True
             elif frame.ASDU.Cause == Cause.actterm:
                 if frame.ASDU.TYP == TYP.C_IC_NA_1:  # 总召唤命令
-                    if not self.all_data_called.done():
+                    finished = self.interrogation
+                    self.interrogation, self.next_interrogation = self.next_interrogation, None
+                    if (finished is None or finished['task']) and not self.all_data_called.done():
                         self.all_data_called.set_result(None)
+                    if self.interrogation is not None:
+                        self.io_loop.create_task(self.send_frame(
+                                iec_104.init_frame(self.ssn, self.rsn, TYP.C_IC_NA_1, Cause.act)))
                 if frame.ASDU.TYP == TYP.C_CI_NA_1:  # 电能脉冲召唤命令
                     if not self.power_data_called.done():
                         self.power_data_called.set_result(None)
@@ -324,8 +362,22 @@ class IEC104Device(BaseDevice):
             logger.error("device[%s] handle_i failed: %s", self.device_id, repr(e), exc_info=True)
             self.disconnect(reconnect=True)
 
+    def frame_priority(self, frame):
+        """
+        :return: (priority, timeout) of an I frame waiting for confirmation in send_queue, tasks never expire
+        """
+        if TYP.C_SC_NA_1 <= frame.ASDU.TYP <= TYP.C_SE_TC_1:
+            return PRIORITY_CTRL, self.send_timeout
+        if frame.ASDU.TYP == TYP.C_RD_NA_1:
+            return PRIORITY_CALL, self.send_timeout
+        return PRIORITY_TASK, None
+
     # 优化发送逻辑
     async def send_frame(self, frame, check=True):
+        """
+        :param check: frames need confirmation go through send_queue, False to write frame at once(it must be
+                      the in-flight frame of send_queue or needs no confirmation)
+        """
         if frame is None:
             return
         stream_write = False
@@ -335,15 +387,19 @@ class IEC104Device(BaseDevice):
             if frame.APCI1 == "S":
                 self.stop_timer(IECParam.T2)
                 frame.APCI2 = self.rsn
-                encode_frame = iec_104.build_isu(frame)
+                encode_frame = encode(frame)
                 self.writer.write(encode_frame)
                 await self.writer.drain()
                 self.w = 0
                 stream_write = True
             # send U
             elif isinstance(frame.APCI1, UFrame):
-                if not check or not self.send_list:
-                    encode_frame = iec_104.build_isu(frame)
+                if check and frame.APCI1 in (UFrame.STARTDT_ACT, UFrame.TESTFR_ACT):
+                    send_now = self.send_queue.submit(frame, PRIORITY_CTRL)
+                else:
+                    send_now = not check or not self.send_queue.busy
+                if send_now:
+                    encode_frame = encode(frame)
                     self.writer.write(encode_frame)
                     await self.writer.drain()
                     stream_write = True
@@ -353,16 +409,17 @@ class IEC104Device(BaseDevice):
                     elif frame.APCI1 == UFrame.TESTFR_ACT:
                         self.start_timer(IECParam.T1)
                         self.test_act_handler = None
-                if check and frame.APCI1 in (
-                        UFrame.STARTDT_ACT, UFrame.TESTFR_ACT):
-                    self.send_list.append(frame)
             # send I
             else:
-                if check is False or not self.send_list or frame.ASDU.Cause not in (Cause.act, Cause.req):
+                if check and frame.ASDU.Cause in (Cause.act, Cause.req):
+                    send_now = self.send_queue.submit(frame, *self.frame_priority(frame))
+                else:
+                    send_now = True
+                if send_now:
                     self.stop_timer(IECParam.T2)
                     frame.APCI1 = self.ssn
                     frame.APCI2 = self.rsn
-                    encode_frame = iec_104.build_isu(frame)
+                    encode_frame = encode(frame)
                     while self.k >= IECParam.K:
                         logger.debug('device[%s] self.k,ParamK=%s, wait S..', self.device_id, (self.k, IECParam.K))
                         if self.k_decreased.done():
@@ -376,8 +433,6 @@ class IEC104Device(BaseDevice):
                     stream_write = True
                     if frame.ASDU.Cause in (Cause.act, Cause.req):
                         self.start_timer(IECParam.T1)
-                if check and frame.ASDU.Cause in (Cause.act, Cause.req):
-                    self.send_list.append(frame)
             if stream_write:
                 logger.debug("device[%s] send_frame(%s): %s", self.device_id,
                              frame.APCI1 if frame.APCI1 == "S" or isinstance(frame.APCI1, UFrame) else
@@ -386,9 +441,10 @@ class IEC104Device(BaseDevice):
                 if self.log_frame:
                     self.io_loop.create_task(
                             self.save_frame(encode_frame, send=True, save_time=datetime.datetime.now()))
-            logger.debug("device[%s] after send_frame: send_list=%s", self.device_id,
-                         [frm.APCI1 if frm.APCI1 == 'S' or isinstance(frm.APCI1, UFrame) else
-                          frm.ASDU.TYP for frm in self.send_list])
+            logger.debug("device[%s] after send_frame: %s frames waiting", self.device_id, len(self.send_queue))
+        except asyncio.QueueFull as e:
+            logger.warning("device[%s] send_frame dropped %s: %s", self.device_id, frame.ASDU.TYP.name
+                           if frame.ASDU else frame.APCI1.name, e)
         except Exception as e:
             logger.error("device[%s] send_frame failed: %s", self.device_id, repr(e), exc_info=True)
             self.disconnect(reconnect=True)
@@ -396,18 +452,17 @@ class IEC104Device(BaseDevice):
     async def check_to_send(self, frame):
         try:
             self.stop_timer(IECParam.T1)
-            if not self.send_list or frame is None:
+            inflight = self.send_queue.inflight
+            if inflight is None or frame is None:
                 return
             if isinstance(frame.APCI1, UFrame) and frame.APCI1 in \
                     (UFrame.STARTDT_CON, UFrame.TESTFR_CON, UFrame.STOPDT_CON):
-                pop_frame = self.send_list.popleft()
-                logger.debug('device[%s] check_to_send: remove U_Frame %s', self.device_id, pop_frame.APCI1.name)
-                await self.send_frame(self.send_list[0] if self.send_list else None, check=False)
-            elif frame.ASDU.TYP == self.send_list[0].ASDU.TYP \
-                    or frame.ASDU.Cause == Cause.req and self.send_list[0].ASDU.TYP == TYP.C_RD_NA_1:
-                pop_frame = self.send_list.popleft()
-                logger.debug('device[%s] check_to_send: remove I_Frame %s', self.device_id, pop_frame.ASDU.TYP.name)
-                await self.send_frame(self.send_list[0] if self.send_list else None, check=False)
+                logger.debug('device[%s] check_to_send: remove U_Frame %s', self.device_id, inflight.APCI1.name)
+                await self.send_frame(self.send_queue.pop(), check=False)
+            elif frame.ASDU.TYP == inflight.ASDU.TYP \
+                    or frame.ASDU.Cause == Cause.req and inflight.ASDU.TYP == TYP.C_RD_NA_1:
+                logger.debug('device[%s] check_to_send: remove I_Frame %s', self.device_id, inflight.ASDU.TYP.name)
+                await self.send_frame(self.send_queue.pop(), check=False)
         except Exception as e:
             logger.error("device[%s] check_to_send failed: %s", self.device_id, repr(e), exc_info=True)
             self.disconnect(reconnect=True)
@@ -426,15 +481,16 @@ class IEC104Device(BaseDevice):
                 self.power_data_called = asyncio.futures.Future(loop=self.io_loop)
             await self.send_frame(iec_104.init_frame(self.ssn, self.rsn, TYP.C_CS_NA_1, Cause.act))
             await self.time_synced
-            await self.send_frame(iec_104.init_frame(self.ssn, self.rsn, TYP.C_IC_NA_1, Cause.act))
+            await self.send_frame(self.join_interrogation(task=True))
             await self.all_data_called
             await self.send_frame(iec_104.init_frame(self.ssn, self.rsn, TYP.C_CI_NA_1, Cause.act))
             await self.power_data_called
             self.last_call_all_time_end = datetime.datetime.now()
             spent = self.last_call_all_time_end - self.last_call_all_time_begin
             self.coll_count += 1
-            logger.info('device[%s] last task costs: %s seconds, rsn=%s, task_count=%s',
-                        self.device_id, spent.total_seconds(), self.rsn, self.coll_count)
+            logger.info('device[%s] last task costs: %s seconds, rsn=%s, task_count=%s, mapping=%s, send_queue=%s',
+                        self.device_id, spent.total_seconds(), self.rsn, self.coll_count, self.mapping_stats,
+                        self.send_queue.stats)
             self.coll_task_handler = self.io_loop.call_later(
                     self.coll_interval.seconds, lambda: self.io_loop.create_task(self.run_task()))
             logger.info('device[%s] run next task at %s', self.device_id,
@@ -443,13 +499,47 @@ class IEC104Device(BaseDevice):
             logger.error("device[%s] run_task failed: %s", self.device_id, repr(e), exc_info=True)
 
     def fresh_task(self, term_dict, term_item_dict, delete=False):
-        pass
+        self.fresh_mapping(term_dict, term_item_dict, delete)
+
+    def join_interrogation(self, codes=(), task=False):
+        """
+        only one station interrogation is sent at a time, callers join the one sent if its data have not begun
+        (not confirmed yet), otherwise the next one, which is sent when the running one terminated
+        :param codes: protocol codes published as 'call' when they arrive
+        :param task: called by run_task, all_data_called is resolved when the interrogation terminated
+        :return: C_IC_NA_1 frame to send, None if joined an interrogation already sent
+        """
+        if self.interrogation is None:
+            self.interrogation = {'confirmed': False, 'task': task, 'codes': set(codes)}
+            return iec_104.init_frame(self.ssn, self.rsn, TYP.C_IC_NA_1, Cause.act)
+        if self.interrogation['confirmed']:
+            if self.next_interrogation is None:
+                self.next_interrogation = {'confirmed': False, 'task': False, 'codes': set()}
+            joined = self.next_interrogation
+        else:
+            joined = self.interrogation
+        joined['task'] = joined['task'] or task
+        joined['codes'].update(codes)
+        return None
 
     def prepare_call_frame(self, term_item_dict):
         frame = iec_104.init_frame(self.ssn, self.rsn, TYP.C_RD_NA_1, Cause.req)  # 102 读命令
         frame.ASDU.data[0].address = int(term_item_dict['protocol_code'])
         return frame
 
+    def prepare_call_frames(self, term_item_list):
+        """
+        C_RD_NA_1 addresses one information object, so reading n codes costs 2n frames(request and response);
+        a station interrogation costs act, actcon, actterm and one response for every run of contiguous codes,
+        it is joined instead when cheaper and values of the called codes are published as 'call' when they arrive
+        """
+        codes = set(int(term_item['protocol_code']) for term_item in term_item_list)
+        runs = code_runs(codes.union(int(code) for code in self.mapping_dict))
+        if 3 + len(runs) < 2 * len(codes):
+            frame = self.join_interrogation(codes)
+            return [] if frame is None else [frame]
+        return [self.prepare_call_frame({'protocol_code': code}) for code in sorted(codes)]
+
     def prepare_ctrl_frame(self, term_item_dict, value):
         frame = iec_104.init_frame(self.ssn, self.rsn, TYP(int(term_item_dict['code_type'])), Cause.act)
         frame.ASDU.data[0].address = int(term_item_dict['protocol_code'])
@@ -751,13 +751,25 @@ def exact_names(obj):
         {obj.name: datetime.datetime.now() if obj.name in ("cp56time2a", "cp24time2a") else 0}
 
 
+# TYP -> fields of information object found by exact_names, time fields are renewed for each frame
+_object_templates = dict()
+
+
 def init_frame(_, apci1=None, apci2=None, typ=None, cause=Cause.unused, sq_count=1, sq=0):
     cc = Container(APCI1=apci1, APCI2=apci2, length=0, ASDU=None)
     if typ is not None:
         cc.ASDU = Container(TYP=typ, sq=sq, sq_count=sq_count, StartAddress=0, Cause=cause,
                             GlobalAddress=1, data=list())
+        template = _object_templates.get(typ)
+        if template is None:
+            template = _object_templates[typ] = exact_names(globals()["ASDU_" + typ.name])
+        now = datetime.datetime.now()
         for num in range(cc.ASDU.sq_count):
-            cc.ASDU.data.append(exact_names(globals()["ASDU_" + typ.name]))
+            obj = Container(**template)
+            for name in ("cp56time2a", "cp24time2a"):
+                if name in obj:
+                    obj[name] = now
+            cc.ASDU.data.append(obj)
     return cc
 
 
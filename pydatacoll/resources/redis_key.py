@@ -47,6 +47,10 @@ REDIS_KEY = {
             'do_verify': '异常判断函数，返回False或0为异常，其他值正常，发生异常执行db_warn_sql，异常原因由warn_msg指定',
             'up_limit': '上限(模拟时用于生成随机数的上限)',
             'down_limit': '下限(模拟时用于生成随机数的下限)',
+            'deadband': '变化死区(相对误差),与上一次的值在此范围内视为未变化,默认1e-04',
+            'keep_count': '最多保留的数据个数,0为不限制,默认见配置[DataRetention]',
+            'keep_age': '数据最长保留时间(秒),0为不限制,默认见配置[DataRetention]',
+            'rollup': '过期数据删除前按周期求平均值,值=[hour, day, hour,day],默认见配置[DataRetention]',
         },
         "HS:MAPPING:{protocol_name}:{device_id}:{protocol_code}": {
             '同上',
@@ -54,6 +58,24 @@ REDIS_KEY = {
         "HS:DATA:{device_id}:{term_id}:{item_id}": {
             'datetime.isoformat()': 'value',  # eg: '2015-12-01T08:50:15.000002': 123.4
         },
+        "HS:ROLLUP:{period}:{device_id}:{term_id}:{item_id}": {
+            'isoformat()前缀': '平均值',  # period=hour eg: '2015-12-01T08': 123.4, period=day eg: '2015-12-01': 123.4
+        },
+        "HS:ROLLUP_COUNT:{period}:{device_id}:{term_id}:{item_id}": {
+            '同上': '参与平均的数据个数',
+        },
+        "HS:DATA_RETENTION": {
+            'runs': '运行次数',
+            'keys': '上次检查的数据个数',
+            'trimmed': '累计删除的数据点数',
+            'rollups': '累计写入的平均值个数',
+            'memory_reclaimed': '上次运行前后redis used_memory的差值(字节)',
+            'last_run': '上次运行时间',
+            'last_duration': '上次运行耗时(秒)',
+        },
+        "HS:LAST_VALUE": {
+            '{device_id}:{term_id}:{item_id}': '最新的值',  # eg: '1:20:30': 123.4
+        },
         "HS:FORMULA:{formula_id}": {
             # 必填
             'id': '主键',
@@ -87,6 +109,16 @@ REDIS_KEY = {
 
         "SET:FORMULA":
             '计算公式主键id列表, eg: [1,2,3]',
+
+        "SET:ITEM_TERM:{item_id}":
+            '包含特定指标类的终端主键id列表, SET:TERM_ITEM的反向索引, eg: [1,2,3]',
+
+        "SET:DEVICE_MAPPING:{device_id}":
+            '引用特定设备的HS:MAPPING键列表, 用于级联删除(同SET:TERM_MAPPING:{term_id}, SET:ITEM_MAPPING:{item_id})',
+
+        "SET:DEVICE_DATA:{device_id}":
+            '引用特定设备的数据键列表,格式: {device_id}:{term_id}:{item_id}, 用于级联删除'
+            '(同SET:TERM_DATA:{term_id}, SET:ITEM_DATA:{item_id}), 旧数据运行pydatacoll-reindex建立索引',
     },
 
     "list": {
@@ -94,7 +126,12 @@ REDIS_KEY = {
             '存储设备发送接收的字符串,格式: 时间,send/recv,数据帧',  # eg: '2015-12-18T12:23:08.916158,send,680407000000'
 
         "LST:DATA_TIME:{device_id}:{term_id}:{item_id}":
-            '存储数据时间,格式: datetime.isoformat()',  # eg: '2015-12-01T08:50:15.000002'
+            '存储数据时间,格式: datetime.isoformat(), 配置[REDIS] time_index = list时使用',  # eg: '2015-12-01T08:50:15.000002'
+    },
+
+    "zset": {
+        "ZS:DATA_TIME:{device_id}:{term_id}:{item_id}":
+            '存储数据时间,成员: datetime.isoformat(), 分数: 时间戳(无时区按UTC计算), 配置[REDIS] time_index = zset时使用',
     },
 
     "channel": {
@@ -116,12 +153,25 @@ REDIS_KEY = {
         "CHANNEL:TERM_ITEM_ADD":
             '终端指标关联,消息内容: HS:TERM_ITEM:{term_id}:{item_id}的值',
 
+        "CHANNEL:DEVICE_ADD_BATCH":
+            '批量添加设备(v2接口),每个MULTI/EXEC批次一条消息,消息内容: [HS:DEVICE:{device_id}的值, ...]',
+
+        "CHANNEL:TERM_ADD_BATCH":
+            '批量添加终端(v2接口),消息内容: [HS:TERM:{term_id}的值, ...]',
+
+        "CHANNEL:TERM_ITEM_ADD_BATCH":
+            '批量终端指标关联(v2接口),消息内容: [HS:TERM_ITEM:{term_id}:{item_id}的值, ...]',
+
         "CHANNEL:TERM_ITEM_DEL":
             '终端指标解除关联,消息内容: {device_id:xxx, term_id:xxx, item_id:xxx}',
 
         "CHANNEL:DEVICE_CALL":
             '设备数据招测,消息内容: {device_id:xxx, term_id:xxx, item_id:xxx}',
 
+        "CHANNEL:DEVICE_CALL_BATCH":
+            '设备批量招测,每个设备一条消息,消息内容: {device_id:xxx, term_items:[HS:TERM_ITEM的值]},'
+            '每个测点分别在CHANNEL:DEVICE_CALL:{device_id}:{term_id}:{item_id}返回',
+
         "CHANNEL:DEVICE_CTRL":
             '设备控制,消息内容: {device_id:xxx, term_id:xxx, item_id:xxx, value:xxx}',
 
@@ -132,11 +182,14 @@ REDIS_KEY = {
             '控制返回,消息内容: 同上',
 
         "CHANNEL:DEVICE_DATA:{device_id}:{term_id}:{item_id}":
-            '采集数据,消息内容: 同上',
+            '采集数据,消息内容: 同上+{last_value:上一次的值(可选)}',
 
         "CHANNEL:WARNING:{device_id}:{term_id}:{item_id}":
             '报警数据,消息内容: 同上+{warn_msg:xxx}',
 
+        "CHANNEL:DATA_RETENTION":
+            "立即清理过期数据,消息内容: {'match': LST:DATA_TIME(或ZS:DATA_TIME)的匹配模式(可选)}",
+
         "CHANNEL:FORMULA_ADD":
             '添加计算公式,消息内容: HS:FORMULA:{formula_id}的值',
 
@@ -150,6 +203,13 @@ REDIS_KEY = {
             "计算公式校验,消息内容: {'formula': xxx, 'p0':xxx, ...}",
 
         "CHANNEL:FORMULA_CHECK_RESULT:{formula_length}":
-            "计算公式校验结果,消息内容: {'rst': xxx, 'err_msg':xxx}"
+            "计算公式校验结果(请求不含reply_to时),消息内容: {'rst': xxx, 'err_msg':xxx}",
+
+        "CHANNEL:SQL_CHECK":
+            "SQL校验,消息内容: HS:TERM_ITEM:{term_id}:{item_id}的值+{device_id, time, value}",
+
+        "CHANNEL:RPC_REPLY:{client_id}":
+            "请求响应(api服务器每个进程一个),CHANNEL:FORMULA_CHECK和CHANNEL:SQL_CHECK请求附带"
+            "{rpc_id: 请求ID, reply_to: 本频道},结果发送到本频道,消息内容: {rpc_id: 请求ID, result: 结果}",
     }
 }
@@ -13,6 +13,9 @@
 # WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
 # License for the specific language governing permissions and limitations
 # under the License.
+from collections import namedtuple
+import functools
+
 
 def str_to_number(s):
     try:
@@ -21,3 +24,21 @@ def str_to_number(s):
         return int(s)
     except ValueError:
         return float(s)
+
+
+@functools.lru_cache(maxsize=1024)
+def param_type(fields: tuple):
+    """
+    :param fields: field names
+    :return: namedtuple type shared by all records with the same fields
+    """
+    return namedtuple('Param', fields)
+
+
+def make_param(data_dict: dict):
+    """
+    build attribute-access record of data_dict without creating a new namedtuple class every time
+    :param data_dict: eg: data message updated by TERM_ITEM
+    :return: record used as PARAM in sql template or param in formula
+    """
+    return param_type(tuple(data_dict.keys()))(**data_dict)
@@ -0,0 +1,135 @@
+#!/usr/bin/env python
+#
+# Copyright 2016 timercrack
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import re
+from collections import OrderedDict, defaultdict
+
+import numpy as np
+import pandas as pd
+
+from pydatacoll.utils.time_index import to_timestamp
+
+# aggregate function name in API -> pandas function name
+AGGREGATE_FUNCTIONS = {'min': 'min', 'max': 'max', 'avg': 'mean', 'sum': 'sum', 'count': 'count'}
+
+INTERVAL_REGEX = re.compile(r'^\s*(\d+)\s*(s|sec|m|min|h|hour|d|day|w|week)s?\s*$', re.IGNORECASE)
+INTERVAL_UNITS = {'s': 1, 'sec': 1, 'm': 60, 'min': 60, 'h': 3600, 'hour': 3600, 'd': 86400, 'day': 86400,
+                  'w': 604800, 'week': 604800}
+
+
+def parse_interval(interval: str):
+    """
+    :param interval: number + unit, unit=[s, m(min), h(hour), d(day), w(week)], eg: 15min, 1h
+    :return: pandas offset, offset objects are used instead of frequency aliases which vary among pandas versions
+    """
+    match = INTERVAL_REGEX.match(interval)
+    if match is None or int(match.group(1)) <= 0:
+        raise ValueError('invalid interval: {}'.format(interval))
+    seconds = int(match.group(1)) * INTERVAL_UNITS[match.group(2).lower()]
+    if seconds % 86400 == 0:
+        return pd.offsets.Day(seconds // 86400)
+    if seconds % 3600 == 0:
+        return pd.offsets.Hour(seconds // 3600)
+    if seconds % 60 == 0:
+        return pd.offsets.Minute(seconds // 60)
+    return pd.offsets.Second(seconds)
+
+
+def to_datetime_index(time_list: list):
+    """
+    :param time_list: datetime.isoformat(), microsecond is omitted by isoformat() when it's 0
+    """
+    try:
+        return pd.to_datetime([time_str if '.' in time_str else time_str + '.000000' for time_str in time_list],
+                              format='%Y-%m-%dT%H:%M:%S.%f')
+    except ValueError:
+        return pd.to_datetime([to_timestamp(time_str) for time_str in time_list], unit='s')
+
+
+def aggregate(data_dict: dict, interval: str, fn_list: list):
+    """
+    :param data_dict: value of HS:DATA, {datetime.isoformat(): value}
+    :param interval: bucket size, see parse_interval
+    :param fn_list: aggregate functions, value=AGGREGATE_FUNCTIONS
+    :return: columnar result, {'time': [start time of buckets], fn: [values]}, empty buckets are omitted
+    """
+    for fn in fn_list:
+        if fn not in AGGREGATE_FUNCTIONS:
+            raise ValueError('invalid aggregate function: {}'.format(fn))
+    offset = parse_interval(interval)
+    series = pd.Series(pd.to_numeric(list(data_dict.values()), errors='coerce'),
+                       index=to_datetime_index(list(data_dict.keys())), dtype=float).dropna().sort_index()
+    pd_functions = list(OrderedDict.fromkeys([AGGREGATE_FUNCTIONS[fn] for fn in fn_list] + ['count']))
+    frame = series.groupby(pd.Grouper(freq=offset)).agg(pd_functions)
+    frame = frame[frame['count'] > 0]
+    rst = {'time': [bucket.isoformat() for bucket in frame.index]}
+    for fn in fn_list:
+        column = frame[AGGREGATE_FUNCTIONS[fn]].values
+        rst[fn] = column.astype(int).tolist() if fn == 'count' else \
+            [None if np.isnan(value) else float(value) for value in column]
+    return rst
+
+
+class AggregateCache(object):
+    """
+    LRU cache of aggregate results, key is a tuple starting with data_key({device_id}:{term_id}:{item_id}),
+    all results of a data_key are dropped by invalidate() when new data arrive.
+    usage:
+        version = cache.version(data_key)
+        rst = cache.get(key)
+        if rst is None:
+            rst = aggregate(...)
+            cache.put(key, rst, version)  # ignored if invalidated during calculation
+    """
+    def __init__(self, maxsize: int = 256):
+        self.maxsize = maxsize
+        self.cache = OrderedDict()
+        self.key_dict = defaultdict(set)  # data_key -> cache keys
+        self.version_dict = defaultdict(int)  # data_key -> times invalidated
+        self.hits = 0
+        self.misses = 0
+
+    def version(self, data_key: str):
+        return self.version_dict[data_key]
+
+    def get(self, key: tuple):
+        if key in self.cache:
+            self.cache.move_to_end(key)
+            self.hits += 1
+            return self.cache[key]
+        self.misses += 1
+        return None
+
+    def put(self, key: tuple, value, version: int = None):
+        if self.maxsize <= 0 or (version is not None and version != self.version_dict[key[0]]):
+            return
+        self.cache[key] = value
+        self.cache.move_to_end(key)
+        self.key_dict[key[0]].add(key)
+        while len(self.cache) > self.maxsize:
+            old_key, _ = self.cache.popitem(last=False)
+            self.key_dict[old_key[0]].discard(old_key)
+            if not self.key_dict[old_key[0]]:
+                del self.key_dict[old_key[0]]
+
+    def invalidate(self, data_key: str):
+        self.version_dict[data_key] += 1
+        for key in self.key_dict.pop(data_key, ()):
+            self.cache.pop(key, None)
+
+    @property
+    def stats(self):
+        return {'size': len(self.cache), 'maxsize': self.maxsize, 'hits': self.hits, 'misses': self.misses}
@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+#
+# Copyright 2016 timercrack
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import hashlib
+import inspect
+import re
+
+METHOD_ORDER = ('GET', 'POST', 'PUT', 'DELETE')
+# {name} or {name:regex} in url of param_function
+URL_PARAM_REGEX = re.compile(r'\{(\w+)(?::([^{}]+))?\}')
+
+
+def make_etag(body: bytes):
+    return '"{}"'.format(hashlib.sha1(body).hexdigest())
+
+
+def route_list(module_arg_dict: dict):
+    """
+    :param module_arg_dict: ParamFunctionContainer.module_arg_dict, {function name: {'method': x, 'url': x}}
+    :return: [(method, url)] ordered by METHOD_ORDER and url, regex of url parameters removed
+    """
+    routes = set((args['method'], URL_PARAM_REGEX.sub(r'{\1}', args['url']))
+                 for args in module_arg_dict.values() if 'method' in args and 'url' in args)
+    return sorted(routes, key=lambda route: (
+        METHOD_ORDER.index(route[0]) if route[0] in METHOD_ORDER else len(METHOD_ORDER), route[0], route[1]))
+
+
+def index_text(routes: list, base_url: str):
+    """
+    :param routes: route_list()
+    :param base_url: scheme://host of request
+    """
+    doc_list = ['PyDataColl is running, available API:\n']
+    doc_list.extend('method: {:<8} URL: {}{}'.format(method, base_url, url) for method, url in routes)
+    return '\n'.join(doc_list)
+
+
+def openapi_spec(container, title: str = 'PyDataColl', version: str = '0.1'):
+    """
+    OpenAPI 3.0 document built from param_function(method, url) and docstrings of container
+    :param container: ParamFunctionContainer with web handlers
+    :return: dict, operationId is name of handler function
+    """
+    paths = dict()
+    for fun_name, args in sorted(container.module_arg_dict.items()):
+        if 'method' not in args or 'url' not in args:
+            continue
+        path = URL_PARAM_REGEX.sub(r'{\1}', args['url'])
+        doc = inspect.getdoc(getattr(container, fun_name)) or ''
+        operation = {'operationId': fun_name, 'summary': doc.splitlines()[0] if doc else fun_name.replace('_', ' '),
+                     'responses': {'200': {'description': 'OK'}, '400': {'description': 'invalid request'}}}
+        if doc:
+            operation['description'] = doc
+        segments = [segment for segment in path.split('/') if segment and not segment.startswith('{')]
+        if len(segments) > 2:
+            operation['tags'] = [segments[2]]
+        parameters = list()
+        for name, pattern in URL_PARAM_REGEX.findall(args['url']):
+            schema = {'type': 'string'}
+            if pattern:
+                schema['pattern'] = '^{}$'.format(pattern)
+            parameters.append({'name': name, 'in': 'path', 'required': True, 'schema': schema})
+            operation['responses']['404'] = {'description': '{} not found'.format(name)}
+        if parameters:
+            operation['parameters'] = parameters
+        if args['method'] in ('POST', 'PUT'):
+            operation['requestBody'] = {'content': {'application/json': {'schema': {}}}}
+        paths.setdefault(path, dict())[args['method'].lower()] = operation
+    return {'openapi': '3.0.0', 'info': {'title': title, 'version': version}, 'paths': paths}
@@ -0,0 +1,58 @@
+#!/usr/bin/env python
+#
+# Copyright 2016 timercrack
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import ast
+import math
+
+SAFE_NODES = tuple(node for node in (getattr(ast, name, None) for name in (
+    'Expression', 'BoolOp', 'BinOp', 'UnaryOp', 'Compare', 'IfExp', 'Call', 'keyword', 'Name', 'Load', 'Attribute',
+    'Subscript', 'Index', 'Slice', 'Tuple', 'List', 'Set', 'Dict', 'Constant', 'Num', 'Str', 'Bytes', 'NameConstant',
+    'And', 'Or', 'Not', 'Invert', 'UAdd', 'USub', 'Add', 'Sub', 'Mult', 'Div', 'FloorDiv', 'Mod', 'Pow', 'LShift',
+    'RShift', 'BitOr', 'BitXor', 'BitAnd', 'Eq', 'NotEq', 'Lt', 'LtE', 'Gt', 'GtE', 'Is', 'IsNot', 'In', 'NotIn',
+)) if node is not None)
+
+SAFE_FUNCTIONS = {name: getattr(math, name) for name in dir(math) if not name.startswith('_')}
+SAFE_FUNCTIONS.update({func.__name__: func for func in (
+    abs, all, any, bool, dict, divmod, float, int, len, list, max, min, pow, round, set, sorted, str, sum, tuple)})
+SAFE_FUNCTIONS.update({'True': True, 'False': False, 'None': None})
+
+
+def compile_expression(expression: str, names=('param', 'value')):
+    """
+    Compile expression into a python function, only operators, math functions, simple builtins and
+    the given names can be used, attributes start with '_' are forbidden.
+    usage:
+        verify = compile_expression('param.down_limit <= value <= param.up_limit')
+        verify(param=param, value=value)
+    :param expression: python expression, eg: do_verify of TERM_ITEM
+    :param names: variables passed to the function as keyword arguments
+    :return: function evaluating expression in a new scope every call
+    """
+    tree = ast.parse(expression.strip(), mode='eval')
+    for node in ast.walk(tree):
+        if not isinstance(node, SAFE_NODES):
+            raise ValueError('{} is not allowed in expression'.format(type(node).__name__))
+        if isinstance(node, ast.Name) and node.id not in names and node.id not in SAFE_FUNCTIONS:
+            raise ValueError('name {} is not defined'.format(node.id))
+        if isinstance(node, ast.Attribute) and node.attr.startswith('_'):
+            raise ValueError('attribute {} is not allowed'.format(node.attr))
+    code = compile(tree, '<expression>', 'eval')
+    global_dict = {'__builtins__': SAFE_FUNCTIONS}
+
+    def evaluate(**scope):
+        return eval(code, global_dict, scope)
+
+    return evaluate
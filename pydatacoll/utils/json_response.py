@@ -26,3 +26,39 @@ class JSON(web.Response):
     def __init__(self, data, status=200, reason=None, headers=None):
         body = json.dumps(data, ensure_ascii=False)
         super().__init__(text=body, status=status, reason=reason, headers=headers, content_type='application/json')
+
+
+class JSONStream(web.StreamResponse):
+    """
+    Stream a JSON object with chunked encoding, items are written as they come, the whole body is never built:
+        resp = JSONStream()
+        await resp.begin(request)
+        await resp.write_items([('2015-12-01T08:50:15', '123.4')])
+        await resp.end()
+        return resp
+    """
+    def __init__(self, status=200, reason=None, headers=None):
+        super().__init__(status=status, reason=reason, headers=headers)
+        self.content_type = 'application/json'
+        self.charset = 'utf-8'
+        self.enable_chunked_encoding()
+        self.chunk_count = 0
+
+    async def begin(self, request):
+        await self.prepare(request)
+        self.write(b'{')
+
+    async def write_items(self, items):
+        """
+        :param items: iterable of (key, value)
+        """
+        body = ','.join('{}:{}'.format(json.dumps(key, ensure_ascii=False), json.dumps(value, ensure_ascii=False))
+                        for key, value in items)
+        if body:
+            self.write('{}{}'.format(',' if self.chunk_count else '', body).encode('utf-8'))
+            self.chunk_count += 1
+            await self.drain()
+
+    async def end(self):
+        self.write(b'}')
+        await self.write_eof()
@@ -0,0 +1,183 @@
+#!/usr/bin/env python
+#
+# Copyright 2016 timercrack
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import argparse
+
+import pydatacoll.utils.logger as my_logger
+from pydatacoll.utils.read_config import *
+from pydatacoll.utils.redis_pool import get_sync_client
+from pydatacoll.utils.time_index import TimeIndex, ROLLUP_PERIODS
+
+logger = my_logger.get_logger('KeyIndex')
+
+
+def mapping_ids(mapping_key: str, term_item: dict):
+    """
+    :param mapping_key: HS:MAPPING:{protocol}:{device_id}:{protocol_code}
+    :param term_item: value of mapping_key
+    :return: (device_id, term_id, item_id)
+    """
+    return mapping_key.split(':')[3], term_item['term_id'], term_item['item_id']
+
+
+class KeyIndex(object):
+    """
+    Reverse index sets used by cascade deletes, so deleting a device/term/item never scans the whole keyspace:
+        SET:{DEVICE|TERM|ITEM}_MAPPING:{id}: keys of HS:MAPPING referencing the id
+        SET:{DEVICE|TERM|ITEM}_DATA:{id}: {device_id}:{term_id}:{item_id} of HS:DATA referencing the id
+        SET:ITEM_TERM:{item_id}: terms having the item, reverse of SET:TERM_ITEM:{term_id}
+    add/remove methods only queue commands, pipe is a Pipeline of redis_pool.
+    """
+    def __init__(self, time_index: TimeIndex = None, batch_size: int = None):
+        self.time_index = time_index or TimeIndex()
+        self.batch_size = batch_size or max(config.getint('REDIS', 'batch_size', fallback=500), 1)
+
+    @staticmethod
+    def add_data(pipe, data_key: str):
+        device_id, term_id, item_id = data_key.split(':')
+        pipe.sadd('SET:DEVICE_DATA:{}'.format(device_id), data_key)
+        pipe.sadd('SET:TERM_DATA:{}'.format(term_id), data_key)
+        pipe.sadd('SET:ITEM_DATA:{}'.format(item_id), data_key)
+
+    @staticmethod
+    def remove_data(pipe, data_key: str):
+        device_id, term_id, item_id = data_key.split(':')
+        pipe.srem('SET:DEVICE_DATA:{}'.format(device_id), data_key)
+        pipe.srem('SET:TERM_DATA:{}'.format(term_id), data_key)
+        pipe.srem('SET:ITEM_DATA:{}'.format(item_id), data_key)
+
+    @staticmethod
+    def add_mapping(pipe, mapping_key: str, term_item: dict):
+        device_id, term_id, item_id = mapping_ids(mapping_key, term_item)
+        pipe.sadd('SET:DEVICE_MAPPING:{}'.format(device_id), mapping_key)
+        pipe.sadd('SET:TERM_MAPPING:{}'.format(term_id), mapping_key)
+        pipe.sadd('SET:ITEM_MAPPING:{}'.format(item_id), mapping_key)
+
+    @staticmethod
+    def remove_mapping(pipe, mapping_key: str, term_item: dict):
+        device_id, term_id, item_id = mapping_ids(mapping_key, term_item)
+        pipe.srem('SET:DEVICE_MAPPING:{}'.format(device_id), mapping_key)
+        pipe.srem('SET:TERM_MAPPING:{}'.format(term_id), mapping_key)
+        pipe.srem('SET:ITEM_MAPPING:{}'.format(item_id), mapping_key)
+
+    @staticmethod
+    def add_term_item(pipe, term_id, item_id):
+        pipe.sadd('SET:TERM_ITEM:{}'.format(term_id), item_id)
+        pipe.sadd('SET:ITEM_TERM:{}'.format(item_id), term_id)
+
+    @staticmethod
+    def remove_term_item(pipe, term_id, item_id):
+        pipe.delete('HS:TERM_ITEM:{}:{}'.format(term_id, item_id))
+        pipe.srem('SET:TERM_ITEM:{}'.format(term_id), item_id)
+        pipe.srem('SET:ITEM_TERM:{}'.format(item_id), term_id)
+
+    async def delete_data(self, redis_pool, data_keys):
+        """
+        delete HS:DATA, time index, rollups and last value of data keys, batch_size keys in one pipeline
+        :param data_keys: {device_id}:{term_id}:{item_id}
+        :return: number of data keys deleted
+        """
+        data_keys = list(data_keys)
+        for idx in range(0, len(data_keys), self.batch_size):
+            batch = data_keys[idx:idx + self.batch_size]
+            pipe = redis_pool.pipeline()
+            for data_key in batch:
+                keys = ['HS:DATA:{}'.format(data_key), self.time_index.key(data_key)]
+                for period in ROLLUP_PERIODS:
+                    keys.append('HS:ROLLUP:{}:{}'.format(period, data_key))
+                    keys.append('HS:ROLLUP_COUNT:{}:{}'.format(period, data_key))
+                pipe.delete(*keys)
+                self.remove_data(pipe, data_key)
+            pipe.hdel('HS:LAST_VALUE', *batch)
+            await pipe.execute()
+        return len(data_keys)
+
+    async def delete_mappings(self, redis_pool, mapping_keys):
+        """
+        delete HS:MAPPING keys and remove them from every index set, two round trips for each batch_size keys
+        :return: number of mapping keys deleted
+        """
+        mapping_keys = list(mapping_keys)
+        for idx in range(0, len(mapping_keys), self.batch_size):
+            batch = mapping_keys[idx:idx + self.batch_size]
+            pipe = redis_pool.pipeline()
+            for mapping_key in batch:
+                pipe.hmget(mapping_key, 'term_id', 'item_id')
+            id_list = await pipe.execute()
+            pipe = redis_pool.pipeline()
+            for mapping_key, (term_id, item_id) in zip(batch, id_list):
+                if term_id is not None and item_id is not None:
+                    self.remove_mapping(pipe, mapping_key, {'term_id': term_id, 'item_id': item_id})
+            pipe.delete(*batch)
+            await pipe.execute()
+        return len(mapping_keys)
+
+    async def delete_term_items(self, redis_pool, term_items):
+        """
+        :param term_items: (term_id, item_id) of HS:TERM_ITEM to delete
+        """
+        term_items = list(term_items)
+        for idx in range(0, len(term_items), self.batch_size):
+            pipe = redis_pool.pipeline()
+            for term_id, item_id in term_items[idx:idx + self.batch_size]:
+                self.remove_term_item(pipe, term_id, item_id)
+            await pipe.execute()
+        return len(term_items)
+
+
+def rebuild(redis_client=None, batch_size: int = 1000):
+    """
+    build index sets from existing HS:MAPPING, HS:DATA and HS:TERM_ITEM, needed once for data written by
+    versions without index, safe to run while server running since all commands are SADD
+    :param redis_client: StrictRedis, default is get_sync_client()
+    :return: (mappings, data keys, term items) indexed
+    """
+    redis_client = redis_client or get_sync_client()
+    counts = list()
+    for match in ('HS:MAPPING:*', 'HS:DATA:*', 'HS:TERM_ITEM:*'):
+        count = 0
+        pipe = redis_client.pipeline(transaction=False)
+        for key in redis_client.scan_iter(match, count=batch_size):
+            if match == 'HS:MAPPING:*':
+                term_id, item_id = redis_client.hmget(key, 'term_id', 'item_id')
+                if term_id is None or item_id is None:
+                    continue
+                KeyIndex.add_mapping(pipe, key, {'term_id': term_id, 'item_id': item_id})
+            elif match == 'HS:DATA:*':
+                if key.count(':') != 4:
+                    continue
+                KeyIndex.add_data(pipe, key[8:])
+            else:
+                _, _, term_id, item_id = key.split(':')
+                KeyIndex.add_term_item(pipe, term_id, item_id)
+            count += 1
+            if count % batch_size == 0:
+                pipe.execute()
+        pipe.execute()
+        counts.append(count)
+    logger.info('rebuild: %s mappings, %s data keys, %s term items indexed', *counts)
+    return tuple(counts)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='PyDataColl reverse index rebuild')
+    parser.add_argument('--batch-size', type=int, default=1000, help='commands sent in one pipeline, default: 1000')
+    args = parser.parse_args()
+    print('{} mappings, {} data keys, {} term items indexed.'.format(*rebuild(batch_size=args.batch_size)))
+
+
+if __name__ == '__main__':
+    main()
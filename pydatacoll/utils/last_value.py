@@ -0,0 +1,54 @@
+#!/usr/bin/env python
+#
+# Copyright 2016 timercrack
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import math
+
+
+class LastValueStore(object):
+    """
+    Last value of every data key seen by a plugin, detect value changes without reading redis.
+    BaseDevice puts last_value into CHANNEL:DEVICE_DATA messages(and HS:LAST_VALUE), it's preferred when present.
+    """
+    def __init__(self, deadband: float = 1e-04):
+        self.deadband = deadband
+        self.value_dict = dict()  # {device_id}:{term_id}:{item_id} -> last value
+
+    def get_deadband(self, term_item: dict):
+        """
+        :param term_item: value of HS:TERM_ITEM, may contain 'deadband'
+        :return: relative tolerance of term_item, default deadband if not set
+        """
+        try:
+            return float(term_item['deadband'])
+        except (KeyError, TypeError, ValueError):
+            return self.deadband
+
+    def changed(self, data_dict: dict, deadband: float = None):
+        """
+        :param data_dict: message of CHANNEL:DEVICE_DATA
+        :param deadband: relative tolerance, value is unchanged when close to last value within it
+        :return: (whether value changed, last value or None)
+        """
+        key = '{}:{}:{}'.format(data_dict['device_id'], data_dict['term_id'], data_dict['item_id'])
+        value = float(data_dict['value'])
+        last_value = data_dict.get('last_value')
+        if last_value is None:
+            last_value = self.value_dict.get(key)
+        self.value_dict[key] = value
+        if last_value is None:
+            return True, None
+        deadband = self.deadband if deadband is None else deadband
+        return not math.isclose(value, float(last_value), rel_tol=deadband), last_value
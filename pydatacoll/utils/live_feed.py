@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+#
+# Copyright 2016 timercrack
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import asyncio
+import fnmatch
+import re
+from collections import OrderedDict
+
+
+class LiveFeed(object):
+    """
+    Live data queue of one client, messages of CHANNEL:DEVICE_DATA matching the glob patterns are queued.
+    the queue is bounded and never blocks publisher: only the latest message of each data key is kept(coalesced),
+    and the data key waiting longest is dropped when maxsize data keys are waiting.
+    usage:
+        feed = LiveFeed(['1:10:*'])
+        feed.put('1:10:20', msg)  # by dispatcher, if feed.match('1:10:20')
+        msg_list = await feed.get()  # by client writer
+    """
+    def __init__(self, patterns: list = None, maxsize: int = 1000, loop: asyncio.AbstractEventLoop = None):
+        self.maxsize = max(maxsize, 1)
+        self.pending = OrderedDict()  # {device_id}:{term_id}:{item_id} -> latest message
+        self.patterns = set()
+        self.regex_list = list()
+        self.event = asyncio.Event(loop=loop) if loop is not None else asyncio.Event()
+        self.closed = False
+        self.sent = 0
+        self.coalesced = 0
+        self.dropped = 0
+        if patterns:
+            self.subscribe(patterns)
+
+    def subscribe(self, patterns: list):
+        """
+        :param patterns: glob patterns of {device_id}:{term_id}:{item_id}, eg: 1:10:*
+        """
+        self.patterns.update(str(pattern) for pattern in patterns)
+        self.regex_list = [re.compile(fnmatch.translate(pattern)) for pattern in self.patterns]
+
+    def unsubscribe(self, patterns: list):
+        self.patterns.difference_update(str(pattern) for pattern in patterns)
+        self.regex_list = [re.compile(fnmatch.translate(pattern)) for pattern in self.patterns]
+
+    def match(self, data_key: str):
+        return any(regex.match(data_key) for regex in self.regex_list)
+
+    def put(self, data_key: str, msg: str):
+        if data_key in self.pending:
+            del self.pending[data_key]
+            self.coalesced += 1
+        elif len(self.pending) >= self.maxsize:
+            self.pending.popitem(last=False)
+            self.dropped += 1
+        self.pending[data_key] = msg
+        self.event.set()
+
+    async def get(self):
+        """
+        :return: all messages waiting in arrival order, empty list if closed
+        """
+        while not self.pending and not self.closed:
+            self.event.clear()
+            await self.event.wait()
+        if self.closed:
+            return list()
+        msg_list = list(self.pending.values())
+        self.pending.clear()
+        self.sent += len(msg_list)
+        return msg_list
+
+    def close(self):
+        self.closed = True
+        self.event.set()
+
+    @property
+    def stats(self):
+        return {'patterns': sorted(self.patterns), 'pending': len(self.pending), 'sent': self.sent,
+                'coalesced': self.coalesced, 'dropped': self.dropped}
@@ -27,6 +27,18 @@ config_example = """# PyDataColl configuration file
 web_port = 8080
 # http(s) request timeout in seconds
 web_timeout = 10
+# datas sent in one chunk of streamed response
+chunk_size = 1000
+# elements of v2 batch api written in one MULTI/EXEC, with one CHANNEL:*_ADD_BATCH message
+write_batch = 1000
+# results cached by datas aggregate API, cache of an item is dropped when new data arrive
+aggregate_cache = 256
+# items waiting in queue of each live data client, the item waiting longest is dropped when full
+live_queue_size = 1000
+# bytes buffered in socket of a live data client before waiting, values of an item are merged meanwhile
+live_buffer_size = 65536
+# seconds clients may cache API index(GET /) and OpenAPI document(GET /api/v1/openapi.json)
+doc_max_age = 300
 # installed plugins
 # plugins = device_manage, db_save, formula_calc
 plugins = device_manage, db_save, formula_calc
@@ -37,16 +49,45 @@ single_process = True
 [DBSaver]
 # whether save unchanged data
 save_unchanged = False
+# relative tolerance to tell whether data changed, overridden by 'deadband' of TERM_ITEM
+deadband = 0.0001
+# rows merged into one INSERT, buffer is flushed when full
+batch_size = 1000
+# seconds between two flushes of the write-behind buffer
+flush_interval = 0.5
 
 [FormulaCalc]
 # whether calculate unchanged parameter
 calc_unchanged = False
+# relative tolerance to tell whether parameter changed, overridden by 'deadband' of TERM_ITEM
+deadband = 0.0001
+
+[DataRetention]
+# max data points kept for each item, 0 means unlimited, overridden by 'keep_count' of TERM_ITEM
+keep_count = 0
+# max age of data points in seconds, 0 means unlimited, overridden by 'keep_age' of TERM_ITEM
+keep_age = 0
+# average expired points into rollup keys before removed, value=[hour, day, hour,day]
+# overridden by 'rollup' of TERM_ITEM
+rollup =
+# seconds between two runs, 0 means only run when CHANNEL:DATA_RETENTION published
+interval = 60
+# max points trimmed of each item in one run
+batch_size = 1000
+# items trimmed in one MULTI/EXEC
+key_batch = 100
 
 [IEC104]
 # data collection interval in seconds, default is 900(15 min)
 coll_interval = 900
 # log send/recv frame to redis for debug
 log_frame = True
+# frames of each priority(ctrl, call, task) waiting in send queue of a device, new frame is dropped when full
+send_queue_size = 1000
+# seconds a control or read command may wait in send queue, it is dropped instead of sent late
+send_timeout = 30
+# frames of higher priority sent in a row before one waiting frame of lower priority
+fair_share = 8
 # protocol parameters, don't modify it unless you know what it means
 T0 = 30
 T1 = 15
@@ -60,6 +101,17 @@ host = 127.0.0.1
 port = 6379
 db = 1
 encoding = utf-8
+# max data points sent to redis in one pipeline
+batch_size = 500
+# connections shared by all devices, plugins and api server of a process
+pool_minsize = 1
+pool_maxsize = 20
+# seconds to wait before subscribing channels again when pub/sub connection lost, doubled on each failure
+resubscribe_delay = 1
+# index of data times, value=[list, zset], list: LST:DATA_TIME in arrival order,
+# zset: ZS:DATA_TIME sorted by time, run pydatacoll-migrate after changed,
+# zset is needed to page datas by start/end, list loads and sorts the whole index for each page
+time_index = list
 
 [MYSQL]
 host = 127.0.0.1
@@ -67,6 +119,12 @@ port = 3306
 db = test
 user = pydatacoll
 password = pydatacoll
+# connections used by DBSaver
+pool_minsize = 1
+pool_maxsize = 10
+# times and interval(seconds) to reconnect when mysql is unavailable
+retry_count = 3
+retry_interval = 1
 
 [LOG]
 level = INFO
@@ -0,0 +1,458 @@
+#!/usr/bin/env python
+#
+# Copyright 2016 timercrack
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import asyncio
+from collections import defaultdict
+import time
+import aioredis
+import redis
+try:
+    import ujson as json
+except ImportError:
+    import json
+
+import pydatacoll.utils.logger as my_logger
+from pydatacoll.utils.read_config import *
+
+logger = my_logger.get_logger('RedisPool')
+
+
+def _flatten(value_dict: dict):
+    """
+    aioredis only accepts str, bytes, int and float arguments, convert others to str like redis-py does
+    :param value_dict: {field: value}
+    :return: [field1, value1, field2, value2...]
+    """
+    args = list()
+    for field, value in value_dict.items():
+        args.append(field)
+        args.append(value if isinstance(value, (str, bytes, int, float)) else str(value))
+    return args
+
+
+class Pipeline(object):
+    """
+    Buffer redis commands and send them in one round trip when execute() is awaited.
+    usage:
+        pipe = redis_client.pipeline()
+        pipe.hgetall('HS:DEVICE:1')
+        pipe.smembers('SET:DEVICE')
+        device_info, device_list = await pipe.execute()
+    """
+    def __init__(self, redis_pool, transaction=False):
+        self.redis_pool = redis_pool
+        self.transaction = transaction
+        self.command_list = list()
+
+    def __len__(self):
+        return len(self.command_list)
+
+    def __getattr__(self, name):
+        def command(*args, **kwargs):
+            self.command_list.append((name, args, kwargs))
+            return self
+        return command
+
+    def hmset_dict(self, key, value_dict: dict):
+        return self.hmset(key, *_flatten(value_dict))
+
+    async def execute(self):
+        """
+        :return: list of results, same order as commands queued
+        """
+        if not self.command_list:
+            return list()
+        command_list, self.command_list = self.command_list, list()
+        conn = await self.redis_pool.acquire()
+        try:
+            self.redis_pool.pipeline_count += 1
+            self.redis_pool.command_count += len(command_list)
+            pipe = conn.multi_exec() if self.transaction else conn.pipeline()
+            for name, args, kwargs in command_list:
+                getattr(pipe, name)(*args, **kwargs)
+            return await pipe.execute()
+        finally:
+            self.redis_pool.release(conn)
+
+
+class RedisPool(object):
+    """
+    Non-blocking redis client backed by an aioredis connection pool, commands have the same name as aioredis ones:
+        await redis_client.hgetall('HS:DEVICE:1')
+    each command borrows a connection from the pool, use pipeline() to send many commands in one round trip.
+    use get_redis_pool() to share one pool between all devices, plugins and the api server of an io_loop.
+    """
+    def __init__(self, io_loop: asyncio.AbstractEventLoop = None, minsize: int = None, maxsize: int = None):
+        self.io_loop = io_loop or asyncio.get_event_loop()
+        self.minsize = minsize or config.getint('REDIS', 'pool_minsize', fallback=1)
+        self.maxsize = max(maxsize or config.getint('REDIS', 'pool_maxsize', fallback=20), self.minsize)
+        self.pool = None
+        self.pool_lock = asyncio.Lock(loop=self.io_loop)
+        self.command_count = 0
+        self.pipeline_count = 0
+        self.acquire_wait = 0.0  # total seconds spent waiting for a free connection
+        self.acquire_wait_max = 0.0
+
+    async def get_pool(self):
+        if self.pool is None:
+            async with self.pool_lock:
+                if self.pool is None:
+                    self.pool = await aioredis.create_pool(
+                            (config.get('REDIS', 'host', fallback='localhost'),
+                             config.getint('REDIS', 'port', fallback=6379)),
+                            db=config.getint('REDIS', 'db', fallback=1),
+                            encoding=config.get('REDIS', 'encoding', fallback='utf-8'),
+                            minsize=self.minsize, maxsize=self.maxsize, loop=self.io_loop)
+        return self.pool
+
+    async def acquire(self):
+        pool = await self.get_pool()
+        start = time.monotonic()
+        conn = await pool.acquire()
+        wait = time.monotonic() - start
+        self.acquire_wait += wait
+        self.acquire_wait_max = max(self.acquire_wait_max, wait)
+        return conn
+
+    def release(self, conn):
+        self.pool.release(conn)
+
+    def __getattr__(self, name):
+        async def command(*args, **kwargs):
+            conn = await self.acquire()
+            try:
+                self.command_count += 1
+                return await getattr(conn, name)(*args, **kwargs)
+            finally:
+                self.release(conn)
+        command.__name__ = name
+        return command
+
+    def pipeline(self, transaction=False):
+        return Pipeline(self, transaction)
+
+    async def hmset_dict(self, key, value_dict: dict):
+        if value_dict:
+            return await self.hmset(key, *_flatten(value_dict))
+
+    async def scan_keys(self, match, count=1000):
+        """
+        :param match: key pattern, eg: HS:MAPPING:*
+        :param count: keys scanned in one round trip
+        :return: list of matched keys
+        """
+        keys = list()
+        conn = await self.acquire()
+        try:
+            cursor = 0
+            while True:
+                self.command_count += 1
+                cursor, found = await conn.scan(cursor, match=match, count=count)
+                keys.extend(found)
+                if not cursor:
+                    break
+        finally:
+            self.release(conn)
+        return keys
+
+    @property
+    def stats(self):
+        """
+        :return: pool usage metrics
+        """
+        size = self.pool.size if self.pool else 0
+        freesize = self.pool.freesize if self.pool else 0
+        return {'minsize': self.minsize, 'maxsize': self.maxsize, 'size': size, 'freesize': freesize,
+                'in_use': size - freesize, 'commands': self.command_count, 'pipelines': self.pipeline_count,
+                'acquire_wait': round(self.acquire_wait, 6), 'acquire_wait_max': round(self.acquire_wait_max, 6)}
+
+    async def close(self):
+        if self.pool is not None:
+            await self.pool.clear()
+            self.pool = None
+
+
+class Subscription(object):
+    """
+    A subscription borrowed from PubSubBroker, messages are queued until get() is called.
+    usage:
+        async with broker.subscribe('CHANNEL:DEVICE_CALL:1:10:1000') as sub:
+            await redis_client.publish(...)
+            channel, msg = await sub.get_json()
+    """
+    def __init__(self, broker, channel: str, pattern: bool = False, maxsize: int = 0):
+        self.broker = broker
+        self.channel = channel
+        self.pattern = pattern
+        self.queue = asyncio.Queue(maxsize=maxsize, loop=broker.io_loop)
+        self.dropped = 0
+
+    async def open(self):
+        await self.broker.add_subscription(self)
+        return self
+
+    async def close(self):
+        await self.broker.remove_subscription(self)
+
+    async def __aenter__(self):
+        return await self.open()
+
+    async def __aexit__(self, exc_type, exc_value, tb):
+        await self.close()
+
+    def put(self, msg):
+        try:
+            self.queue.put_nowait(msg)
+        except asyncio.QueueFull:
+            self.dropped += 1
+
+    def put_close(self):
+        """
+        put the close sentinel(None), the oldest message is dropped if queue is full so get() never hangs
+        """
+        if self.queue.full():
+            self.queue.get_nowait()
+            self.dropped += 1
+        self.queue.put_nowait(None)
+
+    async def get(self):
+        """
+        :return: (real_channel, message), None if subscription is closed
+        """
+        return await self.queue.get()
+
+    async def get_json(self):
+        msg = await self.queue.get()
+        if msg is None:
+            return None
+        return msg[0], json.loads(msg[1])
+
+
+class PubSubBroker(object):
+    """
+    Multiplex all subscriptions of an io_loop onto one redis pub/sub connection,
+    a channel(pattern) is subscribed from redis only once no matter how many Subscriptions refer to it.
+    Subscribing and unsubscribing of a channel are serialized by a lock of the channel, channels are subscribed
+    again on a new connection if the connection is lost, messages published before that are lost.
+    """
+    def __init__(self, io_loop: asyncio.AbstractEventLoop = None):
+        self.io_loop = io_loop or asyncio.get_event_loop()
+        self.sub_client = None
+        self.client_lock = asyncio.Lock(loop=self.io_loop)
+        self.subscription_dict = defaultdict(set)  # (pattern, channel) -> set of Subscription
+        self.reader_dict = dict()  # (pattern, channel) -> aioredis Channel read by _reader
+        self.lock_dict = dict()  # (pattern, channel) -> [Lock, number of users]
+        self.message_count = 0
+        self.resubscribe_count = 0
+        self.resubscribe_delay = config.getfloat('REDIS', 'resubscribe_delay', fallback=1)
+
+    async def get_client(self):
+        if self.sub_client is None or self.sub_client.closed:
+            async with self.client_lock:
+                if self.sub_client is None or self.sub_client.closed:
+                    self.sub_client = await aioredis.create_redis(
+                            (config.get('REDIS', 'host', fallback='localhost'),
+                             config.getint('REDIS', 'port', fallback=6379)),
+                            db=config.getint('REDIS', 'db', fallback=1), loop=self.io_loop)
+        return self.sub_client
+
+    def subscribe(self, channel: str, pattern: bool = False, maxsize: int = 0):
+        """
+        :param channel: channel name or pattern
+        :param pattern: psubscribe instead of subscribe
+        :param maxsize: max messages queued in subscription, newer messages are dropped when full
+        :return: Subscription, not subscribed until opened
+        """
+        return Subscription(self, channel, pattern, maxsize)
+
+    def _acquire_lock(self, key):
+        entry = self.lock_dict.get(key)
+        if entry is None:
+            entry = self.lock_dict[key] = [asyncio.Lock(loop=self.io_loop), 0]
+        entry[1] += 1
+        return entry[0]
+
+    def _release_lock(self, key):
+        entry = self.lock_dict[key]
+        entry[1] -= 1
+        if entry[1] == 0:
+            del self.lock_dict[key]
+
+    async def _subscribe(self, key):
+        pattern, channel = key
+        client = await self.get_client()
+        if pattern:
+            ch, = await client.psubscribe(channel)
+        else:
+            ch, = await client.subscribe(channel)
+        self.reader_dict[key] = ch
+        self.io_loop.create_task(self._reader(key, ch))
+
+    async def add_subscription(self, sub: Subscription):
+        key = (sub.pattern, sub.channel)
+        lock = self._acquire_lock(key)
+        try:
+            async with lock:
+                if key not in self.reader_dict:
+                    await self._subscribe(key)
+                self.subscription_dict[key].add(sub)
+        finally:
+            self._release_lock(key)
+
+    async def remove_subscription(self, sub: Subscription):
+        key = (sub.pattern, sub.channel)
+        lock = self._acquire_lock(key)
+        try:
+            async with lock:
+                sub_set = self.subscription_dict.get(key)
+                if sub_set is None or sub not in sub_set:
+                    return
+                sub_set.discard(sub)
+                sub.put_close()
+                if sub_set:
+                    return
+                del self.subscription_dict[key]
+                if self.reader_dict.pop(key, None) is not None and \
+                        self.sub_client is not None and not self.sub_client.closed:
+                    if sub.pattern:
+                        await self.sub_client.punsubscribe(sub.channel)
+                    else:
+                        await self.sub_client.unsubscribe(sub.channel)
+        finally:
+            self._release_lock(key)
+
+    async def _resubscribe(self, key):
+        """
+        subscribe key again after its connection lost, retry until succeed or nobody subscribes it
+        """
+        delay = self.resubscribe_delay
+        while True:
+            lock = self._acquire_lock(key)
+            try:
+                async with lock:
+                    if not self.subscription_dict.get(key) or key in self.reader_dict:
+                        return
+                    await self._subscribe(key)
+                    self.resubscribe_count += 1
+                    logger.info('resubscribe %s succeeded', key[1])
+                    return
+            except Exception as e:
+                logger.error('resubscribe %s failed: %s, retry after %s seconds', key[1], repr(e), delay)
+            finally:
+                self._release_lock(key)
+            await asyncio.sleep(delay, loop=self.io_loop)
+            delay = min(delay * 2, 30)
+
+    async def _reader(self, key, ch):
+        encoding = config.get('REDIS', 'encoding', fallback='utf-8')
+        pattern, channel = key
+        try:
+            await self._read(key, ch, encoding)
+        except Exception as e:
+            logger.error('_reader of %s failed: %s', channel, repr(e), exc_info=True)
+        if self.reader_dict.get(key) is not ch:  # unsubscribed or broker closed
+            return
+        del self.reader_dict[key]
+        logger.error('subscription of %s lost, resubscribing..', channel)
+        self.io_loop.create_task(self._resubscribe(key))
+
+    async def _read(self, key, ch, encoding):
+        pattern, channel = key
+        while await ch.wait_message():
+            if pattern:
+                real_channel, msg = await ch.get()
+                real_channel = real_channel.decode(encoding)
+            else:
+                real_channel, msg = channel, await ch.get()
+            if isinstance(msg, bytes):
+                msg = msg.decode(encoding)
+            self.message_count += 1
+            for sub in list(self.subscription_dict.get(key, ())):
+                sub.put((real_channel, msg))
+
+    @property
+    def stats(self):
+        return {'channels': len(self.subscription_dict),
+                'subscriptions': sum(len(sub_set) for sub_set in self.subscription_dict.values()),
+                'messages': self.message_count, 'resubscribes': self.resubscribe_count}
+
+    async def close(self):
+        for sub_set in self.subscription_dict.values():
+            for sub in sub_set:
+                sub.put_close()
+        self.subscription_dict.clear()
+        self.reader_dict.clear()
+        if self.sub_client is not None:
+            self.sub_client.close()
+            self.sub_client = None
+
+
+_redis_pool_dict = dict()  # io_loop -> RedisPool
+_broker_dict = dict()  # io_loop -> PubSubBroker
+_sync_pool = None
+
+
+def get_redis_pool(io_loop: asyncio.AbstractEventLoop = None) -> RedisPool:
+    """
+    :return: the RedisPool shared by everything running on io_loop
+    """
+    io_loop = io_loop or asyncio.get_event_loop()
+    if io_loop not in _redis_pool_dict:
+        _redis_pool_dict[io_loop] = RedisPool(io_loop)
+    return _redis_pool_dict[io_loop]
+
+
+def get_broker(io_loop: asyncio.AbstractEventLoop = None) -> PubSubBroker:
+    """
+    :return: the PubSubBroker shared by everything running on io_loop
+    """
+    io_loop = io_loop or asyncio.get_event_loop()
+    if io_loop not in _broker_dict:
+        _broker_dict[io_loop] = PubSubBroker(io_loop)
+    return _broker_dict[io_loop]
+
+
+def get_sync_client() -> redis.StrictRedis:
+    """
+    blocking client for scripts and tools running outside of an io_loop, all clients share one connection pool
+    """
+    global _sync_pool
+    if _sync_pool is None:
+        _sync_pool = redis.ConnectionPool(
+                host=config.get('REDIS', 'host', fallback='localhost'),
+                port=config.getint('REDIS', 'port', fallback=6379),
+                db=config.getint('REDIS', 'db', fallback=1),
+                max_connections=config.getint('REDIS', 'pool_maxsize', fallback=20),
+                decode_responses=True)
+    return redis.StrictRedis(connection_pool=_sync_pool)
+
+
+def redis_stats(io_loop: asyncio.AbstractEventLoop = None) -> dict:
+    """
+    :return: usage metrics of the shared pool and broker of io_loop
+    """
+    io_loop = io_loop or asyncio.get_event_loop()
+    return {'pool': get_redis_pool(io_loop).stats, 'pubsub': get_broker(io_loop).stats}
+
+
+async def close_redis_pool(io_loop: asyncio.AbstractEventLoop = None):
+    io_loop = io_loop or asyncio.get_event_loop()
+    broker = _broker_dict.pop(io_loop, None)
+    if broker is not None:
+        await broker.close()
+    redis_pool = _redis_pool_dict.pop(io_loop, None)
+    if redis_pool is not None:
+        await redis_pool.close()
@@ -0,0 +1,194 @@
+#!/usr/bin/env python
+#
+# Copyright 2016 timercrack
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import asyncio
+import uuid
+from collections import defaultdict
+try:
+    import ujson as json
+except ImportError:
+    import json
+
+import pydatacoll.utils.logger as my_logger
+
+logger = my_logger.get_logger('RPC')
+
+# fields added to request message by RPCClient.call
+RPC_ID = 'rpc_id'
+REPLY_TO = 'reply_to'
+
+
+def take_reply(msg_dict: dict):
+    """
+    remove rpc fields from a request message, called by responder before handling it
+    :return: (reply_to, rpc_id), (None, None) if sender is not a RPCClient
+    """
+    return msg_dict.pop(REPLY_TO, None), msg_dict.pop(RPC_ID, None)
+
+
+async def reply(redis_pool, reply_to: str, rpc_id: str, result):
+    """
+    send result of a request to its RPCClient
+    """
+    await redis_pool.publish(reply_to, json.dumps({RPC_ID: rpc_id, 'result': result}))
+
+
+class RPCClient(object):
+    """
+    Request/response over redis pub/sub with one long-lived subscription of PubSubBroker for all requests:
+        call(): request message carries rpc_id and reply_to(CHANNEL:RPC_REPLY:{client_id}), responder publishes
+                {rpc_id, result} to reply_to by reply(), response is routed to caller by rpc_id
+        call_channel(): for responders publishing to a fixed channel(eg: CHANNEL:DEVICE_CALL:{d}:{t}:{i}), the
+                pattern of reply channel is subscribed once, every caller waiting on that channel gets the message
+        call_channels(): call_channel() for many reply channels at once, results are taken as they arrive
+    usage:
+        rpc = RPCClient(broker, redis_pool, io_loop)
+        rst = await rpc.call('CHANNEL:FORMULA_CHECK', formula_dict, timeout=10)
+        await rpc.close()
+    """
+    def __init__(self, broker, redis_pool, io_loop: asyncio.AbstractEventLoop = None):
+        self.broker = broker
+        self.redis_pool = redis_pool
+        self.io_loop = io_loop or asyncio.get_event_loop()
+        self.reply_channel = 'CHANNEL:RPC_REPLY:{}'.format(uuid.uuid4().hex)
+        self.future_dict = dict()  # rpc_id -> Future
+        self.waiter_dict = defaultdict(set)  # reply channel of call_channel -> set of Future
+        self.sub_dict = dict()  # channel(pattern) -> (Subscription, reader task)
+        self.sub_lock = asyncio.Lock(loop=self.io_loop)
+        self.calls = 0
+        self.timeouts = 0
+
+    async def _listen(self, channel: str, pattern: bool):
+        if channel not in self.sub_dict:
+            async with self.sub_lock:
+                if channel not in self.sub_dict:
+                    sub = await self.broker.subscribe(channel, pattern=pattern).open()
+                    self.sub_dict[channel] = (sub, self.io_loop.create_task(self._reader(sub)))
+
+    async def _reader(self, sub):
+        while True:
+            msg = await sub.get()
+            if msg is None:
+                break
+            real_channel, msg = msg
+            try:
+                if real_channel == self.reply_channel:
+                    msg_dict = json.loads(msg)
+                    future = self.future_dict.pop(msg_dict.get(RPC_ID), None)
+                    if future is not None and not future.done():
+                        future.set_result(msg_dict.get('result'))
+                else:
+                    for future in self.waiter_dict.pop(real_channel, ()):
+                        if not future.done():
+                            future.set_result(msg)
+            except Exception as e:
+                logger.error('rpc reader failed: %s', repr(e), exc_info=True)
+
+    async def _wait(self, future, timeout: float):
+        self.calls += 1
+        try:
+            return await asyncio.wait_for(future, timeout, loop=self.io_loop)
+        except asyncio.TimeoutError:
+            self.timeouts += 1
+            raise
+
+    async def call(self, channel: str, msg_dict: dict, timeout: float = None):
+        """
+        :param channel: request channel of responder
+        :param msg_dict: request message, rpc_id and reply_to are added
+        :return: result published by responder
+        """
+        await self._listen(self.reply_channel, False)
+        rpc_id = uuid.uuid4().hex
+        future = asyncio.Future(loop=self.io_loop)
+        self.future_dict[rpc_id] = future
+        try:
+            request = dict(msg_dict)
+            request.update({RPC_ID: rpc_id, REPLY_TO: self.reply_channel})
+            await self.redis_pool.publish(channel, json.dumps(request))
+            return await self._wait(future, timeout)
+        finally:
+            self.future_dict.pop(rpc_id, None)
+
+    async def call_channel(self, channel: str, msg: str, reply_channel: str, reply_pattern: str,
+                           timeout: float = None):
+        """
+        :param msg: request message, sent as is
+        :param reply_channel: channel responder publishes to
+        :param reply_pattern: pattern covering reply_channel, subscribed once for all calls
+        :return: message of reply_channel
+        """
+        await self._listen(reply_pattern, True)
+        future = asyncio.Future(loop=self.io_loop)
+        self.waiter_dict[reply_channel].add(future)
+        try:
+            await self.redis_pool.publish(channel, msg)
+            return await self._wait(future, timeout)
+        finally:
+            self._discard(reply_channel, future)
+
+    def _discard(self, reply_channel: str, future):
+        waiters = self.waiter_dict.get(reply_channel)
+        if waiters is not None:
+            waiters.discard(future)
+            if not waiters:
+                del self.waiter_dict[reply_channel]
+
+    async def call_channels(self, channel: str, msg_list: list, reply_channels, reply_pattern: str):
+        """
+        fan-out version of call_channel: waiters of all reply channels are registered before msg_list is published
+        in one pipeline, caller takes results as they come(eg: by asyncio.wait) and must release() them at last
+        :param msg_list: request messages, sent as is
+        :param reply_channels: channels responders publish to, duplicated channels share one Future
+        :return: {reply_channel: Future}
+        """
+        await self._listen(reply_pattern, True)
+        future_dict = dict()
+        for reply_channel in reply_channels:
+            if reply_channel not in future_dict:
+                future_dict[reply_channel] = asyncio.Future(loop=self.io_loop)
+                self.waiter_dict[reply_channel].add(future_dict[reply_channel])
+        self.calls += len(future_dict)
+        try:
+            pipe = self.redis_pool.pipeline()
+            for msg in msg_list:
+                pipe.publish(channel, msg)
+            await pipe.execute()
+        except Exception:
+            self.release(future_dict)
+            raise
+        return future_dict
+
+    def release(self, future_dict: dict):
+        """
+        :param future_dict: returned by call_channels, Futures not done are cancelled and counted as timeout
+        """
+        for reply_channel, future in future_dict.items():
+            if not future.done():
+                future.cancel()
+                self.timeouts += 1
+            self._discard(reply_channel, future)
+
+    @property
+    def stats(self):
+        return {'pending': len(self.future_dict) + sum(len(waiters) for waiters in self.waiter_dict.values()),
+                'calls': self.calls, 'timeouts': self.timeouts, 'subscriptions': sorted(self.sub_dict)}
+
+    async def close(self):
+        for sub, task in self.sub_dict.values():
+            await sub.close()
+            await task
+        self.sub_dict.clear()
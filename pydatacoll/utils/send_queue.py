@@ -0,0 +1,138 @@
+#!/usr/bin/env python
+#
+# Copyright 2016 timercrack
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import time
+from asyncio import QueueFull
+from collections import deque
+
+# priority of frames, 0 is the highest
+PRIORITY_CTRL = 0  # control commands and link management
+PRIORITY_CALL = 1  # on-demand reads
+PRIORITY_TASK = 2  # periodic tasks: clock sync, interrogations
+PRIORITY_NAMES = ('ctrl', 'call', 'task')
+
+
+class SendQueue(object):
+    """
+    Frames waiting for the link of one device, only one frame is in flight(sent and waiting for confirmation):
+        * one bounded FIFO for each priority, put() raises QueueFull when the FIFO of the priority is full
+        * frames put with a timeout are dropped if still waiting after it, so stale commands are never sent
+        * the highest priority waiting is sent first, but a waiting lower priority is sent after being passed over
+          fair_share times, so periodic tasks are delayed by a busy operator but never starved
+    usage:
+        if queue.submit(frame, PRIORITY_CTRL, timeout=30):  # by sender
+            write(frame)  # link is idle, frame is in flight now
+        write(queue.pop())  # when in-flight frame confirmed, None if nothing waiting
+    """
+    def __init__(self, maxsize: int = 1000, fair_share: int = 8, clock=time.monotonic):
+        self.maxsize = max(maxsize, 1)
+        self.fair_share = max(fair_share, 1)
+        self.clock = clock
+        self.queues = [deque() for _ in PRIORITY_NAMES]  # (frame, put time, deadline)
+        self.passed = [0] * len(PRIORITY_NAMES)
+        self.inflight = None
+        self.sent = [0] * len(PRIORITY_NAMES)
+        self.expired = [0] * len(PRIORITY_NAMES)
+        self.rejected = [0] * len(PRIORITY_NAMES)
+        self.wait_total = [0.0] * len(PRIORITY_NAMES)
+        self.wait_max = [0.0] * len(PRIORITY_NAMES)
+
+    def __len__(self):
+        return sum(len(queue) for queue in self.queues)
+
+    @property
+    def busy(self):
+        return self.inflight is not None
+
+    def submit(self, frame, priority: int, timeout: float = None):
+        """
+        :param timeout: seconds frame may wait, None for never expire
+        :return: True if link is idle and frame is in flight now, False if queued
+        """
+        if self.inflight is None:
+            self._sent(priority, 0.0)
+            self.inflight = frame
+            return True
+        self.put(frame, priority, timeout)
+        return False
+
+    def put(self, frame, priority: int, timeout: float = None):
+        if len(self.queues[priority]) >= self.maxsize:
+            self.rejected[priority] += 1
+            raise QueueFull('{} queue is full'.format(PRIORITY_NAMES[priority]))
+        now = self.clock()
+        self.queues[priority].append((frame, now, None if timeout is None else now + timeout))
+
+    def pop(self):
+        """
+        in-flight frame is confirmed, take the next frame to send, expired frames are dropped
+        :return: frame in flight now, None if nothing waiting
+        """
+        self.inflight = None
+        now = self.clock()
+        for priority, queue in enumerate(self.queues):
+            while queue and queue[0][2] is not None and now > queue[0][2]:
+                queue.popleft()
+                self.expired[priority] += 1
+        priority = self._next_priority()
+        if priority is None:
+            return None
+        frame, put_time, _ = self.queues[priority].popleft()
+        self._sent(priority, now - put_time)
+        self.inflight = frame
+        return frame
+
+    def discard(self):
+        """
+        drop in-flight frame without sending the next one
+        """
+        frame, self.inflight = self.inflight, None
+        return frame
+
+    def clear(self):
+        self.inflight = None
+        for queue in self.queues:
+            queue.clear()
+        self.passed = [0] * len(PRIORITY_NAMES)
+
+    def _next_priority(self):
+        waiting = [priority for priority, queue in enumerate(self.queues) if queue]
+        if not waiting:
+            return None
+        for priority in reversed(waiting[1:]):
+            if self.passed[priority] >= self.fair_share:
+                break
+        else:
+            priority = waiting[0]
+        for passed in waiting:
+            self.passed[passed] = 0 if passed == priority else self.passed[passed] + 1
+        return priority
+
+    def _sent(self, priority: int, wait: float):
+        self.sent[priority] += 1
+        self.wait_total[priority] += wait
+        self.wait_max[priority] = max(self.wait_max[priority], wait)
+
+    @property
+    def stats(self):
+        """
+        :return: {priority name: counters}, wait_avg and wait_max are seconds between put and sent
+        """
+        return {name: {'pending': len(self.queues[priority]), 'sent': self.sent[priority],
+                       'expired': self.expired[priority], 'rejected': self.rejected[priority],
+                       'wait_avg': self.wait_total[priority] / self.sent[priority] if self.sent[priority] else 0.0,
+                       'wait_max': self.wait_max[priority]}
+                for priority, name in enumerate(PRIORITY_NAMES)}
@@ -0,0 +1,165 @@
+#!/usr/bin/env python
+#
+# Copyright 2016 timercrack
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import zlib
+try:
+    import ujson as json
+except ImportError:
+    import json
+
+from pydatacoll.utils.key_index import KeyIndex
+
+# record type -> required fields of data, records are exported in this order so references come first
+RECORD_TYPES = {
+    'item': ('id',),
+    'device': ('id', 'protocol'),
+    'term': ('id', 'device_id'),
+    'term_item': ('term_id', 'item_id'),
+    'mapping': ('term_id', 'item_id'),
+    'formula': ('id',),
+}
+EXPORT_ORDER = ('item', 'device', 'term', 'term_item', 'mapping', 'formula')
+GZIP_MAGIC = b'\x1f\x8b'
+
+
+def check_record(record, device_ids=None):
+    """
+    :param record: {'type': RECORD_TYPES, 'data': value of hash}, mapping has 'key' of HS:MAPPING too
+    :param device_ids: ids of known devices, device_id in mapping key must be one of them, None for no check
+    :return: error text, None if valid
+    """
+    if not isinstance(record, dict) or record.get('type') not in RECORD_TYPES:
+        return 'unknown record type'
+    data = record.get('data')
+    if not isinstance(data, dict):
+        return 'data is not an object'
+    missing = [field for field in RECORD_TYPES[record['type']] if data.get(field) in (None, '')]
+    if missing:
+        return 'missing {}'.format(', '.join(missing))
+    if record['type'] == 'mapping':
+        key_parts = str(record.get('key', '')).split(':')
+        if len(key_parts) != 5 or key_parts[:2] != ['HS', 'MAPPING']:
+            return 'invalid mapping key'
+        device_id = key_parts[3]
+        if str(data.get('device_id', device_id)) != device_id:
+            return 'device_id mismatch in mapping key and data'
+        if device_ids is not None and device_id not in device_ids:
+            return 'device_id of mapping key not found'
+    return None
+
+
+def queue_record(pipe, record: dict):
+    """
+    queue writes of one record into pipe, same keys as created by api server
+    """
+    data = record['data']
+    if record['type'] == 'item':
+        pipe.hmset_dict('HS:ITEM:{}'.format(data['id']), data)
+        pipe.sadd('SET:ITEM', data['id'])
+    elif record['type'] == 'device':
+        pipe.hmset_dict('HS:DEVICE:{}'.format(data['id']), data)
+        pipe.sadd('SET:DEVICE', data['id'])
+    elif record['type'] == 'term':
+        pipe.hmset_dict('HS:TERM:{}'.format(data['id']), data)
+        pipe.sadd('SET:TERM', data['id'])
+        pipe.sadd('SET:DEVICE_TERM:{}'.format(data['device_id']), data['id'])
+    elif record['type'] == 'term_item':
+        pipe.hmset_dict('HS:TERM_ITEM:{}:{}'.format(data['term_id'], data['item_id']), data)
+        KeyIndex.add_term_item(pipe, data['term_id'], data['item_id'])
+    elif record['type'] == 'mapping':
+        pipe.hmset_dict(record['key'], data)
+        KeyIndex.add_mapping(pipe, record['key'], data)
+    elif record['type'] == 'formula':
+        pipe.hmset_dict('HS:FORMULA:{}'.format(data['id']), data)
+        pipe.sadd('SET:FORMULA', data['id'])
+        for param, param_value in data.items():
+            if param.startswith('p'):
+                pipe.sadd('SET:FORMULA_PARAM:{}'.format(param_value), data['id'])
+
+
+class ModelWriter(object):
+    """
+    Encode records into JSON Lines, gzip compressed by default, one record each line:
+        {"type": "device", "data": {"id": "1", "name": "...", "protocol": "iec104"}}
+        {"type": "mapping", "key": "HS:MAPPING:IEC104:1:100", "data": {"term_id": "10", "item_id": "1000"}}
+    """
+    def __init__(self, compress: bool = True):
+        self.compressor = zlib.compressobj(6, zlib.DEFLATED, 31) if compress else None
+
+    def encode(self, records) -> bytes:
+        data = ''.join('{}\n'.format(json.dumps(record, ensure_ascii=False)) for record in records).encode('utf-8')
+        return self.compressor.compress(data) if self.compressor else data
+
+    def flush(self) -> bytes:
+        return self.compressor.flush() if self.compressor else b''
+
+
+class ModelReader(object):
+    """
+    Decode records written by ModelWriter chunk by chunk, gzip is detected from the first chunk,
+    ValueError is raised with line number at the first invalid record.
+    device of a mapping must be known before it, either in device_ids or a device record read before.
+    usage:
+        reader = ModelReader(device_ids)
+        records = reader.feed(chunk)  # for every chunk received
+        records = reader.close()  # the last line without line break
+    """
+    def __init__(self, device_ids=None):
+        """
+        :param device_ids: ids of devices already exist, eg: members of SET:DEVICE
+        """
+        self.device_ids = {str(device_id) for device_id in device_ids or ()}
+        self.decompressor = None
+        self.started = False
+        self.buffer = b''
+        self.line_no = 0
+
+    def feed(self, data: bytes) -> list:
+        if not self.started and data:
+            self.started = True
+            if data[:2] == GZIP_MAGIC:
+                self.decompressor = zlib.decompressobj(31)
+        if self.decompressor:
+            data = self.decompressor.decompress(data)
+        lines = (self.buffer + data).split(b'\n')
+        self.buffer = lines.pop()
+        return self._parse(lines)
+
+    def close(self) -> list:
+        if self.decompressor:
+            self.buffer += self.decompressor.flush()
+            if not self.decompressor.eof:
+                raise ValueError('line {}: truncated gzip stream'.format(self.line_no + 1))
+        lines, self.buffer = [self.buffer], b''
+        return self._parse(lines)
+
+    def _parse(self, lines: list) -> list:
+        records = list()
+        for line in lines:
+            self.line_no += 1
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line.decode('utf-8'))
+            except ValueError as e:
+                raise ValueError('line {}: {}'.format(self.line_no, e))
+            error = check_record(record, self.device_ids)
+            if error is not None:
+                raise ValueError('line {}: {}'.format(self.line_no, error))
+            if record['type'] == 'device':
+                self.device_ids.add(str(record['data']['id']))
+            records.append(record)
+        return records
@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+#
+# Copyright 2016 timercrack
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import re
+from string import Formatter
+
+from pydatacoll.utils import make_param
+
+# fields before these keywords are part of the statement (table name, columns), not values
+VALUE_KEYWORD = re.compile(r'\b(values|set|where)\b', re.IGNORECASE)
+
+
+def _in_quote(sql: str):
+    """
+    :return: quote char if sql ends inside a string literal, otherwise None
+    """
+    quote = None
+    escaped = False
+    for char in sql:
+        if escaped:
+            escaped = False
+        elif char == '\\':
+            escaped = True
+        elif quote is None and char in ("'", '"'):
+            quote = char
+        elif char == quote:
+            quote = None
+    return quote
+
+
+class SQLTemplate(object):
+    """
+    Compile db_save_sql/db_warn_sql of TERM_ITEM into a parameterized statement plus an argument extractor:
+        template:  insert into t(device_id,value) VALUES ('{PARAM.device_id}',{PARAM.value})
+        statement: insert into t(device_id,value) VALUES (%s,%s)
+        extract({'device_id': 1, 'value': 12.3}) -> ('1', 12.3)
+    statement is None when template can not be parameterized (eg: table name is a field),
+    render() it with str.format as before.
+    """
+    def __init__(self, template: str):
+        self.template = template
+        self.statement = None
+        self.fields = list()  # (name, quoted, conversion, format_spec)
+        try:
+            self.statement = self._compile()
+        except ValueError:
+            pass
+        if self.statement is None:
+            self.fields.clear()
+
+    def _compile(self):
+        parts = list(Formatter().parse(self.template))
+        sql_list = list()
+        strip_quote = False
+        for idx, (literal, field_name, format_spec, conversion) in enumerate(parts):
+            if strip_quote:
+                literal = literal[1:]
+                strip_quote = False
+            if field_name is None:
+                sql_list.append(literal.replace('%', '%%'))
+                continue
+            name = field_name[6:] if field_name.startswith('PARAM.') else ''
+            if not name.isidentifier() or '{' in format_spec:
+                return None
+            sql = ''.join(sql_list) + literal
+            if not VALUE_KEYWORD.search(sql):
+                return None
+            quoted = False
+            quote = _in_quote(sql)
+            if quote is not None:
+                next_literal = parts[idx + 1][0] if idx + 1 < len(parts) else ''
+                # only a field surrounded by quotes can be parameterized, eg: '{PARAM.time}'
+                if not literal.endswith(quote) or not next_literal.startswith(quote):
+                    return None
+                literal = literal[:-1]
+                quoted = strip_quote = True
+            sql_list.append(literal.replace('%', '%%'))
+            sql_list.append('%s')
+            self.fields.append((name, quoted, conversion, format_spec))
+        return ''.join(sql_list)
+
+    def extract(self, data_dict: dict):
+        """
+        :param data_dict: data message updated by TERM_ITEM
+        :return: arguments of statement
+        """
+        args = list()
+        for name, quoted, conversion, format_spec in self.fields:
+            value = data_dict[name]
+            if conversion == 'r':
+                value = repr(value)
+            elif conversion == 'a':
+                value = ascii(value)
+            elif conversion == 's':
+                value = str(value)
+            if format_spec:
+                value = format(value, format_spec)
+            args.append(str(value) if quoted else value)
+        return tuple(args)
+
+    def render(self, data_dict: dict):
+        """
+        :return: sql text formatted as str.format(PARAM=param)
+        """
+        return self.template.format(PARAM=make_param(data_dict))
@@ -0,0 +1,208 @@
+#!/usr/bin/env python
+#
+# Copyright 2016 timercrack
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import argparse
+import calendar
+import datetime
+
+from dateutil import parser as date_parser
+
+import pydatacoll.utils.logger as my_logger
+from pydatacoll.utils.read_config import *
+from pydatacoll.utils.redis_pool import get_sync_client
+
+logger = my_logger.get_logger('TimeIndex')
+
+TIME_INDEX_BACKENDS = {'list': 'LST:DATA_TIME:', 'zset': 'ZS:DATA_TIME:'}
+# rollup period -> length of datetime.isoformat() prefix used as bucket, eg: '2015-12-01T08' for hour
+ROLLUP_PERIODS = {'hour': 13, 'day': 10}
+
+
+def to_timestamp(time_str: str) -> float:
+    """
+    :param time_str: datetime.isoformat(), eg: '2015-12-01T08:50:15.000002'
+    :return: seconds since epoch, time without timezone is treated as UTC so score never depends on local DST
+    """
+    try:
+        dt = datetime.datetime.strptime(time_str, '%Y-%m-%dT%H:%M:%S.%f' if '.' in time_str else '%Y-%m-%dT%H:%M:%S')
+    except ValueError:
+        dt = date_parser.parse(time_str)
+        if dt.tzinfo is not None:
+            dt = dt.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+    return calendar.timegm(dt.timetuple()) + dt.microsecond / 1e6
+
+
+class TimeIndex(object):
+    """
+    Index of data times of HS:DATA:{device_id}:{term_id}:{item_id}, backend is set by [REDIS] time_index:
+        list: LST:DATA_TIME:{device_id}:{term_id}:{item_id}, times in arrival order, range lookup scans the list
+        zset: ZS:DATA_TIME:{device_id}:{term_id}:{item_id}, times scored by timestamp, ordered by time even if
+              data arrive out of order, range lookup is O(log N)
+    client of commands is redis_pool(returns awaitable) or a Pipeline of it(command queued).
+    """
+    def __init__(self, backend: str = None):
+        self.backend = backend or config.get('REDIS', 'time_index', fallback='list')
+        if self.backend not in TIME_INDEX_BACKENDS:
+            raise ValueError('unknown time_index backend: {}'.format(self.backend))
+        self.prefix = TIME_INDEX_BACKENDS[self.backend]
+
+    def key(self, data_key: str):
+        """
+        :param data_key: {device_id}:{term_id}:{item_id}
+        """
+        return self.prefix + data_key
+
+    def add(self, client, data_key: str, time_str: str):
+        if self.backend == 'zset':
+            return client.zadd(self.key(data_key), to_timestamp(time_str), time_str)
+        return client.rpush(self.key(data_key), time_str)
+
+    def count(self, client, data_key: str):
+        if self.backend == 'zset':
+            return client.zcard(self.key(data_key))
+        return client.llen(self.key(data_key))
+
+    def range(self, client, data_key: str, start: int = 0, stop: int = -1):
+        """
+        times by index, both start and stop are included, negative index counts from the latest
+        """
+        if self.backend == 'zset':
+            return client.zrange(self.key(data_key), start, stop)
+        return client.lrange(self.key(data_key), start, stop)
+
+    def trim(self, client, data_key: str, time_list: list):
+        """
+        remove expired times read by range(), they are the first len(time_list) times of list, zset removes them by
+        member since a late older time may have shifted ranks after they were read
+        """
+        if self.backend == 'zset':
+            return client.zrem(self.key(data_key), *time_list)
+        return client.ltrim(self.key(data_key), len(time_list), -1)
+
+    async def between(self, redis_pool, data_key: str, start: str = None, end: str = None, offset: int = 0,
+                      count: int = None):
+        """
+        :param start: datetime.isoformat(), None means no lower bound
+        :param end: datetime.isoformat(), None means no upper bound
+        :param offset: skip first offset times in range
+        :param count: max times returned, None means all
+        :return: times in [start, end] ordered by time(in arrival order for list without start and end),
+                 list loads and sorts the whole index when start or end is given, use zset to page large indexes
+        """
+        if start is None and end is None:
+            return await self.range(redis_pool, data_key, offset, -1 if count is None else offset + count - 1)
+        min_score = to_timestamp(start) if start else float('-inf')
+        max_score = to_timestamp(end) if end else float('inf')
+        if self.backend == 'zset':
+            if offset or count is not None:
+                return await redis_pool.zrangebyscore(self.key(data_key), min_score, max_score, offset=offset,
+                                                      count=-1 if count is None else count)
+            return await redis_pool.zrangebyscore(self.key(data_key), min_score, max_score)
+        time_list = await redis_pool.lrange(self.key(data_key), 0, -1)
+        time_list = [(to_timestamp(time_str), time_str) for time_str in time_list]
+        time_list = [time_str for score, time_str in sorted(time_list) if min_score <= score <= max_score]
+        return time_list[offset:] if count is None else time_list[offset:offset + count]
+
+    async def query(self, redis_pool, data_keys: list, start: str = None, end: str = None, latest: int = None):
+        """
+        times of many data keys in one pipeline
+        :param start: datetime.isoformat(), None means no lower bound
+        :param end: datetime.isoformat(), None means no upper bound
+        :param latest: only the latest times of each key, None means all
+        :return: list of time lists ordered by time(in arrival order for list without start and end), same order
+                 as data_keys
+        """
+        min_score = to_timestamp(start) if start else float('-inf')
+        max_score = to_timestamp(end) if end else float('inf')
+        pipe = redis_pool.pipeline()
+        for data_key in data_keys:
+            if start is None and end is None:
+                self.range(pipe, data_key, -latest if latest else 0, -1)
+            elif self.backend == 'zset' and latest:
+                pipe.zrevrangebyscore(self.key(data_key), max_score, min_score, offset=0, count=latest)
+            elif self.backend == 'zset':
+                pipe.zrangebyscore(self.key(data_key), min_score, max_score)
+            else:
+                pipe.lrange(self.key(data_key), 0, -1)
+        rst = await pipe.execute()
+        if start is None and end is None:
+            return rst
+        if self.backend == 'zset':
+            return [time_list[::-1] for time_list in rst] if latest else rst
+        filtered = list()
+        for time_list in rst:
+            time_list = sorted((to_timestamp(time_str), time_str) for time_str in time_list)
+            time_list = [time_str for score, time_str in time_list if min_score <= score <= max_score]
+            filtered.append(time_list[-latest:] if latest else time_list)
+        return filtered
+
+
+def migrate(backend: str, delete: bool = False, batch_size: int = 1000, redis_client=None):
+    """
+    copy every time index of the other backend into backend, zset is safe to migrate into while server running
+    (switch [REDIS] time_index first so new data go to zset), stop server before migrating into list.
+    :param backend: target backend, list or zset
+    :param delete: delete source keys after migrated
+    :param batch_size: times sent in one command
+    :param redis_client: StrictRedis, default is get_sync_client()
+    :return: number of keys migrated
+    """
+    redis_client = redis_client or get_sync_client()
+    target = TimeIndex(backend)
+    source = TimeIndex('list' if backend == 'zset' else 'zset')
+    migrated = 0
+    for key in redis_client.scan_iter(source.prefix + '*', count=batch_size):
+        data_key = key[len(source.prefix):]
+        time_list = redis_client.lrange(key, 0, -1) if source.backend == 'list' else redis_client.zrange(key, 0, -1)
+        score_dict = dict()
+        for time_str in time_list:
+            try:
+                score_dict[time_str] = to_timestamp(time_str)
+            except (ValueError, OverflowError):
+                logger.warning('migrate %s: invalid time %s ignored', key, time_str)
+        pipe = redis_client.pipeline(transaction=True)
+        if target.backend == 'zset':
+            pairs = list()
+            for time_str, score in score_dict.items():
+                pairs.extend((score, time_str))
+            for idx in range(0, len(pairs), batch_size * 2):
+                pipe.execute_command('ZADD', target.key(data_key), *pairs[idx:idx + batch_size * 2])
+        else:
+            for time_str in redis_client.lrange(target.key(data_key), 0, -1):
+                score_dict.setdefault(time_str, to_timestamp(time_str))
+            time_list = sorted(score_dict, key=score_dict.get)
+            pipe.delete(target.key(data_key))
+            for idx in range(0, len(time_list), batch_size):
+                pipe.rpush(target.key(data_key), *time_list[idx:idx + batch_size])
+        if delete:
+            pipe.delete(key)
+        pipe.execute()
+        migrated += 1
+    logger.info('migrate: %s keys migrated from %s to %s', migrated, source.backend, target.backend)
+    return migrated
+
+
+def main():
+    parser = argparse.ArgumentParser(description='PyDataColl time index migration')
+    parser.add_argument('--to', choices=sorted(TIME_INDEX_BACKENDS), default='zset',
+                        help='target backend, default: zset')
+    parser.add_argument('--delete', action='store_true', help='delete source keys after migrated')
+    parser.add_argument('--batch-size', type=int, default=1000, help='times sent in one command, default: 1000')
+    args = parser.parse_args()
+    print('{} keys migrated to {}.'.format(migrate(args.to, args.delete, args.batch_size), args.to))
+
+if __name__ == '__main__':
+    main()
@@ -30,6 +30,7 @@ kwargs['version'] = version
 
 kwargs['install_requires'] = [
     'aiohttp>=0.20.1',
+    'aiomysql>=0.0.6',
     'aioredis>=0.2.4',
     'cchardet>=1.0.0',
     'construct>=2.5.2',
@@ -51,6 +52,8 @@ setup(
     entry_points={
         'console_scripts': [
             'pydatacoll = pydatacoll.api_server:main',
+            'pydatacoll-migrate = pydatacoll.utils.time_index:main',
+            'pydatacoll-reindex = pydatacoll.utils.key_index:main',
         ],
         'setuptools.installation': [
             'eggsecutable = pydatacoll.api_server:main',
@@ -0,0 +1,53 @@
+import argparse
+import datetime
+import timeit
+
+from pydatacoll.protocols.iec104.frame import *
+from pydatacoll.protocols.iec104.codec import decode, encode
+
+
+def interrogation_frame(typ: TYP, count: int, sq: int = 0):
+    """
+    :param count: objects in frame, APDU is at most 253 bytes
+    :return: encoded response of station interrogation carrying count objects of typ
+    """
+    frame = iec_104.init_frame(100, 20, typ, Cause.introgen, sq_count=count, sq=sq)
+    frame.ASDU.StartAddress = 1000
+    for idx, obj in enumerate(frame.ASDU.data):
+        if 'address' in obj:
+            obj.address = 1000 + idx
+        obj.value = idx % 2 if typ == TYP.M_SP_NA_1 else idx * 1.5 if typ in (TYP.M_ME_NC_1, TYP.M_ME_TF_1) else idx
+        if 'cp56time2a' in obj:
+            obj.cp56time2a = datetime.datetime.now()
+    return iec_104.build_isu(frame)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='IEC 104 frame codec benchmark')
+    parser.add_argument('-n', type=int, default=200, help='frames decoded or encoded in each round, default: 200')
+    args = parser.parse_args()
+    for name, data in (('M_SP_NA_1 sq=1', interrogation_frame(TYP.M_SP_NA_1, 127, sq=1)),
+                       ('M_ME_NB_1 sq=1', interrogation_frame(TYP.M_ME_NB_1, 80, sq=1)),
+                       ('M_ME_NC_1 sq=0', interrogation_frame(TYP.M_ME_NC_1, 30)),
+                       ('M_ME_TF_1 sq=0', interrogation_frame(TYP.M_ME_TF_1, 16))):
+        objects = decode(data).ASDU.sq_count
+        print('{}: {} bytes, {} objects per frame'.format(name, len(data), objects))
+        costs = list()
+        for func in (iec_104.parse, decode):
+            cost = min(timeit.repeat(lambda: func(data), number=args.n, repeat=3)) / args.n
+            costs.append(cost)
+            print('    {:<16} {:9.1f}us per frame, {:10.0f} objects/s'.format(
+                    func.__qualname__, cost * 1e6, objects / cost))
+        print('    speedup: {:.1f}x'.format(costs[0] / costs[1]))
+    for name, frame in (('S', iec_104.init_frame("S", 74)),
+                        ('TESTFR_CON', iec_104.init_frame(UFrame.TESTFR_CON)),
+                        ('C_SC_NA_1', iec_104.init_frame(105, 3, TYP.C_SC_NA_1, Cause.act)),
+                        ('C_CS_NA_1', iec_104.init_frame(105, 3, TYP.C_CS_NA_1, Cause.act)),
+                        ('M_ME_NC_1 sq=0', iec_104.parse(interrogation_frame(TYP.M_ME_NC_1, 30)))):
+        print('{}: {} bytes'.format(name, len(encode(frame))))
+        costs = list()
+        for func in (iec_104.build_isu, encode):
+            cost = min(timeit.repeat(lambda: func(frame), number=args.n, repeat=3)) / args.n
+            costs.append(cost)
+            print('    {:<16} {:9.1f}us per frame'.format(func.__qualname__, cost * 1e6))
+        print('    speedup: {:.1f}x'.format(costs[0] / costs[1]))
@@ -15,6 +15,7 @@
 import datetime
 import redis
 from pydatacoll.utils.read_config import *
+from pydatacoll.utils.key_index import rebuild
 
 test_formula = {'id': '9', 'formula': 'p1+p2', 'device_id': '2', 'term_id': '30', 'item_id': '2000',
                 'p1': '1:10:1000',
@@ -122,3 +123,4 @@ def generate():
     redis_client.hmset("HS:DATA:1:10:2000", device1_term10_item2000)
     redis_client.hmset("HS:DATA:1:20:1000", device1_term20_item1000)
     redis_client.hmset("HS:DATA:2:30:1000", device2_term30_item1000)
+    rebuild(redis_client)
@@ -0,0 +1,30 @@
+import argparse
+from collections import namedtuple
+import datetime
+import timeit
+
+from pydatacoll.utils import make_param
+
+DATA_DICT = {
+    'device_id': '1', 'term_id': '10', 'item_id': '20', 'time': datetime.datetime.now().isoformat(), 'value': 123.4,
+    'protocol_code': '100', 'code_type': '36', 'down_limit': '50', 'up_limit': '100', 'warn_msg': 'value error!',
+}
+
+
+def namedtuple_per_message():
+    return namedtuple('Param', DATA_DICT.keys())(**DATA_DICT)
+
+
+def cached_param():
+    return make_param(DATA_DICT)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='param record benchmark')
+    parser.add_argument('-n', type=int, default=10000, help='messages per second, default: 10000')
+    args = parser.parse_args()
+    budget = 1e6 / args.n  # microseconds available for one message
+    print('{} msgs/s, {:.1f}us per message'.format(args.n, budget))
+    for func in (namedtuple_per_message, cached_param):
+        cost = min(timeit.repeat(func, number=args.n, repeat=3)) / args.n * 1e6
+        print('{:<24} {:8.2f}us per message, {:5.1f}% of budget'.format(func.__name__, cost, cost / budget * 100))
@@ -0,0 +1,54 @@
+import asyncio
+import datetime
+try:
+    import ujson as json
+except ImportError:
+    import json
+import asynctest
+import redis
+import pydatacoll.utils.logger as my_logger
+import pydatacoll.plugins.data_retention as data_retention
+from pydatacoll.utils.read_config import *
+
+logger = my_logger.get_logger('DataRetentionTest')
+
+
+class DataRetentionTest(asynctest.TestCase):
+    loop = None  # make pycharm happy
+
+    def setUp(self):
+        super(DataRetentionTest, self).setUp()
+        self.redis_client = redis.StrictRedis(db=config.getint('REDIS', 'db', fallback=1), decode_responses=True)
+        self.redis_client.flushdb()
+        self.retention = data_retention.DataRetention(self.loop)
+        self.retention.interval = 0
+        self.loop.run_until_complete(self.retention.install())
+        start_time = datetime.datetime(2016, 1, 1, 8)
+        self.time_list = [(start_time + datetime.timedelta(minutes=30 * idx)).isoformat() for idx in range(10)]
+        for idx, time_str in enumerate(self.time_list):
+            self.redis_client.rpush('LST:DATA_TIME:1:10:20', time_str)
+            self.redis_client.hset('HS:DATA:1:10:20', time_str, idx)
+
+    def tearDown(self):
+        self.loop.run_until_complete(self.retention.uninstall())
+
+    async def test_keep_count(self):
+        self.redis_client.hmset('HS:TERM_ITEM:10:20', {'term_id': 10, 'item_id': 20, 'keep_count': 4})
+        self.assertEqual(await self.retention.retain(), 6)
+        self.assertEqual(self.redis_client.lrange('LST:DATA_TIME:1:10:20', 0, -1), self.time_list[6:])
+        self.assertEqual(sorted(self.redis_client.hkeys('HS:DATA:1:10:20')), self.time_list[6:])
+        self.assertEqual(await self.retention.retain(), 0)
+        self.assertEqual(self.redis_client.hget('HS:DATA_RETENTION', 'trimmed'), '6')
+
+    async def test_keep_age_rollup(self):
+        self.redis_client.hmset('HS:TERM_ITEM:10:20', {
+            'term_id': 10, 'item_id': 20, 'keep_age': 3600, 'rollup': 'hour,day'})
+        self.redis_client.publish('CHANNEL:DATA_RETENTION', json.dumps({}))
+        await asyncio.sleep(0.5)
+        self.assertEqual(self.redis_client.llen('LST:DATA_TIME:1:10:20'), 0)
+        self.assertFalse(self.redis_client.exists('HS:DATA:1:10:20'))
+        rollup = self.redis_client.hgetall('HS:ROLLUP:hour:1:10:20')
+        self.assertEqual(len(rollup), 5)
+        self.assertAlmostEqual(float(rollup['2016-01-01T08']), 0.5)
+        self.assertEqual(self.redis_client.hget('HS:ROLLUP_COUNT:hour:1:10:20', '2016-01-01T12'), '2')
+        self.assertAlmostEqual(float(self.redis_client.hget('HS:ROLLUP:day:1:10:20', '2016-01-01')), 4.5)
@@ -84,6 +84,42 @@ CREATE TABLE test_data_check(
         self.assertEqual(len(rst), 1)
         self.assertEqual(rst[0][5], 123.4)
 
+    async def test_batch_save(self):
+        self.redis_client.hmset('HS:TERM_ITEM:10:20', {
+            'term_id': 10, 'item_id': 20, 'protocol_code': 100, 'code_type': 36,
+            'db_save_sql': "insert into test_db_save(device_id,term_id,item_id,time,value) VALUES "
+                           "('{PARAM.device_id}','{PARAM.term_id}','{PARAM.item_id}','{PARAM.time}',{PARAM.value})"
+        })
+        self.db_saver.batch_size = 3
+        flush_count = self.db_saver.flush_count
+        for value in range(5):
+            time_str = datetime.datetime.now().isoformat()
+            self.redis_client.rpush('LST:DATA_TIME:1:10:20', time_str)
+            self.redis_client.hset('HS:DATA:1:10:20', time_str, value)
+            self.redis_client.publish('CHANNEL:DEVICE_DATA:1:10:20', json.dumps({
+                'device_id': 1, 'term_id': 10, 'item_id': 20, 'time': time_str, 'value': value}))
+        await asyncio.sleep(1)
+        self.assertEqual(self.db_saver.queue_depth, 0)
+        self.assertGreaterEqual(self.db_saver.flush_count - flush_count, 2)
+        self.assertGreater(self.db_saver.stats['flush_latency_max'], 0)
+        self.cursor.execute("SELECT value FROM test_db_save ORDER BY value")
+        rst = self.cursor.fetchall()
+        self.assertEqual([row[0] for row in rst], [0, 1, 2, 3, 4])
+
+    async def test_reconnect(self):
+        await self.db_saver.execute("insert into test_db_save(value) VALUES (1)")
+        pool = await self.db_saver.get_pool()
+        conn = await pool.acquire()
+        cursor = await conn.cursor()
+        await cursor.execute('SELECT CONNECTION_ID()')
+        conn_id, = await cursor.fetchone()
+        pool.release(conn)
+        self.cursor.execute('KILL {}'.format(conn_id))
+        await self.db_saver.execute("insert into test_db_save(value) VALUES (%s)", (2,))
+        self.cursor.execute("SELECT value FROM test_db_save ORDER BY value")
+        rst = self.cursor.fetchall()
+        self.assertEqual([row[0] for row in rst], [1, 2])
+
     async def test_data_check(self):
         term_item = {
             'term_id': 10, 'item_id': 20, 'protocol_code': 100, 'code_type': 36, 'down_limit': 50, 'up_limit': 100,
@@ -4,7 +4,7 @@ import asynctest
 import redis
 
 import pydatacoll.utils.logger as my_logger
-from pydatacoll.protocols.iec104.device import IEC104Device
+from pydatacoll.protocols.iec104.device import IEC104Device, code_runs
 from pydatacoll.protocols.iec104.frame import *
 from test.mock_device.iec104device import IEC104Device as MockDevice, create_servers
 from test.mock_device import mock_data
@@ -44,6 +44,7 @@ class IEC104DeviceTest(asynctest.TestCase):
         device.disconnect(reconnect=True)
         self.assertEqual(device.user_canceled, False)
         self.assertEqual(device.connected, False)
+        await asyncio.sleep(0.1)
         status = self.redis_client.hget('HS:DEVICE:1', 'status')
         self.assertEqual(status, 'off')
         await device.data_link_established
@@ -65,7 +66,7 @@ class IEC104DeviceTest(asynctest.TestCase):
         await device.data_link_established
         send_data = iec_104.init_frame(device.ssn, device.rsn, TYP.C_CS_NA_1, Cause.act)  # 103 时钟同步命令
         await device.send_frame(send_data)
-        self.assertEqual(device.send_list[0].ASDU.TYP, TYP.C_CS_NA_1)
+        self.assertEqual(device.send_queue.inflight.ASDU.TYP, TYP.C_CS_NA_1)
         await device.time_synced
         self.assertEqual(self.redis_client.llen('LST:FRAME:2'), 4)
         recv_frame = MockDevice.frame_list['2'][2]
@@ -83,7 +84,7 @@ class IEC104DeviceTest(asynctest.TestCase):
         # 100 总召唤
         send_data = iec_104.init_frame(device.ssn, device.rsn, TYP.C_IC_NA_1, Cause.act)
         await device.send_frame(send_data)
-        self.assertEqual(device.send_list[0].ASDU.TYP, TYP.C_IC_NA_1)
+        self.assertEqual(device.send_queue.inflight.ASDU.TYP, TYP.C_IC_NA_1)
         await device.all_data_called
         self.assertEqual(len(MockDevice.frame_list['1']), 8)  # 2U + 3I(call_all) + 3(call_all_data) = 8
         device.disconnect()
@@ -99,7 +100,7 @@ class IEC104DeviceTest(asynctest.TestCase):
     #     # 101 电能量召唤
     #     send_data = iec_104.init_frame(device.ssn, device.rsn, TYP.C_CI_NA_1, Cause.act)
     #     await device.send_frame(send_data)
-    #     self.assertEqual(device.send_list[0].ASDU.TYP, TYP.C_CI_NA_1)
+    #     self.assertEqual(device.send_queue.inflight.ASDU.TYP, TYP.C_CI_NA_1)
     #     await asyncio.sleep(3)
     #     self.assertEqual(len(MockDevice.frame_list[1]), 16)  # 2U + 1S + 3I(call_power) + 10I(power data) = 16
     #     device.disconnect()
@@ -155,3 +156,57 @@ class IEC104DeviceTest(asynctest.TestCase):
 
         self.assertAlmostEqual(rst['value'], 102, delta=0.0001)
         device.disconnect()
+
+    async def test_process_data_batch(self):
+        device = IEC104Device(mock_data.device1, self.loop)
+        device.batch_size = 2
+        data_time = datetime.datetime.now()
+        time_count = self.redis_client.llen('LST:DATA_TIME:1:20:1000')
+        await device.process_data({(data_time, 100, 220.5), (data_time, 200, 1), (data_time, 300, 99.9),
+                                   (data_time, 999, 0)})
+        self.assertEqual(self.redis_client.hget('HS:DATA:1:10:1000', data_time.isoformat()), '220.5')
+        self.assertEqual(self.redis_client.hget('HS:DATA:1:10:2000', data_time.isoformat()), '1.0')
+        self.assertEqual(self.redis_client.hget('HS:DATA:1:20:1000', data_time.isoformat()), '99.9')
+        self.assertEqual(self.redis_client.lindex('LST:DATA_TIME:1:20:1000', -1), data_time.isoformat())
+        self.assertEqual(self.redis_client.llen('LST:DATA_TIME:1:20:1000'), time_count + 1)
+        device.disconnect()
+
+    async def test_mapping_cache(self):
+        device = IEC104Device(mock_data.device1, self.loop)
+        await device.data_link_established
+        self.assertEqual(device.mapping_stats['size'], 3)
+        data_time = datetime.datetime.now()
+        await device.process_data({(data_time, 100, 220.5), (data_time, 400, 1)})
+        self.assertEqual(device.mapping_hit, 1)
+        self.assertEqual(device.mapping_miss, 1)
+        self.assertEqual(device.last_value_dict['1:10:1000'], 220.5)
+        device.fresh_task(None, {'device_id': '1', 'term_id': '10', 'item_id': '1000'}, delete=True)
+        self.assertNotIn('100', device.mapping_dict)
+        self.assertNotIn('1:10:1000', device.last_value_dict)
+        device.fresh_task(None, {'device_id': '1', 'term_id': '10', 'item_id': '1000', 'protocol_code': 101}, False)
+        self.assertEqual(device.mapping_dict['101']['item_id'], '1000')
+        device.fresh_task({'device_id': '1', 'term_id': '10'}, None, delete=True)
+        self.assertEqual(device.mapping_stats['size'], 1)
+        device.disconnect()
+
+    async def test_prepare_call_frames(self):
+        self.assertEqual(code_runs([5, 1, 2, 3, 3, 7, 8]), [(1, 3), (5, 1), (7, 2)])
+        self.assertEqual(code_runs(range(300)), [(0, 127), (127, 127), (254, 46)])
+        device = IEC104Device(mock_data.device1, self.loop)
+        await device.data_link_established
+        frame_list = device.prepare_call_frames([mock_data.term10_item1000, mock_data.term20_item1000])
+        self.assertEqual([frame.ASDU.TYP for frame in frame_list], [TYP.C_RD_NA_1, TYP.C_RD_NA_1])
+        self.assertEqual([frame.ASDU.data[0].address for frame in frame_list], [100, 300])
+        term_item_list = [dict(mock_data.term10_item1000, protocol_code=code) for code in range(100, 110)]
+        frame_list = device.prepare_call_frames(term_item_list)
+        self.assertEqual([frame.ASDU.TYP for frame in frame_list], [TYP.C_IC_NA_1])
+        self.assertEqual(device.interrogation['codes'], set(range(100, 110)))
+        # join the interrogation not confirmed yet, or the next one if its data have begun
+        self.assertEqual(device.prepare_call_frames(term_item_list[5:] + [dict(term_item_list[0], protocol_code=120)]
+                                                    + term_item_list[:5]), [])
+        self.assertEqual(device.interrogation['codes'], set(range(100, 110)) | {120})
+        device.interrogation['confirmed'] = True
+        self.assertIsNone(device.join_interrogation(task=True))
+        self.assertEqual(device.next_interrogation, {'confirmed': False, 'task': True, 'codes': set()})
+        self.assertFalse(device.interrogation['task'])
+        device.disconnect()
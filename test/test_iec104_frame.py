@@ -1,6 +1,7 @@
 import unittest
 
 from pydatacoll.protocols.iec104.frame import *
+from pydatacoll.protocols.iec104.codec import decode, encode, OBJECT_FORMATS, QUALITY_IV
 
 soe_bin = b"\x68\x15\x1a\x00\x06\x00\x1e\x01\x03\x00\x01\x00\x08\x00\x00\x00\xad\x39\x1c\x10\xda\x0b\x05"
 i_bin = b"\x68\x0e\xe8\x00\x06\x00\x65\x01\x0a\x00\x01\x00\x00\x00\x00\x05"
@@ -151,3 +152,92 @@ class IEC104Test(unittest.TestCase):
         re_build = iec_104.build(parse)
         # print("re_build=", re_build.hex())
         self.assertEqual(re_build, build)
+
+    def assert_same_decode(self, data):
+        expected = iec_104.parse(data)
+        frame = decode(data)
+        self.assertEqual((frame.APCI1, frame.APCI2), (expected.APCI1, expected.APCI2))
+        if expected.ASDU is None:
+            self.assertIsNone(frame.ASDU)
+            return
+        for name in ('TYP', 'sq', 'sq_count', 'Cause', 'GlobalAddress'):
+            self.assertEqual(getattr(frame.ASDU, name), getattr(expected.ASDU, name))
+        self.assertEqual(len(frame.ASDU.data), expected.ASDU.sq_count)
+        for idx, (obj, (address, value, quality, data_time)) in enumerate(zip(expected.ASDU.data, frame.ASDU.data)):
+            if 'address' in obj:
+                self.assertEqual(address, expected.ASDU.StartAddress + idx if obj.address is None else obj.address)
+            if 'value' in obj:
+                self.assertEqual(value, obj.value)
+            if 'IV' in obj:
+                self.assertEqual(bool(quality & QUALITY_IV), bool(obj.IV))
+            if 'se' in obj:
+                self.assertEqual(bool(quality & 0x80), bool(obj.se))
+            if 'cp56time2a' in obj:
+                self.assertEqual(data_time, obj.cp56time2a)
+            elif 'cp24time2a' in obj:
+                self.assertEqual((data_time.minute, data_time.second, data_time.microsecond),
+                                 (obj.cp24time2a.minute, obj.cp24time2a.second, obj.cp24time2a.microsecond))
+            else:
+                self.assertIsNone(data_time)
+
+    def test_fast_decode(self):
+        for data in (soe_bin, i_bin, s_bin, u_bin, i_big):
+            self.assert_same_decode(data)
+        data_time = datetime.datetime(2016, 3, 1, 12, 30, 15, 123000)
+        float_types = (TYP.M_ME_NC_1, TYP.M_ME_TC_1, TYP.M_ME_TF_1, TYP.C_SE_NC_1, TYP.C_SE_TC_1)
+        for typ in TYP:
+            for sq in (0, 1):
+                frame = iec_104.init_frame(10, 20, typ, Cause.spont, sq_count=3, sq=sq)
+                frame.ASDU.StartAddress = 0x10203
+                for idx, obj in enumerate(frame.ASDU.data):
+                    if 'address' in obj:
+                        obj.address = 0x30201 + idx
+                    if 'value' in obj:
+                        if OBJECT_FORMATS[typ][3]:  # value mask is set if value is a bit field
+                            obj.value = idx % 2
+                        else:
+                            obj.value = idx + 1.5 if typ in float_types else idx + 1000
+                    for flag in ('IV', 'se'):
+                        if flag in obj:
+                            obj[flag] = idx % 2
+                    if 'cp56time2a' in obj:
+                        obj.cp56time2a = data_time
+                    if 'cp24time2a' in obj:
+                        obj.cp24time2a = data_time
+                self.assert_same_decode(iec_104.build_isu(frame))
+        with self.assertRaises(ValueError):
+            decode(soe_bin[:-1])
+        with self.assertRaises(ValueError):
+            decode(b"\x68\x04\x07")
+
+    def test_fast_encode(self):
+        for data in (soe_bin, i_bin, s_bin, u_bin, i_big):
+            self.assertEqual(encode(iec_104.parse(data)), data)
+        for u_frame in UFrame:
+            c = iec_104.init_frame(u_frame)
+            self.assertEqual(encode(c), iec_104.build_isu(c))
+        for rsn in (0, 74, 32767):
+            c = iec_104.init_frame("S", rsn)
+            self.assertEqual(encode(c), iec_104.build_isu(c))
+        data_time = datetime.datetime(2016, 3, 1, 12, 30, 15, 123000)
+        for typ in TYP:
+            fields = OBJECT_FORMATS[typ][0]
+            for sq in (0, 1):
+                frame = iec_104.init_frame(10, 20, typ, Cause.act, sq_count=3, sq=sq)
+                frame.ASDU.StartAddress = 0x10203
+                for idx, obj in enumerate(frame.ASDU.data):
+                    for name in obj:
+                        if name == 'address':
+                            obj.address = 0x30201 + idx
+                        elif name in ('cp56time2a', 'cp24time2a'):
+                            obj[name] = data_time
+                        elif name == 'value' and fields[0] == 'f':
+                            obj.value = idx + 1.5
+                        elif name in ('value', 'CD', 'CP16Time2a') and fields[0] in 'HI':
+                            obj[name] = idx + 1000
+                        else:  # bits are truncated, flags not in (0, 1) are default
+                            obj[name] = (idx + 1) * 3
+                self.assertEqual(encode(frame), iec_104.build_isu(frame))
+        frame.ASDU.sq_count = 4
+        with self.assertRaises(ValueError):
+            encode(frame)
@@ -1,4 +1,5 @@
 import asyncio
+import datetime
 import aiohttp
 import aioredis
 import asynctest
@@ -77,6 +78,19 @@ class InterfaceTest(asynctest.TestCase):
             server.close()
             self.loop.run_until_complete(server.wait_closed())
 
+    async def test_get_index(self):
+        async with aiohttp.get('http://127.0.0.1:8080/') as r:
+            self.assertEqual(r.status, 200)
+            rst = await r.text()
+            self.assertIn('method: GET      URL: http://127.0.0.1:8080/api/v1/devices/{device_id}\n', rst)
+            etag = r.headers['ETag']
+        async with aiohttp.get('http://127.0.0.1:8080/', headers={'If-None-Match': etag}) as r:
+            self.assertEqual(r.status, 304)
+        async with aiohttp.get('http://127.0.0.1:8080/api/v1/openapi.json') as r:
+            self.assertEqual(r.status, 200)
+            rst = await r.json()
+            self.assertEqual(rst['paths']['/api/v1/devices/{device_id}']['delete']['operationId'], 'del_device')
+
     async def test_get_redis_key(self):
         async with aiohttp.get('http://127.0.0.1:8080/api/v1/redis_key') as r:
             self.assertEqual(r.status, 200)
@@ -163,6 +177,15 @@ name 'p2' is not defined
             rst = await r.text()
             self.assertEqual(rst, "parameter not found: p1=123:45:6")
 
+        async def check(formula):  # same length of repr(), results must not be mixed up
+            async with aiohttp.post('http://127.0.0.1:8080/api/v1/formula_check', data=json.dumps(
+                    {'formula': formula, 'p1': '1:10:1000'})) as resp:
+                return await resp.text()
+        rst = await asyncio.gather(check('p1[-1]+10'), check('p1[-1]+p3'), check('p1[-1]+10'))
+        self.assertEqual(rst[0], 'OK')
+        self.assertTrue(rst[1].startswith('NameError'))
+        self.assertEqual(rst[2], 'OK')
+
         formulas = [1]
         async with aiohttp.post('http://127.0.0.1:8080/api/v2/formulas/del', data=json.dumps(formulas)) as r:
             self.assertEqual(r.status, 200)
@@ -224,6 +247,19 @@ name 'p2' is not defined
             rst = self.redis_client.smembers('SET:DEVICE')
             self.assertEqual(len(rst), 0)
 
+        devices = [{'id': 6, 'name': '测试集中器6', 'protocol': 'formula'}, {'name': '测试集中器7', 'protocol': 'formula'}]
+        async with aiohttp.post('http://127.0.0.1:8080/api/v2/devices', data=json.dumps(devices)) as r:
+            self.assertEqual(r.status, 400)
+            rst = await r.text()
+            self.assertEqual(rst, 'element 1 missing id!')
+            rst = self.redis_client.exists('HS:DEVICE:6')
+            self.assertFalse(rst)
+        devices[1]['id'] = 7
+        async with aiohttp.post('http://127.0.0.1:8080/api/v2/devices', data=json.dumps(devices)) as r:
+            self.assertEqual(r.status, 200)
+            rst = self.redis_client.smembers('SET:DEVICE')
+            self.assertSetEqual(rst, {'6', '7'})
+
     async def test_term_CRUD(self):
         async with aiohttp.get('http://127.0.0.1:8080/api/v1/terms') as r:
             self.assertEqual(r.status, 200)
@@ -293,6 +329,12 @@ name 'p2' is not defined
             self.assertEqual(r.status, 200)
             rst = self.redis_client.smembers('SET:TERM')
             self.assertEqual(len(rst), 0)
+            rst = self.redis_client.exists('HS:MAPPING:IEC104:1:100')
+            self.assertFalse(rst)
+            rst = self.redis_client.exists('HS:DATA:1:10:1000')
+            self.assertFalse(rst)
+            rst = self.redis_client.exists('SET:TERM_DATA:10')
+            self.assertFalse(rst)
 
     async def test_item_CRUD(self):
         async with aiohttp.get('http://127.0.0.1:8080/api/v1/items') as r:
@@ -370,6 +412,40 @@ name 'p2' is not defined
             self.assertEqual(r.status, 200)
             rst = await r.json()
             self.assertEqual(len(rst), 0)
+        async with aiohttp.get('http://127.0.0.1:8080/api/v1/devices/1/terms/10/items/1000/datas',
+                               params={'limit': 2}) as r:
+            self.assertEqual(r.status, 200)
+            self.assertEqual(r.headers['X-Next-Cursor'], '2')
+            rst = await r.json()
+            self.assertDictEqual(rst, {'2015-12-01T08:50:15.000001': '100.0', '2015-12-01T08:50:15.000002': '101.0'})
+        async with aiohttp.get('http://127.0.0.1:8080/api/v1/devices/1/terms/10/items/1000/datas',
+                               params={'limit': 2, 'cursor': 2}) as r:
+            self.assertEqual(r.status, 200)
+            self.assertNotIn('X-Next-Cursor', r.headers)
+            rst = await r.json()
+            self.assertDictEqual(rst, {'2015-12-01T08:50:15.000003': '102.0'})
+        async with aiohttp.get('http://127.0.0.1:8080/api/v1/devices/1/terms/10/items/1000/datas',
+                               params={'start': '2015-12-01T08:50:15.000002', 'end': '2015-12-01T09:00:00'}) as r:
+            self.assertEqual(r.status, 200)
+            rst = await r.json()
+            self.assertDictEqual(rst, {'2015-12-01T08:50:15.000002': '101.0', '2015-12-01T08:50:15.000003': '102.0'})
+        async with aiohttp.get('http://127.0.0.1:8080/api/v1/devices/1/terms/10/items/1000/datas',
+                               params={'limit': 0}) as r:
+            self.assertEqual(r.status, 400)
+        async with aiohttp.post('http://127.0.0.1:8080/api/v2/datas/query', data=json.dumps({
+                'keys': ['1:10:1000', {'device_id': 1, 'term_id': 10, 'item_id': 2000}, '99:99:99']})) as r:
+            self.assertEqual(r.status, 200)
+            rst = await r.json()
+            self.assertDictEqual(rst, {
+                '1:10:1000': {'time': ['2015-12-01T08:50:15.000003'], 'value': ['102.0']},
+                '1:10:2000': {'time': ['2015-12-01T08:50:15.000006'], 'value': ['1.0']},
+                '99:99:99': {'time': [], 'value': []}})
+        async with aiohttp.post('http://127.0.0.1:8080/api/v2/datas/query', data=json.dumps({
+                'keys': ['1:10:1000'], 'start': '2015-12-01T08:50:15.000002', 'latest': 5})) as r:
+            self.assertEqual(r.status, 200)
+            rst = await r.json()
+            self.assertDictEqual(rst, {'1:10:1000': {
+                'time': ['2015-12-01T08:50:15.000002', '2015-12-01T08:50:15.000003'], 'value': ['101.0', '102.0']}})
 
     async def test_term_item_CRUD(self):
         async with aiohttp.get('http://127.0.0.1:8080/api/v1/terms/10/items/1000') as r:
@@ -399,6 +475,10 @@ name 'p2' is not defined
             self.assertDictEqual(rst, mock_data.test_term_item)
             rst = self.redis_client.sismember('SET:TERM_ITEM:20', 2000)
             self.assertTrue(rst)
+            rst = self.redis_client.sismember('SET:TERM_MAPPING:20', 'HS:MAPPING:IEC104:1:400')
+            self.assertTrue(rst)
+            rst = self.redis_client.sismember('SET:ITEM_TERM:2000', 20)
+            self.assertTrue(rst)
         async with aiohttp.post('http://127.0.0.1:8080/api/v1/terms/20/items',
                                 data=json.dumps(mock_data.test_term_item)) as r:
             self.assertEqual(r.status, 409)
@@ -439,6 +519,40 @@ name 'p2' is not defined
             rst = list(self.redis_client.scan_iter('HS:TERM_ITEMS:*'))
             self.assertEqual(len(rst), 0)
 
+    async def test_term_item_batch(self):
+        term_items = [mock_data.test_term_item, dict(mock_data.test_term_item, term_id='99')]
+        async with aiohttp.post('http://127.0.0.1:8080/api/v2/term_items', data=json.dumps(term_items)) as r:
+            self.assertEqual(r.status, 404)
+            rst = await r.text()
+            self.assertEqual(rst, 'element 1 term_id not found!')
+            self.assertFalse(self.redis_client.exists('HS:TERM_ITEM:20:2000'))
+        # device_id of body is ignored, old mapping is replaced by new protocol_code
+        term_items = [dict(mock_data.term10_item1000, device_id='2', protocol_code='101')]
+        async with aiohttp.post('http://127.0.0.1:8080/api/v2/term_items', data=json.dumps(term_items)) as r:
+            self.assertEqual(r.status, 200)
+            self.assertFalse(self.redis_client.exists('HS:MAPPING:IEC104:1:100'))
+            self.assertFalse(self.redis_client.sismember('SET:TERM_MAPPING:10', 'HS:MAPPING:IEC104:1:100'))
+            rst = self.redis_client.hgetall('HS:MAPPING:IEC104:1:101')
+            self.assertEqual(rst['device_id'], '1')
+            self.assertTrue(self.redis_client.sismember('SET:ITEM_MAPPING:1000', 'HS:MAPPING:IEC104:1:101'))
+
+    async def test_del_item_running_device(self):
+        device = self.api_server.plugin_dict['DeviceManager'].device_dict['1']
+        await device.data_link_established
+        data_time = datetime.datetime.now()
+        await device.process_data({(data_time, 100, 1.5)})
+        self.assertEqual(self.redis_client.hget('HS:DATA:1:10:1000', data_time.isoformat()), '1.5')
+        self.assertIn('100', device.mapping_dict)
+        async with aiohttp.delete('http://127.0.0.1:8080/api/v1/items/1000') as r:
+            self.assertEqual(r.status, 200)
+        await asyncio.sleep(0.5)  # wait for CHANNEL:TERM_ITEM_DEL
+        self.assertNotIn('100', device.mapping_dict)
+        self.assertNotIn('300', device.mapping_dict)
+        await device.process_data({(datetime.datetime.now(), 100, 2.5), (datetime.datetime.now(), 300, 2.5)})
+        self.assertFalse(self.redis_client.exists('HS:DATA:1:10:1000'))
+        self.assertFalse(self.redis_client.exists('HS:DATA:1:20:1000'))
+        self.assertFalse(self.redis_client.hexists('HS:LAST_VALUE', '1:10:1000'))
+
     async def test_device_call(self):
         call_dict = {'device_id': '1', 'term_id': '10', 'item_id': 1000}
         async with aiohttp.post('http://127.0.0.1:8080/api/v1/device_call', data=json.dumps(call_dict)) as r:
@@ -446,6 +560,25 @@ name 'p2' is not defined
             rst = await r.json()
             self.assertAlmostEqual(rst['value'], 102, delta=0.0001)
 
+    async def test_device_call_batch(self):
+        call_list = [{'device_id': '1', 'term_id': '10', 'item_id': 1000},
+                     {'device_id': 1, 'term_id': 20, 'item_id': 1000},
+                     {'device_id': '2', 'term_id': '30', 'item_id': '1000'},
+                     {'device_id': '1', 'term_id': '10', 'item_id': '1000'},
+                     {'device_id': '1', 'term_id': '10', 'item_id': '3000'}]
+        async with aiohttp.post('http://127.0.0.1:8080/api/v2/device_call', data=json.dumps(call_list)) as r:
+            self.assertEqual(r.status, 200)
+            rst_list = [json.loads(line) for line in (await r.text()).splitlines()]
+        self.assertEqual(len(rst_list), 4)
+        self.assertDictEqual(rst_list[0], {'device_id': '1', 'term_id': '10', 'item_id': '3000',
+                                           'status': 'not_found'})
+        rst_dict = {(rst['device_id'], rst['term_id'], rst['item_id']): rst for rst in rst_list[1:]}
+        self.assertEqual(set(rst_dict), {('1', '10', '1000'), ('1', '20', '1000'), ('2', '30', '1000')})
+        self.assertTrue(all(rst['status'] == 'ok' for rst in rst_dict.values()))
+        self.assertAlmostEqual(rst_dict[('1', '10', '1000')]['value'], 102, delta=0.0001)
+        async with aiohttp.post('http://127.0.0.1:8080/api/v2/device_call', data=json.dumps([{'device_id': 1}])) as r:
+            self.assertEqual(r.status, 400)
+
     async def test_device_ctrl(self):
         ctrl_dict = {'device_id': '2', 'term_id': '30', 'item_id': '1000', 'value': 123.4}
         async with aiohttp.post('http://127.0.0.1:8080/api/v1/device_ctrl', data=json.dumps(ctrl_dict)) as r:
@@ -459,3 +592,86 @@ name 'p2' is not defined
             self.assertEqual(r.status, 200)
             rst = await r.text()
             self.assertEqual(rst, 'not found sql to check')
+        term_item = dict(mock_data.term10_item1000, db_save_sql='INSERT INTO test_db_save VALUE')
+        async with aiohttp.post('http://127.0.0.1:8080/api/v1/sql_check', data=json.dumps(term_item)) as r:
+            self.assertEqual(r.status, 200)
+            rst = await r.text()
+            self.assertTrue(rst.startswith('(1064, '), rst)
+
+    async def test_data_aggregate(self):
+        url = 'http://127.0.0.1:8080/api/v1/devices/1/terms/10/items/1000/datas/aggregate'
+        async with aiohttp.get(url, params={'interval': '1h', 'fn': 'avg,max,count'}) as r:
+            self.assertEqual(r.status, 200)
+            rst = await r.json()
+            self.assertDictEqual(rst, {'time': ['2015-12-01T08:00:00'], 'avg': [101.0], 'max': [102.0], 'count': [3]})
+        time_str = '2015-12-01T09:00:00'
+        self.redis_client.hset('HS:DATA:1:10:1000', time_str, 200)
+        self.redis_client.rpush('LST:DATA_TIME:1:10:1000', time_str)
+        self.redis_client.publish('CHANNEL:DEVICE_DATA:1:10:1000', json.dumps({
+            'device_id': 1, 'term_id': 10, 'item_id': 1000, 'time': time_str, 'value': 200}))
+        await asyncio.sleep(0.5)
+        async with aiohttp.get(url, params={'interval': '1h', 'fn': 'avg,max,count'}) as r:
+            self.assertEqual(r.status, 200)
+            rst = await r.json()
+            self.assertEqual(rst['time'], ['2015-12-01T08:00:00', '2015-12-01T09:00:00'])
+            self.assertEqual(rst['count'], [3, 1])
+        async with aiohttp.get(url, params={'interval': '1h', 'fn': 'median'}) as r:
+            self.assertEqual(r.status, 400)
+
+    async def test_live_websocket(self):
+        ws = await aiohttp.ws_connect('http://127.0.0.1:8080/api/v1/live/ws?pattern=1:10:*')
+        ws.send_str(json.dumps({'subscribe': ['2:30:1000']}))
+        await asyncio.sleep(0.5)
+        for device_id, term_id in ((1, 10), (1, 20), (2, 30)):
+            self.redis_client.publish('CHANNEL:DEVICE_DATA:{}:{}:1000'.format(device_id, term_id), json.dumps({
+                'device_id': device_id, 'term_id': term_id, 'item_id': 1000, 'time': '2016-01-01T00:00:00',
+                'value': 1.0}))
+        rst = list()
+        while len(rst) < 2:
+            msg = await asyncio.wait_for(ws.receive(), 5)
+            rst.extend(json.loads(msg.data))
+        self.assertEqual(sorted((data['device_id'], data['term_id']) for data in rst), [(1, 10), (2, 30)])
+        await ws.close()
+
+    async def test_import_export(self):
+        async with aiohttp.get('http://127.0.0.1:8080/api/v2/export', params={'gzip': '0'}) as r:
+            self.assertEqual(r.status, 200)
+            rst = [json.loads(line) for line in (await r.text()).splitlines()]
+            # 2 items, 3 devices, 4 terms, 5 term_items, 4 mappings and 1 formula
+            self.assertEqual(len(rst), 19)
+            self.assertEqual(rst[0]['type'], 'item')
+        async with aiohttp.get('http://127.0.0.1:8080/api/v2/export') as r:
+            self.assertEqual(r.status, 200)
+            body = await r.read()
+        self.redis_client.flushdb()
+        async with aiohttp.post('http://127.0.0.1:8080/api/v2/import', data=body) as r:
+            self.assertEqual(r.status, 200)
+            rst = await r.json()
+            self.assertEqual(rst, {'imported': 19})
+            rst = self.redis_client.hgetall('HS:DEVICE:1')
+            self.assertDictEqual(rst, mock_data.device1)
+            rst = self.redis_client.hgetall('HS:MAPPING:IEC104:1:100')
+            self.assertDictEqual(rst, mock_data.term10_item1000)
+            rst = self.redis_client.sismember('SET:TERM_MAPPING:10', 'HS:MAPPING:IEC104:1:100')
+            self.assertTrue(rst)
+            rst = self.redis_client.smembers('SET:FORMULA_PARAM:1:10:1000')
+            self.assertSetEqual(rst, {'1'})
+        body = '{"type": "item", "data": {"id": "5000"}}\n{"type": "term", "data": {"id": "50"}}\n'
+        async with aiohttp.post('http://127.0.0.1:8080/api/v2/import', data=body) as r:
+            self.assertEqual(r.status, 400)
+            rst = await r.text()
+            self.assertEqual(rst, 'line 2: missing device_id, 0 records imported')
+            rst = self.redis_client.exists('HS:ITEM:5000')
+            self.assertFalse(rst)
+
+    async def test_redis_stats(self):
+        call_dict = {'device_id': '1', 'term_id': '10', 'item_id': 1000}
+        async with aiohttp.post('http://127.0.0.1:8080/api/v1/device_call', data=json.dumps(call_dict)) as r:
+            self.assertEqual(r.status, 200)
+        async with aiohttp.get('http://127.0.0.1:8080/api/v1/redis_stats') as r:
+            self.assertEqual(r.status, 200)
+            rst = await r.json()
+            self.assertEqual(rst['pool']['maxsize'], config.getint('REDIS', 'pool_maxsize', fallback=20))
+            self.assertGreater(rst['pool']['commands'], 0)
+            self.assertLessEqual(rst['pool']['size'], rst['pool']['maxsize'])
+            self.assertGreater(rst['pubsub']['channels'], 0)  # channels psubscribed by plugins
@@ -1,7 +1,19 @@
+import asyncio
 import unittest
 import pydatacoll.utils.logger as my_logger
 from pydatacoll.utils.func_container import ParamFunctionContainer, param_function
-from pydatacoll.utils import str_to_number
+from pydatacoll.utils import str_to_number, make_param
+from pydatacoll.utils.sql_template import SQLTemplate
+from pydatacoll.utils.expression import compile_expression
+from pydatacoll.utils.last_value import LastValueStore
+from pydatacoll.utils.time_index import TimeIndex, to_timestamp
+from pydatacoll.utils.aggregate import aggregate, AggregateCache
+from pydatacoll.utils.live_feed import LiveFeed
+from pydatacoll.utils.key_index import KeyIndex
+from pydatacoll.utils.redis_pool import Pipeline, PubSubBroker
+from pydatacoll.utils.site_model import ModelReader, ModelWriter
+from pydatacoll.utils.api_doc import index_text, openapi_spec, route_list
+from pydatacoll.utils.send_queue import SendQueue, PRIORITY_CTRL, PRIORITY_CALL, PRIORITY_TASK
 
 logger = my_logger.get_logger('UtilTest')
 
@@ -28,7 +40,272 @@ class UtilTest(unittest.TestCase):
         self.assertDictEqual(api.module_arg_dict, {'api_device_list': {'method': 'GET', 'url': '/devices'},
                                                    'api_new_device': {'method': 'POST', 'url': '/devices_new'}})
 
+    def test_api_doc(self):
+
+        class MyAPI(ParamFunctionContainer):
+            @param_function(method='DELETE', url=r'/api/v1/devices/{device_id}')
+            def del_device(self, request):
+                pass
+
+            @param_function(method='GET', url=r'/api/v1/devices/{device_id}/datas/{index:-?\d+}')
+            def get_data(self, request):
+                """
+                data of index
+                """
+
+        api = MyAPI()
+        routes = route_list(api.module_arg_dict)
+        self.assertEqual(routes, [('GET', '/api/v1/devices/{device_id}/datas/{index}'),
+                                  ('DELETE', '/api/v1/devices/{device_id}')])
+        self.assertEqual(index_text(routes, 'http://host').splitlines()[-1],
+                         'method: DELETE   URL: http://host/api/v1/devices/{device_id}')
+        spec = openapi_spec(api)
+        operation = spec['paths']['/api/v1/devices/{device_id}/datas/{index}']['get']
+        self.assertEqual(operation['operationId'], 'get_data')
+        self.assertEqual(operation['summary'], 'data of index')
+        self.assertEqual(operation['tags'], ['devices'])
+        self.assertEqual(operation['parameters'][1]['schema'], {'type': 'string', 'pattern': '^-?\\d+$'})
+        self.assertEqual(spec['paths']['/api/v1/devices/{device_id}']['delete']['summary'], 'del device')
+
     def test_str_to_number(self):
         self.assertEqual(str(1.1), str(str_to_number('1.1')))
         self.assertEqual(str(1), str(str_to_number('1')))
         self.assertEqual(str(1), str(str_to_number(1)))
+
+    def test_make_param(self):
+        param = make_param({'device_id': 1, 'value': 12.3})
+        self.assertEqual((param.device_id, param.value), (1, 12.3))
+        self.assertIs(type(param), type(make_param({'device_id': 2, 'value': 45.6})))
+        self.assertIsNot(type(param), type(make_param({'value': 45.6, 'device_id': 2})))
+
+    def test_sql_template(self):
+        data_dict = {'device_id': 1, 'term_id': '10', 'item_id': '20', 'time': '2016-01-01T00:00:00', 'value': 12.3,
+                     'warn_msg': "it's 100%"}
+        template = SQLTemplate("insert into test_db_save(device_id,term_id,item_id,time,value) VALUES "
+                               "('{PARAM.device_id}','{PARAM.term_id}','{PARAM.item_id}','{PARAM.time}',{PARAM.value})")
+        self.assertEqual(template.statement, "insert into test_db_save(device_id,term_id,item_id,time,value) VALUES "
+                                             "(%s,%s,%s,%s,%s)")
+        self.assertEqual(template.extract(data_dict), ('1', '10', '20', '2016-01-01T00:00:00', 12.3))
+        template = SQLTemplate("update t set value={PARAM.value:.2f}, msg=\"{PARAM.warn_msg}\" where name like 'a%'")
+        self.assertEqual(template.statement, "update t set value=%s, msg=%s where name like 'a%%'")
+        self.assertEqual(template.extract(data_dict), ('12.30', "it's 100%"))
+        # field used as table name or inside a string literal can't be parameterized
+        for sql in ("insert into t_{PARAM.device_id}(value) VALUES ({PARAM.value})",
+                    "insert into t(msg) VALUES ('{PARAM.term_id}-{PARAM.item_id}')"):
+            template = SQLTemplate(sql)
+            self.assertIsNone(template.statement)
+            self.assertEqual(template.render(data_dict), sql.format(PARAM=type('Param', (), data_dict)))
+
+    def test_compile_expression(self):
+        param = type('Param', (), {'down_limit': 50, 'up_limit': 100})
+        verify = compile_expression('param.down_limit <= float(value) <= param.up_limit')
+        self.assertTrue(verify(param=param, value='60.5'))
+        self.assertFalse(verify(param=param, value='123.4'))
+        self.assertTrue(compile_expression('int(value) == 42 and sqrt(16) == 4')(param=param, value='42'))
+        for expression in ('__import__("os")', 'param.__class__', 'open("/etc/passwd")', '[x for x in value]',
+                           'lambda: 1'):
+            self.assertRaises(ValueError, compile_expression, expression)
+        self.assertRaises(SyntaxError, compile_expression, 'value = 1')
+
+    def test_last_value_store(self):
+        store = LastValueStore(deadband=1e-04)
+        data = {'device_id': '1', 'term_id': '10', 'item_id': '1000', 'value': 102.0}
+        self.assertEqual(store.changed(data), (True, None))
+        self.assertEqual(store.changed(data), (False, 102.0))
+        self.assertEqual(store.changed(dict(data, value=102.00001)), (False, 102.0))
+        self.assertEqual(store.changed(dict(data, value=105.0), deadband=0.1), (False, 102.00001))
+        self.assertEqual(store.changed(dict(data, value=106.0, last_value='50')), (True, '50'))
+        self.assertEqual(store.get_deadband({'deadband': '0.5'}), 0.5)
+        self.assertEqual(store.get_deadband({}), 1e-04)
+        self.assertEqual(store.get_deadband({'deadband': None}), 1e-04)
+
+    def test_time_index(self):
+        self.assertEqual(to_timestamp('1970-01-01T00:01:40'), 100)
+        self.assertEqual(to_timestamp('1970-01-01T00:01:40.500000'), 100.5)
+        self.assertEqual(to_timestamp('1970-01-01T08:01:40+08:00'), 100)
+        time_list = ['2016-01-01T08:00:00.000001', '2016-01-01T07:59:59', '2016-01-01T08:00:00']
+        self.assertEqual(sorted(time_list, key=to_timestamp), [time_list[1], time_list[2], time_list[0]])
+        self.assertEqual(TimeIndex('zset').key('1:10:20'), 'ZS:DATA_TIME:1:10:20')
+        self.assertEqual(TimeIndex('list').key('1:10:20'), 'LST:DATA_TIME:1:10:20')
+        self.assertRaises(ValueError, TimeIndex, 'hash')
+        pipe = Pipeline(None)
+        TimeIndex('zset').trim(pipe, '1:10:20', time_list[:2])
+        TimeIndex('list').trim(pipe, '1:10:20', time_list[:2])
+        self.assertEqual(pipe.command_list[0][:2], ('zrem', ('ZS:DATA_TIME:1:10:20', time_list[0], time_list[1])))
+        self.assertEqual(pipe.command_list[1][:2], ('ltrim', ('LST:DATA_TIME:1:10:20', 2, -1)))
+
+    def test_key_index(self):
+        pipe = Pipeline(None)
+        KeyIndex.add_data(pipe, '1:10:20')
+        KeyIndex.add_mapping(pipe, 'HS:MAPPING:IEC104:1:100', {'term_id': '10', 'item_id': '20'})
+        KeyIndex.add_term_item(pipe, '10', '20')
+        self.assertEqual([args for _, args, _ in pipe.command_list], [
+            ('SET:DEVICE_DATA:1', '1:10:20'), ('SET:TERM_DATA:10', '1:10:20'), ('SET:ITEM_DATA:20', '1:10:20'),
+            ('SET:DEVICE_MAPPING:1', 'HS:MAPPING:IEC104:1:100'), ('SET:TERM_MAPPING:10', 'HS:MAPPING:IEC104:1:100'),
+            ('SET:ITEM_MAPPING:20', 'HS:MAPPING:IEC104:1:100'), ('SET:TERM_ITEM:10', '20'), ('SET:ITEM_TERM:20', '10')])
+        self.assertEqual(set(name for name, _, _ in pipe.command_list), {'sadd'})
+        pipe = Pipeline(None)
+        KeyIndex.remove_term_item(pipe, '10', '20')
+        self.assertEqual([name for name, _, _ in pipe.command_list], ['delete', 'srem', 'srem'])
+
+    def test_site_model(self):
+        records = [{'type': 'device', 'data': {'id': '1', 'name': '测试集中器1', 'protocol': 'iec104'}},
+                   {'type': 'mapping', 'key': 'HS:MAPPING:IEC104:1:100', 'data': {'term_id': '10', 'item_id': '20'}}]
+        for compress in (True, False):
+            writer = ModelWriter(compress)
+            body = writer.encode(records[:1]) + writer.encode(records[1:]) + writer.flush()
+            reader = ModelReader()
+            rst = list()
+            for idx in range(0, len(body), 7):
+                rst.extend(reader.feed(body[idx:idx + 7]))
+            rst.extend(reader.close())
+            self.assertEqual(rst, records)
+        reader = ModelReader()
+        self.assertEqual(reader.feed(b'{"type": "item", "data": {"id": 1}}\n{"type": "term", "data": {"id": 2'), [
+            {'type': 'item', 'data': {'id': 1}}])
+        self.assertRaisesRegex(ValueError, 'line 2: missing device_id', reader.feed, b'}}\n')
+        self.assertRaisesRegex(ValueError, 'line 1: unknown record type', ModelReader().feed, b'{"type": "x"}\n')
+        mapping = b'{"type": "mapping", "key": "%s", "data": {"term_id": "10", "item_id": "20"%s}}\n'
+        self.assertRaisesRegex(ValueError, 'line 1: invalid mapping key', ModelReader(['1']).feed,
+                               mapping % (b'HS:TERM_ITEM:IEC104:1:100', b''))
+        self.assertRaisesRegex(ValueError, 'line 1: device_id mismatch', ModelReader(['1']).feed,
+                               mapping % (b'HS:MAPPING:IEC104:1:100', b', "device_id": "2"'))
+        self.assertRaisesRegex(ValueError, 'line 1: device_id of mapping key not found', ModelReader(['2']).feed,
+                               mapping % (b'HS:MAPPING:IEC104:1:100', b''))
+        self.assertEqual(len(ModelReader([1]).feed(mapping % (b'HS:MAPPING:IEC104:1:100', b''))), 1)
+
+    def test_aggregate(self):
+        data_dict = {'2016-01-01T08:10:00': '1', '2016-01-01T08:50:00.000001': '3', '2016-01-01T10:00:00': '5',
+                     '2016-01-01T10:30:00': 'NaN'}
+        self.assertEqual(aggregate(data_dict, '1h', ['avg', 'max', 'count']), {
+            'time': ['2016-01-01T08:00:00', '2016-01-01T10:00:00'], 'avg': [2.0, 5.0], 'max': [3.0, 5.0],
+            'count': [2, 1]})
+        self.assertEqual(aggregate(data_dict, '1d', ['sum', 'min']),
+                         {'time': ['2016-01-01T00:00:00'], 'sum': [9.0], 'min': [1.0]})
+        self.assertEqual(aggregate({}, '15min', ['avg']), {'time': [], 'avg': []})
+        self.assertRaises(ValueError, aggregate, data_dict, '1y', ['avg'])
+        self.assertRaises(ValueError, aggregate, data_dict, '1h', ['median'])
+        cache = AggregateCache(maxsize=2)
+        cache.put(('1:10:20', '1h'), 1)
+        cache.put(('1:10:30', '1h'), 2)
+        self.assertEqual(cache.get(('1:10:20', '1h')), 1)
+        cache.put(('1:10:40', '1h'), 3)
+        self.assertIsNone(cache.get(('1:10:30', '1h')))
+        version = cache.version('1:10:20')
+        cache.invalidate('1:10:20')
+        self.assertIsNone(cache.get(('1:10:20', '1h')))
+        cache.put(('1:10:20', '1h'), 1, version)
+        self.assertIsNone(cache.get(('1:10:20', '1h')))
+        self.assertEqual(cache.stats, {'size': 1, 'maxsize': 2, 'hits': 1, 'misses': 3})
+
+    def test_live_feed(self):
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        feed = LiveFeed(['1:10:*'], maxsize=2)
+        self.assertTrue(feed.match('1:10:20'))
+        self.assertFalse(feed.match('1:100:20'))
+        feed.subscribe(['2:*'])
+        self.assertTrue(feed.match('2:30:40'))
+        feed.put('1:10:20', 'a1')
+        feed.put('1:10:30', 'b1')
+        feed.put('1:10:20', 'a2')
+        feed.put('2:30:40', 'c1')
+        self.assertEqual(loop.run_until_complete(feed.get()), ['a2', 'c1'])
+        self.assertEqual((feed.coalesced, feed.dropped, feed.sent), (1, 1, 2))
+        feed.unsubscribe(['2:*'])
+        self.assertFalse(feed.match('2:30:40'))
+        loop.call_soon(feed.put, '1:10:20', 'a3')
+        self.assertEqual(loop.run_until_complete(feed.get()), ['a3'])
+        loop.call_soon(feed.close)
+        self.assertEqual(loop.run_until_complete(feed.get()), [])
+        asyncio.set_event_loop(None)
+        loop.close()
+
+    def test_send_queue(self):
+        now = [0.0]
+        queue = SendQueue(maxsize=2, fair_share=2, clock=lambda: now[0])
+        self.assertTrue(queue.submit('ic', PRIORITY_TASK))
+        self.assertFalse(queue.submit('ci', PRIORITY_TASK))
+        self.assertFalse(queue.submit('rd1', PRIORITY_CALL, timeout=5))
+        self.assertFalse(queue.submit('rd2', PRIORITY_CALL, timeout=5))
+        self.assertRaises(asyncio.QueueFull, queue.submit, 'rd3', PRIORITY_CALL)
+        self.assertFalse(queue.submit('sc1', PRIORITY_CTRL, timeout=1))
+        self.assertEqual((queue.inflight, len(queue)), ('ic', 4))
+        now[0] = 0.5
+        self.assertEqual(queue.pop(), 'sc1')  # control first
+        self.assertEqual(queue.pop(), 'rd1')
+        queue.put('sc2', PRIORITY_CTRL, timeout=1)
+        queue.put('sc3', PRIORITY_CTRL, timeout=10)
+        now[0] = 2
+        self.assertEqual(queue.pop(), 'ci')  # task passed over twice
+        self.assertEqual(queue.pop(), 'sc3')  # sc2 expired
+        self.assertEqual(queue.pop(), 'rd2')
+        self.assertIsNone(queue.pop())
+        self.assertFalse(queue.busy)
+        stats = queue.stats
+        self.assertEqual(stats['ctrl'], {'pending': 0, 'sent': 2, 'expired': 1, 'rejected': 0,
+                                         'wait_avg': 1.0, 'wait_max': 1.5})
+        self.assertEqual((stats['call']['sent'], stats['call']['rejected'], stats['call']['wait_max']), (2, 1, 2))
+        self.assertEqual((stats['task']['sent'], stats['task']['wait_avg']), (2, 1.0))
+
+    def test_pubsub_broker(self):
+
+        class FakeChannel(object):
+            def __init__(self):
+                self.queue = asyncio.Queue()
+
+            async def wait_message(self):
+                self.message = await self.queue.get()
+                return self.message is not None
+
+            async def get(self):
+                return self.message
+
+        class FakeClient(object):
+            closed = False
+            subscribe_count = 0
+
+            async def subscribe(self, channel):
+                FakeClient.subscribe_count += 1
+                await asyncio.sleep(0.01)
+                self.ch = FakeChannel()
+                return [self.ch]
+
+            async def unsubscribe(self, channel):
+                self.ch.queue.put_nowait(None)
+
+            def publish(self, msg):
+                self.ch.queue.put_nowait(msg)
+
+        async def run():
+            broker = PubSubBroker(loop)
+            broker.resubscribe_delay = 0.01
+            client = broker.sub_client = FakeClient()
+            sub1, sub2 = await asyncio.gather(broker.subscribe('CH').open(), broker.subscribe('CH', maxsize=1).open())
+            self.assertEqual(FakeClient.subscribe_count, 1)
+            client.publish(b'1')
+            client.publish(b'2')
+            await asyncio.sleep(0.01)
+            self.assertEqual([sub1.queue.qsize(), sub2.queue.qsize(), sub2.dropped], [2, 1, 1])
+            await sub2.close()  # queue is full, close sentinel is put anyway
+            self.assertEqual(await sub2.get(), None)
+            client.closed = True  # connection lost, channel is subscribed again on a new client
+            client.ch.queue.put_nowait(None)
+            new_client = FakeClient()
+
+            async def get_client():
+                broker.sub_client = new_client
+                return new_client
+            broker.get_client = get_client
+            await asyncio.sleep(0.05)
+            self.assertEqual((FakeClient.subscribe_count, broker.stats['resubscribes']), (2, 1))
+            new_client.publish(b'3')
+            await asyncio.sleep(0.01)
+            self.assertEqual([(await sub1.get())[1] for _ in range(3)], ['1', '2', '3'])
+            await sub1.close()
+            self.assertEqual(await sub1.get(), None)
+            self.assertEqual((broker.subscription_dict, broker.reader_dict, broker.lock_dict), ({}, {}, {}))
+
+        loop = asyncio.new_event_loop()
+        loop.run_until_complete(run())
+        loop.close()